@@ -0,0 +1,257 @@
+"""
+Per-user admission control.
+
+AdmissionMiddleware runs before routing and before any request body is
+read. It identifies the user from the bearer token, the same way
+get_current_user does. Each user then has:
+
+- a token bucket of RATE_LIMIT_BURST requests, refilled at
+  RATE_LIMIT_PER_SECOND;
+- at most RATE_LIMIT_MAX_HEAVY heavy requests (uploads, downloads,
+  extraction) in progress at once;
+- optionally, upload bodies read at no more than UPLOAD_BANDWIDTH_PER_USER
+  bytes per second across all of their uploads. The client is slowed down
+  by TCP backpressure, not rejected.
+
+Requests over a limit get 429 with Retry-After. Requests without a valid
+token pass through, and the route answers them with 401. Counters live in
+the process, or in Postgres with RATE_LIMIT_BACKEND=postgres so that every
+worker enforces the same limits. Bandwidth shaping is always per process.
+"""
+import asyncio
+import json
+import math
+import re
+import time
+import uuid
+from collections import defaultdict
+from functools import lru_cache
+
+from fastapi import HTTPException
+
+from .cache import TTLCache
+from .config import get_settings
+from .database import get_connection, run_db
+from .dependencies import verify_token
+
+settings = get_settings()
+
+# Requests that hold a heavy slot for as long as they run
+HEAVY_PATHS = re.compile(r"^/file/(upload|upload_bulk|download|download_dir|extract|upload_sessions/[^/]+/chunks/\d+)$")
+# Told to clients refused a heavy slot, which frees when some request ends
+HEAVY_RETRY_AFTER = 1
+# Postgres slots expire after this long, in case a worker dies holding one
+SLOT_LEASE_SECONDS = 3600
+# Users tracked by the in-process limiter
+MAX_TRACKED_USERS = 100000
+
+
+class MemoryLimiter:
+    """
+    Counters in this process. Everything runs on the event loop, so no
+    locking beyond what TTLCache already does.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        # A bucket left alone this long is full again, so it can be dropped
+        self._buckets = TTLCache(MAX_TRACKED_USERS, burst / rate if rate > 0 else 1)
+        self._slots = defaultdict(int)
+
+    async def take(self, key: str, cost: float = 1) -> float:
+        """
+        Takes `cost` tokens from the bucket. Returns 0 when allowed,
+        otherwise the seconds until enough tokens are back.
+        """
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+        if tokens < cost:
+            self._buckets.set(key, (tokens, now))
+            return (cost - tokens) / self.rate
+        self._buckets.set(key, (tokens - cost, now))
+        return 0
+
+    async def acquire(self, key: str, limit: int):
+        if self._slots[key] >= limit:
+            return None
+        self._slots[key] += 1
+        return key
+
+    async def release(self, slot):
+        self._slots[slot] -= 1
+        if self._slots[slot] <= 0:
+            del self._slots[slot]
+
+
+def _pg_take(key: str, rate: float, burst: int, cost: float) -> float:
+    # Refill using the database clock, so workers' clocks don't matter.
+    # The upsert locks the row until commit.
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO rate_limit_buckets AS b (key, tokens, updated_at)
+                VALUES (%(key)s, %(burst)s, extract(epoch FROM clock_timestamp()))
+                ON CONFLICT (key) DO UPDATE SET
+                    tokens = LEAST(%(burst)s, b.tokens + (EXCLUDED.updated_at - b.updated_at) * %(rate)s),
+                    updated_at = EXCLUDED.updated_at
+                RETURNING tokens
+                """,
+                {"key": key, "burst": burst, "rate": rate},
+            )
+            tokens = cur.fetchone()[0]
+            if tokens < cost:
+                return (cost - tokens) / rate
+            cur.execute("UPDATE rate_limit_buckets SET tokens = tokens - %s WHERE key = %s", (cost, key))
+            return 0
+
+def _pg_acquire(key: str, limit: int):
+    slot_id = uuid.uuid4().hex
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            # Serializes acquires for this key until commit
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (key,))
+            cur.execute(
+                "DELETE FROM rate_limit_slots WHERE key = %s AND expires_at < extract(epoch FROM clock_timestamp())",
+                (key,),
+            )
+            cur.execute("SELECT count(*) FROM rate_limit_slots WHERE key = %s", (key,))
+            if cur.fetchone()[0] >= limit:
+                return None
+            cur.execute(
+                "INSERT INTO rate_limit_slots (slot_id, key, expires_at) "
+                "VALUES (%s, %s, extract(epoch FROM clock_timestamp()) + %s)",
+                (slot_id, key, SLOT_LEASE_SECONDS),
+            )
+    return slot_id
+
+def _pg_release(slot_id: str):
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM rate_limit_slots WHERE slot_id = %s", (slot_id,))
+
+
+class PostgresLimiter:
+    """
+    Counters shared by every worker on the same database, at the cost of a
+    round trip per check.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+
+    async def take(self, key: str, cost: float = 1) -> float:
+        return await run_db(_pg_take, key, self.rate, self.burst, cost)
+
+    async def acquire(self, key: str, limit: int):
+        return await run_db(_pg_acquire, key, limit)
+
+    async def release(self, slot):
+        await run_db(_pg_release, slot)
+
+
+@lru_cache()
+def get_limiter():
+    if settings.RATE_LIMIT_BACKEND == "postgres":
+        if not settings.DATABASE_URL:
+            raise Exception("RATE_LIMIT_BACKEND=postgres needs DATABASE_URL")
+        return PostgresLimiter(settings.RATE_LIMIT_PER_SECOND, settings.RATE_LIMIT_BURST)
+    return MemoryLimiter(settings.RATE_LIMIT_PER_SECOND, settings.RATE_LIMIT_BURST)
+
+
+class _Bandwidth:
+    """
+    Byte budget per user for upload bodies. A chunk that overdraws the
+    budget is held back until it's paid off.
+    """
+
+    def __init__(self, rate: int):
+        self.rate = rate
+        self._buckets = TTLCache(MAX_TRACKED_USERS, 60)
+
+    async def throttle(self, key: str, size: int):
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.get(key, (self.rate, now))
+        # Up to one second's worth can build up while idle
+        tokens = min(self.rate, tokens + (now - updated_at) * self.rate) - size
+        self._buckets.set(key, (tokens, now))
+        if tokens < 0:
+            await asyncio.sleep(-tokens / self.rate)
+
+_bandwidth = _Bandwidth(settings.UPLOAD_BANDWIDTH_PER_USER) if settings.UPLOAD_BANDWIDTH_PER_USER > 0 else None
+
+
+def _bearer_user(scope):
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            scheme, _, token = value.decode("latin-1").partition(" ")
+            if scheme.lower() != "bearer" or not token:
+                return None
+            try:
+                return verify_token(token)
+            except HTTPException:
+                return None
+    return None
+
+def _shaped(receive, user_id: str):
+    async def shaped_receive():
+        message = await receive()
+        if message["type"] == "http.request" and message.get("body"):
+            await _bandwidth.throttle(user_id, len(message["body"]))
+        return message
+    return shaped_receive
+
+async def _too_many(send, retry_after: float, detail: str):
+    body = json.dumps({"detail": detail}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": 429,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class AdmissionMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        user = _bearer_user(scope)
+        if user is None:
+            await self.app(scope, receive, send)
+            return
+
+        limiter = get_limiter()
+        if settings.RATE_LIMIT_PER_SECOND > 0:
+            retry_after = await limiter.take(f"rate:{user.user_id}")
+            if retry_after:
+                await _too_many(send, retry_after, "Rate limit exceeded")
+                return
+
+        heavy = HEAVY_PATHS.match(scope["path"]) is not None
+        slot = None
+        if heavy and settings.RATE_LIMIT_MAX_HEAVY > 0:
+            slot = await limiter.acquire(f"heavy:{user.user_id}", settings.RATE_LIMIT_MAX_HEAVY)
+            if slot is None:
+                await _too_many(send, HEAVY_RETRY_AFTER, "Too many uploads or downloads in progress")
+                return
+
+        if heavy and _bandwidth is not None:
+            receive = _shaped(receive, user.user_id)
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            if slot is not None:
+                await limiter.release(slot)
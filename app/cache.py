@@ -0,0 +1,102 @@
+import heapq
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Small thread-safe LRU cache whose entries also expire after a TTL.
+    Sync dependencies run in the threadpool, hence the lock.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return default if entry is None else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+
+class ExpiringSet:
+    """
+    Thread-safe set whose members each expire at their own deadline and are
+    never evicted before it. Once `maxsize` live members are held, add()
+    refuses instead of dropping any.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._expires = {}
+        # (expires_at, member), soonest first, to purge expired members
+        self._heap = []
+        self._lock = threading.Lock()
+
+    def _purge(self, now: float):
+        while self._heap and self._heap[0][0] <= now:
+            expires_at, member = heapq.heappop(self._heap)
+            if self._expires.get(member) == expires_at:
+                del self._expires[member]
+
+    def add(self, member, ttl: float) -> bool:
+        # False when full; members already past their deadline need no entry
+        if ttl <= 0:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            self._purge(now)
+            if member not in self._expires and len(self._expires) >= self.maxsize:
+                return False
+            expires_at = max(now + ttl, self._expires.get(member, 0))
+            self._expires[member] = expires_at
+            heapq.heappush(self._heap, (expires_at, member))
+            return True
+
+    def __contains__(self, member) -> bool:
+        with self._lock:
+            expires_at = self._expires.get(member)
+            return expires_at is not None and expires_at > time.monotonic()
+
+    def __len__(self):
+        return len(self._expires)
@@ -1,8 +1,10 @@
 from functools import lru_cache
 import os
-from dotenv import load_dotenv
 
-load_dotenv(dotenv_path="config.env")
+# Deployments set the environment directly; only local runs have the file
+if os.path.exists("config.env"):
+    from dotenv import load_dotenv
+    load_dotenv(dotenv_path="config.env")
 
  
 
@@ -13,7 +15,136 @@ class Settings:
     SUPABASE_BUCKET = os.getenv("SUPABASE_BUCKET")
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_DAYS: int = 1
+    # Object storage: "supabase", or "local" to keep objects on disk under
+    # LOCAL_STORAGE_DIR. Local signed URLs point at LOCAL_STORAGE_URL, this
+    # app's /file/local route.
+    STORAGE_BACKEND: str = os.getenv("STORAGE_BACKEND", "supabase")
+    LOCAL_STORAGE_DIR: str = os.getenv("LOCAL_STORAGE_DIR", "uploads/storage")
+    LOCAL_STORAGE_URL: str = os.getenv("LOCAL_STORAGE_URL", "http://localhost:8000/file/local")
     DATABASE_URL = os.getenv("DATABASE_URL")
+    DB_POOL_MIN: int = int(os.getenv("DB_POOL_MIN", 1))
+    DB_POOL_MAX: int = int(os.getenv("DB_POOL_MAX", 10))
+    # A user's metadata index is rebuilt from storage at most once every
+    # RECONCILE_COOLDOWN seconds when listings find it missing
+    RECONCILE_COOLDOWN: int = int(os.getenv("RECONCILE_COOLDOWN", 300))
+    # Verified JWTs are cached for at most this many seconds
+    TOKEN_CACHE_SIZE: int = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+    TOKEN_CACHE_TTL: int = int(os.getenv("TOKEN_CACHE_TTL", 300))
+    # Logged out tokens are refused until they expire; logouts beyond this
+    # many unexpired tokens fail rather than forget an earlier one
+    REVOKED_TOKENS_MAX: int = int(os.getenv("REVOKED_TOKENS_MAX", 1000000))
+    # Profiles are cached per user for USER_PROFILE_CACHE_TTL seconds
+    USER_PROFILE_CACHE_SIZE: int = int(os.getenv("USER_PROFILE_CACHE_SIZE", 10000))
+    USER_PROFILE_CACHE_TTL: int = int(os.getenv("USER_PROFILE_CACHE_TTL", 300))
+    # Signed URLs live SIGNED_URL_EXPIRES_IN seconds and are served from
+    # cache until SIGNED_URL_SAFETY_MARGIN seconds before they expire
+    SIGNED_URL_EXPIRES_IN: int = int(os.getenv("SIGNED_URL_EXPIRES_IN", 300))
+    SIGNED_URL_SAFETY_MARGIN: int = int(os.getenv("SIGNED_URL_SAFETY_MARGIN", 60))
+    SIGNED_URL_CACHE_SIZE: int = int(os.getenv("SIGNED_URL_CACHE_SIZE", 10000))
+    SIGNED_URL_BATCH_MAX: int = int(os.getenv("SIGNED_URL_BATCH_MAX", 1000))
+    # Uploads are piped to storage in chunks of this many bytes
+    UPLOAD_CHUNK_SIZE: int = int(os.getenv("UPLOAD_CHUNK_SIZE", 1024 * 1024))
+    # Hard cap on a single upload, enforced while streaming (0 disables it)
+    MAX_UPLOAD_SIZE: int = int(os.getenv("MAX_UPLOAD_SIZE", 512 * 1024 * 1024))
+    # Bulk uploads send this many files to storage at once
+    BULK_UPLOAD_CONCURRENCY: int = int(os.getenv("BULK_UPLOAD_CONCURRENCY", 8))
+    BULK_UPLOAD_MAX_FILES: int = int(os.getenv("BULK_UPLOAD_MAX_FILES", 1000))
+    # Content-hash dedup (needs DATABASE_URL). DEDUP_SCOPE is "user" to
+    # only reuse a user's own uploads or "global" to reuse anyone's, which
+    # turns off /check_hashes and /upload_by_hash.
+    DEDUP_ENABLED: bool = os.getenv("DEDUP_ENABLED", "true").lower() == "true"
+    DEDUP_SCOPE: str = os.getenv("DEDUP_SCOPE", "user")
+    # Text, CSV, JSON and XML uploads of COMPRESSION_MIN_SIZE bytes or more
+    # are stored compressed with COMPRESSION_ENCODING ("gzip", or "zstd"
+    # with the zstandard package) when their first COMPRESSION_SAMPLE_SIZE
+    # bytes shrink to COMPRESSION_MAX_RATIO or less.
+    COMPRESSION_ENABLED: bool = os.getenv("COMPRESSION_ENABLED", "false").lower() == "true"
+    COMPRESSION_ENCODING: str = os.getenv("COMPRESSION_ENCODING", "gzip")
+    COMPRESSION_LEVEL: int = int(os.getenv("COMPRESSION_LEVEL", 6))
+    COMPRESSION_MIN_SIZE: int = int(os.getenv("COMPRESSION_MIN_SIZE", 1024))
+    COMPRESSION_SAMPLE_SIZE: int = int(os.getenv("COMPRESSION_SAMPLE_SIZE", 256 * 1024))
+    COMPRESSION_MAX_RATIO: float = float(os.getenv("COMPRESSION_MAX_RATIO", 0.9))
+    # Resumable upload sessions keep their chunks here until finalize. Each
+    # session is capped at MAX_UPLOAD_SIZE and a user can have at most
+    # UPLOAD_SESSION_MAX_PER_USER open at once (0 for no limit).
+    UPLOAD_SESSION_DIR: str = os.getenv("UPLOAD_SESSION_DIR", "uploads/sessions")
+    UPLOAD_SESSION_MAX_CHUNK_SIZE: int = int(os.getenv("UPLOAD_SESSION_MAX_CHUNK_SIZE", 64 * 1024 * 1024))
+    UPLOAD_SESSION_TTL_HOURS: int = int(os.getenv("UPLOAD_SESSION_TTL_HOURS", 24))
+    UPLOAD_SESSION_MAX_PER_USER: int = int(os.getenv("UPLOAD_SESSION_MAX_PER_USER", 16))
+    # How many folders a recursive walk lists at once
+    TREE_WALK_CONCURRENCY: int = int(os.getenv("TREE_WALK_CONCURRENCY", 16))
+    # Directory renames move this many objects at once and keep a
+    # resumable journal of every move here
+    RENAME_CONCURRENCY: int = int(os.getenv("RENAME_CONCURRENCY", 16))
+    RENAME_JOURNAL_DIR: str = os.getenv("RENAME_JOURNAL_DIR", "uploads/renames")
+    RENAME_JOURNAL_TTL_HOURS: int = int(os.getenv("RENAME_JOURNAL_TTL_HOURS", 168))
+    # Directory ZIP downloads fetch this many objects ahead of the writer,
+    # buffering at most DOWNLOAD_DIR_QUEUE_CHUNKS chunks per object
+    DOWNLOAD_DIR_PREFETCH: int = int(os.getenv("DOWNLOAD_DIR_PREFETCH", 4))
+    DOWNLOAD_DIR_QUEUE_CHUNKS: int = int(os.getenv("DOWNLOAD_DIR_QUEUE_CHUNKS", 4))
+    # /file/download keeps hot objects on disk, DOWNLOAD_CACHE_MAX_BYTES in
+    # all, and revalidates them with storage after DOWNLOAD_CACHE_TTL
+    # seconds. Objects over DOWNLOAD_CACHE_MAX_OBJECT_SIZE are streamed through.
+    DOWNLOAD_CACHE_DIR: str = os.getenv("DOWNLOAD_CACHE_DIR", "uploads/cache")
+    DOWNLOAD_CACHE_MAX_BYTES: int = int(os.getenv("DOWNLOAD_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+    DOWNLOAD_CACHE_MAX_OBJECT_SIZE: int = int(os.getenv("DOWNLOAD_CACHE_MAX_OBJECT_SIZE", 64 * 1024 * 1024))
+    DOWNLOAD_CACHE_TTL: int = int(os.getenv("DOWNLOAD_CACHE_TTL", 30))
+    # Text extraction (needs DATABASE_URL) runs in a process pool after
+    # upload. Text is capped at PARSER_MAX_CHARS per document and each
+    # worker at PARSER_MEMORY_LIMIT_MB of address space (0 disables it).
+    PARSER_ENABLED: bool = os.getenv("PARSER_ENABLED", "true").lower() == "true"
+    PARSER_WORKERS: int = int(os.getenv("PARSER_WORKERS", 2))
+    PARSER_MAX_FILE_SIZE: int = int(os.getenv("PARSER_MAX_FILE_SIZE", 50 * 1024 * 1024))
+    PARSER_MAX_CHARS: int = int(os.getenv("PARSER_MAX_CHARS", 1_000_000))
+    PARSER_MEMORY_LIMIT_MB: int = int(os.getenv("PARSER_MEMORY_LIMIT_MB", 1024))
+    PARSER_TASKS_PER_WORKER: int = int(os.getenv("PARSER_TASKS_PER_WORKER", 100))
+    # Auto-tagging (needs DATABASE_URL). Files are tagged TAGGER_BATCH_SIZE
+    # at a time from their name, mimetype and first TAGGER_MAX_CHARS of
+    # extracted text; new uploads are collected for TAGGER_FLUSH_SECONDS.
+    TAGGER_ENABLED: bool = os.getenv("TAGGER_ENABLED", "true").lower() == "true"
+    TAGGER_BATCH_SIZE: int = int(os.getenv("TAGGER_BATCH_SIZE", 1000))
+    TAGGER_MAX_CHARS: int = int(os.getenv("TAGGER_MAX_CHARS", 20000))
+    TAGGER_MIN_SCORE: float = float(os.getenv("TAGGER_MIN_SCORE", 2.0))
+    TAGGER_MAX_TAGS: int = int(os.getenv("TAGGER_MAX_TAGS", 5))
+    TAGGER_FLUSH_SECONDS: float = float(os.getenv("TAGGER_FLUSH_SECONDS", 5.0))
+    # Background jobs (recursive delete/rename). JOB_BACKEND is "asyncio"
+    # to run them on the app's event loop or "process" for a process pool.
+    # A user can have at most JOB_MAX_ACTIVE_PER_USER jobs queued or running
+    # (0 for no limit).
+    JOB_BACKEND: str = os.getenv("JOB_BACKEND", "asyncio")
+    JOB_WORKERS: int = int(os.getenv("JOB_WORKERS", 4))
+    JOB_MAX_ACTIVE_PER_USER: int = int(os.getenv("JOB_MAX_ACTIVE_PER_USER", 16))
+    JOB_DIR: str = os.getenv("JOB_DIR", "uploads/jobs")
+    JOB_TTL_HOURS: int = int(os.getenv("JOB_TTL_HOURS", 168))
+    # A process that misses JOB_LEASE_SECONDS of heartbeats loses its jobs
+    # to the other processes sharing JOB_DIR
+    JOB_LEASE_SECONDS: int = int(os.getenv("JOB_LEASE_SECONDS", 60))
+    # Per-user admission control (0 disables each limit): a bucket of
+    # RATE_LIMIT_BURST requests refilled at RATE_LIMIT_PER_SECOND, at most
+    # RATE_LIMIT_MAX_HEAVY uploads/downloads at once, and upload bodies read
+    # at UPLOAD_BANDWIDTH_PER_USER bytes/s. RATE_LIMIT_BACKEND is "memory",
+    # or "postgres" to share the counters between workers.
+    RATE_LIMIT_PER_SECOND: float = float(os.getenv("RATE_LIMIT_PER_SECOND", 50))
+    RATE_LIMIT_BURST: int = int(os.getenv("RATE_LIMIT_BURST", 100))
+    RATE_LIMIT_MAX_HEAVY: int = int(os.getenv("RATE_LIMIT_MAX_HEAVY", 8))
+    UPLOAD_BANDWIDTH_PER_USER: int = int(os.getenv("UPLOAD_BANDWIDTH_PER_USER", 0))
+    RATE_LIMIT_BACKEND: str = os.getenv("RATE_LIMIT_BACKEND", "memory")
+    # Prometheus metrics on /metrics. Requests slower than
+    # PROFILE_SLOW_REQUEST_MS get a sampled profile written to PROFILE_DIR
+    # (0 disables the sampler, which wakes every PROFILE_INTERVAL_MS).
+    METRICS_ENABLED: bool = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+    PROFILE_SLOW_REQUEST_MS: int = int(os.getenv("PROFILE_SLOW_REQUEST_MS", 0))
+    PROFILE_INTERVAL_MS: int = int(os.getenv("PROFILE_INTERVAL_MS", 10))
+    PROFILE_DIR: str = os.getenv("PROFILE_DIR", "uploads/profiles")
+    PROFILE_MAX_FILES: int = int(os.getenv("PROFILE_MAX_FILES", 100))
+    # Shared HTTP client used for every storage call
+    HTTP_MAX_CONNECTIONS: int = int(os.getenv("HTTP_MAX_CONNECTIONS", 100))
+    HTTP_MAX_KEEPALIVE_CONNECTIONS: int = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", 20))
+    HTTP_KEEPALIVE_EXPIRY: float = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 30.0))
+    HTTP_TIMEOUT: float = float(os.getenv("HTTP_TIMEOUT", 60.0))
+    HTTP_CONNECT_TIMEOUT: float = float(os.getenv("HTTP_CONNECT_TIMEOUT", 10.0))
+    HTTP_POOL_TIMEOUT: float = float(os.getenv("HTTP_POOL_TIMEOUT", 10.0))
+    HTTP2: bool = os.getenv("HTTP2", "true").lower() == "true"
 
 @lru_cache()
 def get_settings():
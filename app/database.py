@@ -0,0 +1,63 @@
+import threading
+from contextlib import contextmanager
+
+from psycopg2.pool import ThreadedConnectionPool
+from starlette.concurrency import run_in_threadpool
+
+from .config import get_settings
+
+settings = get_settings()
+
+_pool = None
+_pool_lock = threading.Lock()
+# ThreadedConnectionPool raises instead of waiting when it runs dry, so
+# callers queue here for a free connection.
+_pool_slots = threading.BoundedSemaphore(settings.DB_POOL_MAX)
+
+
+def database_enabled() -> bool:
+    return bool(settings.DATABASE_URL)
+
+def get_pool() -> ThreadedConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadedConnectionPool(settings.DB_POOL_MIN, settings.DB_POOL_MAX, settings.DATABASE_URL)
+    return _pool
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+@contextmanager
+def get_connection():
+    """
+    Borrow a pooled connection for one transaction: committed on success,
+    rolled back on error.
+    """
+    with _pool_slots:
+        pool = get_pool()
+        conn = pool.getconn()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            pool.putconn(conn)
+
+async def run_db(fn, *args, **kwargs):
+    # psycopg2 is blocking; keep it off the event loop
+    return await run_in_threadpool(fn, *args, **kwargs)
+
+def init_db():
+    from .models import SCHEMA
+
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(SCHEMA)
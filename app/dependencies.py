@@ -1,16 +1,55 @@
+import hashlib
+import logging
+import time
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 import jwt
 from jwt import PyJWTError
+from .cache import ExpiringSet, TTLCache
 from .config import get_settings
+from .metrics import Callback
 from .schemas import TokenData
-from supabase import create_client
  
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
 settings = get_settings()
-supabase = create_client(settings.SUPABASE_URL, settings.SUPABASE_KEY)
+logger = logging.getLogger(__name__)
+
+# Verified tokens, keyed by sha256 of the raw token, so repeat requests from
+# the same client skip jwt.decode. Entries never outlive the token's `exp`.
+token_cache = TTLCache(maxsize=settings.TOKEN_CACHE_SIZE, ttl=settings.TOKEN_CACHE_TTL)
+# Tokens that have been logged out, kept until they would have expired anyway
+revoked_tokens = ExpiringSet(maxsize=settings.REVOKED_TOKENS_MAX)
+
+Callback(
+    "filenest_token_cache_hits_total", "Requests whose token was found already verified.",
+    lambda: {(): token_cache.hits}, kind="counter",
+)
+Callback(
+    "filenest_token_cache_misses_total", "Requests whose token had to be decoded.",
+    lambda: {(): token_cache.misses}, kind="counter",
+)
+Callback("filenest_token_cache_entries", "Verified tokens in the cache.", lambda: {(): len(token_cache)})
+Callback("filenest_revoked_tokens", "Logged out tokens on the revocation list.", lambda: {(): len(revoked_tokens)})
+
+def _token_key(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def revoke_token(token: str):
+    key = _token_key(token)
+    token_cache.pop(key)
+    try:
+        payload = jwt.decode(token, settings.JWT_SECRET, algorithms=[settings.ALGORITHM])
+    except PyJWTError:
+        return
+    if not revoked_tokens.add(key, payload.get("exp", 0) - time.time()):
+        logger.error("Revoked token list is full (%d), refusing to log a token out", revoked_tokens.maxsize)
+        raise Exception("Logout is unavailable right now, try again later")
 
 def get_current_user(token: str = Depends(oauth2_scheme)):
+    return verify_token(token)
+
+# Also called by the admission middleware, which runs before routing
+def verify_token(token: str) -> TokenData:
    
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -18,6 +57,13 @@ def get_current_user(token: str = Depends(oauth2_scheme)):
         headers={"WWW-Authenticate": "Bearer"},
     )
     
+    key = _token_key(token)
+    if key in revoked_tokens:
+        raise credentials_exception
+    cached = token_cache.get(key)
+    if cached is not None:
+        return cached
+
     try:
          
         payload = jwt.decode(
@@ -31,7 +77,10 @@ def get_current_user(token: str = Depends(oauth2_scheme)):
         session_id: str = payload.get("session_id")
         if not user_id or not session_id:
             raise credentials_exception
-        return TokenData(user_id=user_id, session_id=session_id)
+        # Tokens issued before the email claim was added don't have it
+        user = TokenData(user_id=user_id, session_id=session_id, email=payload.get("email"))
+        token_cache.set(key, user, ttl=payload.get("exp", 0) - time.time())
+        return user
     except PyJWTError:
         raise credentials_exception
     
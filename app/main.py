@@ -1,4 +1,5 @@
 import os
+from contextlib import asynccontextmanager
 from fastapi import Depends, FastAPI, Request
 from fastapi.openapi.utils import get_openapi
 from fastapi.responses import JSONResponse
@@ -8,13 +9,38 @@ from .routers import file_routes
 from .routers import auth_router
 from .dependencies import get_current_user
 from .schemas import TokenData
+from .database import close_pool, database_enabled, init_db, run_db
+from .admission import AdmissionMiddleware
+from .metrics import MetricsMiddleware, render_metrics
+from .profiling import start_profiler, stop_profiler
+from .services.clients import close_http_client, open_http_client
+from .services.jobs import start_job_runner, stop_job_runner
+from .services.object_cache import close_object_cache
+from .services.parser import close_parser_pool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.exceptions import RequestValidationError
 from fastapi.responses import PlainTextResponse
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from fastapi import status
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled HTTP client for the whole process, reused by every storage call
+    await open_http_client()
+    if database_enabled():
+        await run_db(init_db)
+    await start_job_runner()
+    start_profiler()
+    yield
+    stop_profiler()
+    await stop_job_runner()
+    close_parser_pool()
+    close_object_cache()
+    await close_http_client()
+    if database_enabled():
+        await run_db(close_pool)
+
+app = FastAPI(lifespan=lifespan)
 
 
 # Custom OpenAPI configuration
@@ -57,6 +83,8 @@ app.openapi = custom_openapi
 
 app.include_router(file_routes.router, prefix="/file", tags=["File"])
 app.include_router(auth_router.router, prefix="/auth", tags=["Auth"])
+# Inside CORS, so browsers can read the Retry-After on a 429
+app.add_middleware(AdmissionMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # instead of "*"
@@ -65,10 +93,16 @@ app.add_middleware(
     allow_headers=["*"],
     expose_headers=["*"],  # <-- important for Angular
 )
+# Outermost, so the timings include CORS and error handling
+app.add_middleware(MetricsMiddleware)
 @app.get("/")
 def read_root():
     return {"message": "Welcome to FileNest - Smart File Organizers"}
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
 
 if not os.path.exists("uploads"):
     os.makedirs("uploads")
@@ -104,7 +138,7 @@ async def custom_http_exception_handler(request: Request, exc: StarletteHTTPExce
     return JSONResponse(
         status_code=exc.status_code,
         content={"detail": str(exc.detail)},
-        
+        headers=getattr(exc, "headers", None),
     )
 
 @app.exception_handler(Exception)
@@ -0,0 +1,269 @@
+"""
+Request and upstream-call metrics in the Prometheus text format.
+
+MetricsMiddleware times every request by route template, counts requests
+in flight and records request and response sizes. Outbound calls to
+Supabase storage, auth and tables, all made over the shared HTTP client,
+are timed separately, and each request also records how long it spent
+waiting on them, so our own overhead is the difference. Caches that
+count their hits report them through Callback metrics. Metrics are per
+process and served by GET /metrics.
+"""
+import threading
+import time
+from contextvars import ContextVar
+
+import httpx
+
+from .config import get_settings
+from .profiling import profile_if_slow
+
+settings = get_settings()
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = tuple(256 * 4 ** i for i in range(12))  # 256 B .. 1 GiB
+
+_registry = []
+# [seconds, calls] spent on upstream calls by the current request
+_upstream = ContextVar("upstream", default=None)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        # Sync routes and dependencies record from the threadpool
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def _samples(self):
+        for key, value in self._values.items():
+            yield self.name, _format_labels(self.labels, key), value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts, made cumulative when rendered
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def _samples(self):
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(float(bound))}"'
+                yield f"{self.name}_bucket", _format_labels(self.labels, key, le), cumulative
+            labels = _format_labels(self.labels, key)
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, count
+
+
+class Callback(_Metric):
+    """
+    Counter or gauge read at scrape time from numbers kept elsewhere, like
+    a cache's hit counts. `read()` returns {label values: value}.
+    """
+
+    def __init__(self, name: str, documentation: str, read, kind: str = "gauge", labels: tuple = ()):
+        super().__init__(name, documentation, labels)
+        self.kind = kind
+        self._read = read
+
+    def _samples(self):
+        for key, value in self._read().items():
+            yield self.name, _format_labels(self.labels, key), value
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+REQUEST_DURATION = Histogram(
+    "filenest_http_request_duration_seconds", "Time to handle a request, by route template.",
+    ("method", "route", "status"),
+)
+REQUEST_UPSTREAM = Histogram(
+    "filenest_http_request_upstream_seconds", "Time a request spent waiting on upstream calls.",
+    ("method", "route"),
+)
+REQUEST_OVERHEAD = Histogram(
+    "filenest_http_request_overhead_seconds", "Request time not spent waiting on upstream calls.",
+    ("method", "route"),
+)
+REQUEST_SIZE = Histogram(
+    "filenest_http_request_size_bytes", "Request body size.", ("method", "route"), SIZE_BUCKETS,
+)
+RESPONSE_SIZE = Histogram(
+    "filenest_http_response_size_bytes", "Response body size.", ("method", "route"), SIZE_BUCKETS,
+)
+REQUESTS_IN_FLIGHT = Gauge("filenest_http_requests_in_flight", "Requests being handled.")
+UPSTREAM_DURATION = Histogram(
+    "filenest_upstream_request_duration_seconds",
+    "Time to response headers for calls to Supabase storage, auth and tables.",
+    ("service", "operation", "status"),
+)
+
+
+def _record_upstream(service: str, operation: str, status: str, elapsed: float):
+    UPSTREAM_DURATION.observe(elapsed, service=service, operation=operation, status=status)
+    spent = _upstream.get()
+    if spent is not None:
+        spent[0] += elapsed
+        spent[1] += 1
+
+def _operation(method: str, path: str):
+    # /storage/v1/object/sign/<bucket>/<key> -> ("storage", "sign"),
+    # /auth/v1/user -> ("auth", "get_user")
+    parts = path.split("/")
+    if len(parts) < 4:
+        return "other", "other"
+    service = parts[1]
+    if service != "storage" or parts[3] != "object":
+        return service, f"{method.lower()}_{parts[3]}"
+    action = parts[4] if len(parts) > 4 else ""
+    if action in ("list", "sign", "move", "copy", "public", "info"):
+        return service, action
+    return service, {"GET": "download", "HEAD": "info", "DELETE": "delete"}.get(method, "upload")
+
+async def _on_request(request: httpx.Request):
+    request.extensions["metrics_start"] = time.perf_counter()
+
+async def _on_response(response: httpx.Response):
+    start = response.request.extensions.get("metrics_start")
+    if start is None:
+        return
+    service, operation = _operation(response.request.method, response.request.url.path)
+    _record_upstream(service, operation, f"{response.status_code // 100}xx", time.perf_counter() - start)
+
+# For httpx event_hooks; response hooks fire once headers are in, before
+# streamed bodies are read
+HTTP_EVENT_HOOKS = {"request": [_on_request], "response": [_on_response]}
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI, so streamed responses and file sends pass straight through.
+    Adds a Server-Timing header splitting the time into app and upstream.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        spent = [0.0, 0]
+        token = _upstream.set(spent)
+        sizes = {"request": 0, "body": 0, "length": None, "status": 500}
+
+        async def counting_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                sizes["request"] += len(message.get("body", b""))
+            return message
+
+        async def timing_send(message):
+            if message["type"] == "http.response.start":
+                sizes["status"] = message["status"]
+                headers = list(message.get("headers", []))
+                for name, value in headers:
+                    if name == b"content-length":
+                        # Files sent with pathsend never pass through as body
+                        sizes["length"] = int(value)
+                app_ms = (time.perf_counter() - start - spent[0]) * 1000
+                headers.append((b"server-timing", f"app;dur={app_ms:.1f}, upstream;dur={spent[0] * 1000:.1f}".encode()))
+                message = {**message, "headers": headers}
+            elif message["type"] == "http.response.body":
+                sizes["body"] += len(message.get("body", b""))
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, counting_receive, timing_send)
+        finally:
+            end = time.perf_counter()
+            REQUESTS_IN_FLIGHT.dec()
+            _upstream.reset(token)
+            route = scope.get("route")
+            route = getattr(route, "path", "unmatched")
+            method = scope["method"]
+            elapsed = end - start
+            REQUEST_DURATION.observe(elapsed, method=method, route=route, status=sizes["status"])
+            REQUEST_UPSTREAM.observe(spent[0], method=method, route=route)
+            # Concurrent upstream calls can add up to more than the request took
+            REQUEST_OVERHEAD.observe(max(0.0, elapsed - spent[0]), method=method, route=route)
+            REQUEST_SIZE.observe(sizes["request"], method=method, route=route)
+            response_size = sizes["length"] if sizes["length"] is not None else sizes["body"]
+            RESPONSE_SIZE.observe(response_size, method=method, route=route)
+            await profile_if_slow(method, route, start, end)
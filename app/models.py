@@ -0,0 +1,141 @@
+# Table definitions, applied idempotently by database.init_db() at startup.
+
+# One row per object or folder in a user's storage tree. `parent` is the
+# folder path relative to the user's root ("" for the root itself), so a
+# directory listing is a single index range scan on (user_id, parent).
+FILE_INDEX = """
+CREATE TABLE IF NOT EXISTS file_index (
+    user_id     TEXT        NOT NULL,
+    parent      TEXT        NOT NULL,
+    name        TEXT        NOT NULL,
+    is_dir      BOOLEAN     NOT NULL DEFAULT FALSE,
+    size        BIGINT,
+    mimetype    TEXT,
+    etag        TEXT,
+    updated_at  TIMESTAMPTZ,
+    PRIMARY KEY (user_id, parent, name)
+);
+
+-- Listings ordered by modification time
+CREATE INDEX IF NOT EXISTS file_index_updated
+    ON file_index (user_id, parent, is_dir, updated_at, name);
+
+-- Recursive delete/rename of a folder match `parent LIKE 'a/b/%'`
+CREATE INDEX IF NOT EXISTS file_index_parent_prefix
+    ON file_index (user_id, parent text_pattern_ops);
+"""
+
+# Per-user index state. Listings only trust the index for users with a
+# reconciled_at, set once it has been rebuilt from storage. `generation`
+# goes up with every change to the user's rows, so a rebuild can tell
+# whether anything changed while it walked storage.
+FILE_INDEX_STATE = """
+CREATE TABLE IF NOT EXISTS file_index_state (
+    user_id        TEXT        PRIMARY KEY,
+    reconciled_at  TIMESTAMPTZ,
+    generation     BIGINT      NOT NULL DEFAULT 0
+);
+"""
+
+# Where a given piece of content already lives in storage, so uploading the
+# same bytes again becomes a server-side copy. `scope` is the owner's
+# user_id, or '*' when DEDUP_SCOPE is global.
+CONTENT_INDEX = """
+CREATE TABLE IF NOT EXISTS content_index (
+    scope       TEXT        NOT NULL,
+    sha256      TEXT        NOT NULL,
+    size        BIGINT      NOT NULL,
+    object_key  TEXT        NOT NULL,
+    mimetype    TEXT,
+    updated_at  TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (scope, sha256, size)
+);
+
+-- Entries are dropped when their object is deleted or moved
+CREATE INDEX IF NOT EXISTS content_index_object_key ON content_index (object_key);
+"""
+
+# Text extracted from uploaded documents by services/parser.py. Keyed like
+# file_index so renames and deletes carry over through the foreign key.
+FILE_TEXT = """
+CREATE TABLE IF NOT EXISTS file_text (
+    user_id       TEXT        NOT NULL,
+    parent        TEXT        NOT NULL,
+    name          TEXT        NOT NULL,
+    kind          TEXT        NOT NULL,
+    content       TEXT,
+    truncated     BOOLEAN     NOT NULL DEFAULT FALSE,
+    metadata      JSONB,
+    error         TEXT,
+    extracted_at  TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (user_id, parent, name),
+    FOREIGN KEY (user_id, parent, name) REFERENCES file_index (user_id, parent, name)
+        ON UPDATE CASCADE ON DELETE CASCADE
+);
+"""
+
+# Category and tags assigned by services/tagger.py, keyed like file_text
+FILE_TAGS = """
+CREATE TABLE IF NOT EXISTS file_tags (
+    user_id    TEXT        NOT NULL,
+    parent     TEXT        NOT NULL,
+    name       TEXT        NOT NULL,
+    category   TEXT        NOT NULL,
+    tags       TEXT[]      NOT NULL DEFAULT '{}',
+    scores     JSONB,
+    tagged_at  TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (user_id, parent, name),
+    FOREIGN KEY (user_id, parent, name) REFERENCES file_index (user_id, parent, name)
+        ON UPDATE CASCADE ON DELETE CASCADE
+);
+
+-- "Files tagged X" lookups
+CREATE INDEX IF NOT EXISTS file_tags_tags ON file_tags USING GIN (tags);
+"""
+
+# Full-text search. Generated tsvector columns follow every write to the
+# rows they're computed from, so the search index is maintained by the same
+# upload/rename/delete hooks as the rest of the index. Names and paths use
+# the 'simple' config (no stemming, punctuation split into words); content
+# is stemmed and capped well below the 1MB tsvector limit.
+SEARCH_INDEX = """
+ALTER TABLE file_index ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+    setweight(to_tsvector('simple', regexp_replace(name, '[^[:alnum:]]+', ' ', 'g')), 'A') ||
+    setweight(to_tsvector('simple', regexp_replace(parent, '[^[:alnum:]]+', ' ', 'g')), 'B')
+) STORED;
+
+CREATE INDEX IF NOT EXISTS file_index_search ON file_index USING GIN (search_vector);
+
+ALTER TABLE file_text ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+    to_tsvector('english', left(coalesce(content, ''), 200000))
+) STORED;
+
+CREATE INDEX IF NOT EXISTS file_text_search ON file_text USING GIN (search_vector);
+"""
+
+# Uploads stored compressed (services/compression.py). `size` stays the
+# original size; `stored_size` is what the object takes up in storage.
+COMPRESSION = """
+ALTER TABLE file_index ADD COLUMN IF NOT EXISTS stored_size BIGINT;
+ALTER TABLE file_index ADD COLUMN IF NOT EXISTS content_encoding TEXT;
+"""
+
+# Admission control counters when RATE_LIMIT_BACKEND is "postgres".
+# Unlogged, since losing them in a crash only resets everyone's limits.
+RATE_LIMITS = """
+CREATE UNLOGGED TABLE IF NOT EXISTS rate_limit_buckets (
+    key         TEXT             PRIMARY KEY,
+    tokens      DOUBLE PRECISION NOT NULL,
+    updated_at  DOUBLE PRECISION NOT NULL
+);
+
+CREATE UNLOGGED TABLE IF NOT EXISTS rate_limit_slots (
+    slot_id     TEXT             PRIMARY KEY,
+    key         TEXT             NOT NULL,
+    expires_at  DOUBLE PRECISION NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS rate_limit_slots_key ON rate_limit_slots (key);
+"""
+
+SCHEMA = FILE_INDEX + FILE_INDEX_STATE + CONTENT_INDEX + FILE_TEXT + FILE_TAGS + SEARCH_INDEX + RATE_LIMITS + COMPRESSION
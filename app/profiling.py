@@ -0,0 +1,100 @@
+"""
+Sampling profiler for slow requests.
+
+With PROFILE_SLOW_REQUEST_MS set, a background thread samples the stack of
+every busy thread each PROFILE_INTERVAL_MS and keeps the last few seconds of
+samples. When a request takes longer than the threshold, the samples taken
+while it ran are written to PROFILE_DIR as collapsed stacks ("a;b;c 12"),
+which flamegraph.pl and speedscope read. Requests share the event loop, so
+a profile also shows whatever else was running at the time.
+"""
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+import anyio
+
+from .config import get_settings
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+# Samples are kept for this long, so longer requests get a truncated profile
+PROFILE_WINDOW = 30
+# Threads whose innermost frame is in one of these are waiting, not working
+_IDLE_FILES = ("selectors.py", "threading.py", "queue.py")
+
+_sampler = None
+
+
+class _Sampler(threading.Thread):
+
+    def __init__(self, interval: float):
+        super().__init__(name="profiler", daemon=True)
+        self.interval = interval
+        self.samples = deque(maxlen=int(PROFILE_WINDOW / interval))
+        self._stop_event = threading.Event()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            now = time.perf_counter()
+            for ident, frame in sys._current_frames().items():
+                if ident != own and not frame.f_code.co_filename.endswith(_IDLE_FILES):
+                    self.samples.append((now, _collapse(frame)))
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def _collapse(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        path = code.co_filename.rsplit(os.sep, 2)
+        names.append(f"{getattr(code, 'co_qualname', code.co_name)} ({'/'.join(path[-2:])}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+def start_profiler():
+    global _sampler
+    if settings.PROFILE_SLOW_REQUEST_MS > 0 and _sampler is None:
+        os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+        _sampler = _Sampler(settings.PROFILE_INTERVAL_MS / 1000)
+        _sampler.start()
+
+def stop_profiler():
+    global _sampler
+    if _sampler is not None:
+        _sampler.stop()
+        _sampler = None
+
+
+def _write_profile(path: str, stacks: Counter):
+    with open(path, "w") as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+    # Oldest profiles go first once there are too many
+    names = sorted(os.listdir(settings.PROFILE_DIR))
+    for name in names[:max(0, len(names) - settings.PROFILE_MAX_FILES)]:
+        try:
+            os.remove(os.path.join(settings.PROFILE_DIR, name))
+        except FileNotFoundError:
+            pass
+
+async def profile_if_slow(method: str, route: str, start: float, end: float):
+    if _sampler is None or (end - start) * 1000 < settings.PROFILE_SLOW_REQUEST_MS:
+        return
+    stacks = Counter(stack for at, stack in list(_sampler.samples) if start <= at <= end)
+    if not stacks:
+        return
+    slug = re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "root"
+    name = f"{time.strftime('%Y%m%dT%H%M%S')}-{int(time.time() * 1000) % 1000:03d}-{method}-{slug}-{int((end - start) * 1000)}ms.folded"
+    path = os.path.join(settings.PROFILE_DIR, name)
+    await anyio.to_thread.run_sync(_write_profile, path, stacks)
+    logger.warning("Slow request %s %s took %.0f ms, profile in %s", method, route, (end - start) * 1000, path)
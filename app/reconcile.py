@@ -0,0 +1,35 @@
+"""
+Rebuild the metadata index from storage.
+
+    python -m app.reconcile            # every user in the bucket
+    python -m app.reconcile USER_ID..  # just these users
+"""
+import asyncio
+import sys
+
+from .database import close_pool, database_enabled, init_db, run_db
+from .services.clients import close_http_client
+from .services.cloud import list_indexed_users, reconcile_user_index
+
+
+async def reconcile(user_ids: list):
+    await run_db(init_db)
+    try:
+        if not user_ids:
+            user_ids = await list_indexed_users()
+        for user_id in user_ids:
+            try:
+                count = await reconcile_user_index(user_id)
+            except Exception as e:
+                print(f"{user_id}: failed, {e}", file=sys.stderr)
+                continue
+            print(f"{user_id}: {count} entries")
+    finally:
+        await close_http_client()
+        await run_db(close_pool)
+
+
+if __name__ == "__main__":
+    if not database_enabled():
+        sys.exit("DATABASE_URL is not set")
+    asyncio.run(reconcile(sys.argv[1:]))
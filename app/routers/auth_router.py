@@ -3,7 +3,7 @@ from ..schemas import (
     LoginRequest, UserCreate, Token, UserProfile,
     UpdatePasswordRequest, ForgotPasswordRequest, ResetPasswordRequest
 )
-from ..dependencies import get_current_user, oauth2_scheme
+from ..dependencies import get_current_user, oauth2_scheme, revoke_token
 from ..services.auth_service import (
     signup_user, login_user, logout_user,
     get_user_profile, update_user_profile,
@@ -19,7 +19,7 @@ router = APIRouter()
 @router.post("/signup", response_model=dict)
 async def signup(user: UserCreate):
     try:
-        user_id = signup_user(user)
+        user_id = await signup_user(user)
         return {"message": "User created successfully", "user_id": user_id}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -28,15 +28,16 @@ async def signup(user: UserCreate):
 @router.post("/login", response_model=Token)
 async def login(request: LoginRequest):
     try:
-        return login_user(request.email, request.password)
+        return await login_user(request.email, request.password)
     except Exception as e:
         raise HTTPException(status_code=401, detail=f"Login failed: {str(e)}")
 
 # ✅ Logout
 @router.post("/logout")
-async def logout(token: TokenData = Depends(get_current_user)):
+async def logout(token: TokenData = Depends(get_current_user), raw_token: str = Depends(oauth2_scheme)):
     try:
-        logout_user(token)
+        revoke_token(raw_token)
+        await logout_user(token)
         return {"message": "Logged out successfully"}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -45,7 +46,7 @@ async def logout(token: TokenData = Depends(get_current_user)):
 @router.get("/get_profile", response_model=UserProfile)
 async def get_profile(user: TokenData = Depends(get_current_user)):
     try:
-        data=get_user_profile(user)
+        data=await get_user_profile(user)
  
         return UserProfile(**data)
         
@@ -56,7 +57,7 @@ async def get_profile(user: TokenData = Depends(get_current_user)):
 @router.put("/update_profile")
 async def update_profile(data: UserProfile, user: TokenData = Depends(get_current_user)):
     try:
-        return update_user_profile(user, data)
+        return await update_user_profile(user, data)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -64,7 +65,7 @@ async def update_profile(data: UserProfile, user: TokenData = Depends(get_curren
 @router.post("/change_password")
 async def change_password(data: UpdatePasswordRequest, user: TokenData = Depends(get_current_user)):
     try:
-        return change_user_password(user, data)
+        return await change_user_password(user, data)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -72,7 +73,7 @@ async def change_password(data: UpdatePasswordRequest, user: TokenData = Depends
 @router.post("/forgot_password")
 async def forgot_password(data: ForgotPasswordRequest):
     try:
-        return send_reset_email(data)
+        return await send_reset_email(data)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -80,14 +81,15 @@ async def forgot_password(data: ForgotPasswordRequest):
 @router.post("/reset_password")
 async def reset_password(data: ResetPasswordRequest):
     try:
-        return reset_user_password(data)
+        return await reset_user_password(data)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @router.post("/logout")
-async def logout(token: TokenData = Depends(get_current_user)):
+async def logout(token: TokenData = Depends(get_current_user), raw_token: str = Depends(oauth2_scheme)):
     try:
-        logout_user(token)
+        revoke_token(raw_token)
+        await logout_user(token)
         return {"message": "Logged out successfully"}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
\ No newline at end of file
@@ -1,10 +1,27 @@
  
-from fastapi import APIRouter, Body, Depends, Form, Query, UploadFile, File,status,HTTPException
+from datetime import datetime
+from typing import Literal, Optional
+from fastapi import APIRouter, Body, Depends, Form, Query, Request, UploadFile, File,status,HTTPException
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+import json
 import shutil
 import os
 
-from ..services.cloud import create_directory_supabase,  delete_directory_supabase, delete_file_supabase, get_signed_url_supabase, list_user_files, rename_directory_supabase, rename_file_supabase, upload_to_supabase
-from ..dependencies import oauth2_scheme
+from ..services.cloud import check_hashes, create_directory_supabase,  delete_file_supabase, get_directory_tree, get_signed_url_supabase, get_signed_urls_supabase, iter_user_files, list_user_files, reconcile_user_index, rename_file_supabase, search_user_files, signed_url_encodings, upload_by_hash, upload_many_to_supabase, upload_to_supabase
+from ..services import compression, metadata_index
+from ..services.archive import content_disposition, download_directory_zip
+from ..services.object_cache import download_file
+from ..services.storage import get_storage
+from ..services.dir_rename import check_resumable, get_rename_status
+from ..services.parser import can_extract, extract_object
+from ..services.text_index import get_text
+from ..services.tag_index import list_tags
+from ..services.jobs import get_job, list_jobs, submit_job
+from ..services.upload_sessions import abort_upload_session, create_upload_session, finalize_upload_session, get_upload_session_status, put_upload_chunk
+from ..database import database_enabled, run_db
+from ..dependencies import get_current_user
+from ..schemas import TokenData, UploadSessionCreate
  
 
 router = APIRouter()
@@ -12,33 +29,169 @@ router = APIRouter()
 @router.post("/upload")
 async def upload_file( file: UploadFile = File(...),
     path: str = Form(...), 
-    token: str = Depends(oauth2_scheme)):
+    user: TokenData = Depends(get_current_user)):
     try:
-        content = await file.read()
-        result = upload_to_supabase(file, content,path,token)
+        result = await upload_to_supabase(file, path, user)
         return {"status": "success", "result": result}
+    except HTTPException:
+        raise
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+@router.post("/upload_bulk")
+async def upload_files(
+    files: list[UploadFile] = File(...),
+    path: str = Form(""),
+    relative_paths: Optional[list[str]] = Form(None),
+    user: TokenData = Depends(get_current_user)
+):
+    try:
+        result = await upload_many_to_supabase(files, path, user, relative_paths)
+        return {"status": "success", "result": result}
+    except HTTPException:
+        raise
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
+@router.post("/check_hashes")
+async def check_content_hashes(
+    hashes: list[str] = Body(..., embed=True),
+    user: TokenData = Depends(get_current_user)
+):
+    # Preflight: known hashes can be created with /upload_by_hash, no bytes sent
+    result = await check_hashes(hashes, user)
+    return {"status": "success", "result": result}
+
+@router.post("/upload_by_hash")
+async def upload_file_by_hash(
+    sha256: str = Form(...),
+    size: int = Form(...),
+    filename: str = Form(...),
+    path: str = Form(""),
+    user: TokenData = Depends(get_current_user)
+):
+    try:
+        result = await upload_by_hash(sha256, size, path, filename, user)
+        return {"status": "success", "result": result}
+    except HTTPException:
+        raise
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+@router.post("/upload_sessions")
+async def start_upload_session(
+    data: UploadSessionCreate,
+    user: TokenData = Depends(get_current_user)
+):
+    result = await run_in_threadpool(create_upload_session, data, user)
+    return {"status": "success", "result": result}
+
+@router.put("/upload_sessions/{session_id}/chunks/{index}")
+async def upload_chunk(
+    session_id: str,
+    index: int,
+    request: Request,
+    user: TokenData = Depends(get_current_user)
+):
+    result = await put_upload_chunk(session_id, index, request, user)
+    return {"status": "success", "result": result}
+
+@router.get("/upload_sessions/{session_id}")
+async def upload_session_status(
+    session_id: str,
+    user: TokenData = Depends(get_current_user)
+):
+    result = get_upload_session_status(session_id, user)
+    return {"status": "success", "result": result}
+
+@router.post("/upload_sessions/{session_id}/finalize")
+async def finalize_upload(
+    session_id: str,
+    user: TokenData = Depends(get_current_user)
+):
+    try:
+        result = await finalize_upload_session(session_id, user)
+        return {"status": "success", "result": result}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            detail=f"Failed to finalize upload: {str(e)}"
+        )
+
+@router.delete("/upload_sessions/{session_id}")
+async def abort_upload(
+    session_id: str,
+    user: TokenData = Depends(get_current_user)
+):
+    result = abort_upload_session(session_id, user)
+    return {"status": "success", "result": result}
+
 @router.get("/files")
 async def get_user_files(
     path: str = Query(..., description="Path inside your storage directory"),
-    token: str = Depends(oauth2_scheme)
+    limit: int = Query(100, ge=1, le=1000, description="Maximum entries per page"),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    sort: Literal["name", "updated_at"] = Query("name"),
+    order: Literal["asc", "desc"] = Query("asc"),
+    stream: bool = Query(False, description="Stream every entry as NDJSON instead of one page"),
+    user: TokenData = Depends(get_current_user)
 ):
+    if stream:
+        return StreamingResponse(_ndjson(iter_user_files(path, user, sort, order)), media_type="application/x-ndjson")
     try:
-        files = list_user_files(path, token)
+        files = await list_user_files(path, user, limit, cursor, sort, order)
         return {"status": "success", "result": files}
+    except HTTPException:
+        raise
     except Exception as e:
         return {"status": "error", "message": str(e)}
+
+async def _ndjson(entries):
+    try:
+        async for entry in entries:
+            yield json.dumps(entry) + "\n"
+    except Exception as e:
+        # Headers are already sent, so report the failure in-band
+        yield json.dumps({"type": "error", "message": str(e)}) + "\n"
     
+@router.get("/search")
+async def search_files(
+    q: str = Query(..., min_length=1, description="Words to find in file names, paths and content"),
+    type: Optional[str] = Query(None, description="Category, mimetype or extension"),
+    modified_after: Optional[datetime] = Query(None),
+    modified_before: Optional[datetime] = Query(None),
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = Query(None),
+    user: TokenData = Depends(get_current_user)
+):
+    result = await search_user_files(q, user, type, modified_after, modified_before, limit, cursor)
+    return {"status": "success", "result": result}
+
+@router.get("/tree")
+async def get_tree(
+    path: str = Query("", description="Folder to start from, defaults to your root"),
+    depth: Optional[int] = Query(None, ge=0, description="Folder levels to descend, unlimited if omitted"),
+    user: TokenData = Depends(get_current_user)
+):
+    try:
+        tree = await get_directory_tree(path, user, depth)
+        return {"status": "success", "result": tree}
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to walk directory tree: {str(e)}"
+        )
+
 @router.post("/create_directory")
 async def create_directory(
     path: str = Form(...),
     dir_name: str = Form(...),
-    token: str = Depends(oauth2_scheme)
+    user: TokenData = Depends(get_current_user)
 ):
     try:
-        result = create_directory_supabase(path,dir_name, token)
+        result = await create_directory_supabase(path,dir_name, user)
         return {"status": "success", "result": result}
     except Exception as e:
         return {"status": "error", "message": str(e)}
@@ -46,10 +199,10 @@ async def create_directory(
 @router.delete("/delete_file")
 async def delete_file(
     file_path: str = Body(..., embed=True),
-    token: str = Depends(oauth2_scheme)
+    user: TokenData = Depends(get_current_user)
 ):
     try:
-        result = delete_file_supabase(file_path, token)
+        result = await delete_file_supabase(file_path, user)
         return {"status": "success", "result": result}
     except HTTPException:
         # Re-raise HTTP exceptions to maintain proper status codes
@@ -61,13 +214,14 @@ async def delete_file(
             detail=f"Failed to delete file: {str(e)}"
         )
     
-@router.delete("/delete_dir")
+@router.delete("/delete_dir", status_code=status.HTTP_202_ACCEPTED)
 async def delete_directory(
     dir_path: str = Body(..., embed=True),
-    token: str = Depends(oauth2_scheme)
+    user: TokenData = Depends(get_current_user)
 ):
+    # Runs as a background job, poll /file/jobs/{job_id} for progress
     try:
-        result = delete_directory_supabase(dir_path, token)
+        result = submit_job("delete_dir", {"dir_path": dir_path}, user)
         return {"status": "success", "result": result}
     except HTTPException:
         # Re-raise HTTP exceptions to maintain proper status codes
@@ -79,43 +233,269 @@ async def delete_directory(
             detail=f"Failed to delete directory: {str(e)}"
         )
 
+@router.get("/download")
+async def download(
+    request: Request,
+    path: str = Query(..., description="File to download"),
+    user: TokenData = Depends(get_current_user)
+):
+    # Served through the disk cache; supports Range, If-None-Match and If-Modified-Since
+    try:
+        return await download_file(path, user, request.headers)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            detail=f"Failed to download file: {str(e)}"
+        )
+
+@router.get("/local/{key:path}")
+async def local_object(request: Request, key: str, token: str = Query(...)):
+    # Signed URLs of the local storage backend land here
+    storage = get_storage()
+    if storage.remote:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not found")
+    path, mimetype, metadata = storage.signed_file(key, token)
+    info = compression.info_from_metadata(metadata)
+    if info is None:
+        return FileResponse(path, media_type=mimetype, content_disposition_type="inline", filename=os.path.basename(key))
+    if compression.accepts(request.headers, info["encoding"]):
+        return FileResponse(
+            path, media_type=mimetype, content_disposition_type="inline", filename=os.path.basename(key),
+            headers={"Content-Encoding": info["encoding"], "Vary": "Accept-Encoding"},
+        )
+    headers = {"Content-Disposition": content_disposition(os.path.basename(key), "inline"), "Vary": "Accept-Encoding"}
+    if info["size"] is not None:
+        headers["Content-Length"] = str(info["size"])
+    return StreamingResponse(
+        compression.decode_stream(_read_file(path), info["encoding"]), media_type=mimetype, headers=headers
+    )
+
+async def _read_file(path: str):
+    with open(path, "rb") as f:
+        while chunk := await run_in_threadpool(f.read, compression.DECODE_CHUNK):
+            yield chunk
+
+@router.get("/download_dir")
+async def download_dir(
+    path: str = Query(..., description="Directory to download as a ZIP"),
+    user: TokenData = Depends(get_current_user)
+):
+    try:
+        filename, body = await download_directory_zip(path, user)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to download directory: {str(e)}"
+        )
+    return StreamingResponse(
+        body,
+        media_type="application/zip",
+        headers={"Content-Disposition": content_disposition(filename)},
+    )
+
+@router.get("/text")
+async def get_file_text(
+    file_path: str = Query(..., description="Path to the file"),
+    user: TokenData = Depends(get_current_user)
+):
+    if not database_enabled():
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Text extraction needs DATABASE_URL")
+    result = await run_db(get_text, user.user_id, file_path.strip("/").replace("..", ""))
+    if result is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No extracted text for this file")
+    return {"status": "success", "result": result}
+
+@router.post("/extract")
+async def extract_file_text(
+    file_path: str = Body(..., embed=True),
+    user: TokenData = Depends(get_current_user)
+):
+    # Re-runs extraction now, e.g. for files uploaded before it existed
+    if not database_enabled():
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Text extraction needs DATABASE_URL")
+    clean_path = file_path.strip("/").replace("..", "")
+    if not can_extract(clean_path):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Unsupported file type")
+    try:
+        result = await extract_object(user.user_id, clean_path)
+        return {"status": "success", "result": {k: v for k, v in result.items() if k != "text"}}
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to extract text: {str(e)}"
+        )
+
+@router.post("/retag", status_code=status.HTTP_202_ACCEPTED)
+async def retag_directory_files(
+    dir_path: str = Body("", embed=True),
+    user: TokenData = Depends(get_current_user)
+):
+    # Runs as a background job, poll /file/jobs/{job_id} for progress
+    if not database_enabled():
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Tagging needs DATABASE_URL")
+    try:
+        result = submit_job("retag", {"dir_path": dir_path}, user)
+        return {"status": "success", "result": result}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to start retagging: {str(e)}"
+        )
+
+@router.get("/storage_savings")
+async def get_storage_savings(user: TokenData = Depends(get_current_user)):
+    # Bytes saved by storing compressible uploads compressed
+    if not database_enabled():
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Compression report needs DATABASE_URL")
+    result = await run_db(metadata_index.storage_savings, user.user_id)
+    return {"status": "success", "result": result}
+
+@router.get("/tags")
+async def get_file_tags(
+    path: str = Query("", description="Folder whose files' tags to list"),
+    user: TokenData = Depends(get_current_user)
+):
+    if not database_enabled():
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Tagging needs DATABASE_URL")
+    result = await run_db(list_tags, user.user_id, path.replace("..", ""))
+    return {"status": "success", "result": result}
+
 @router.get("/get_signed_url")
 async def get_signed_url(
     file_path: str = Query(..., description="Path to the file"),
-    token: str = Depends(oauth2_scheme)
+    user: TokenData = Depends(get_current_user)
 ):
     try:
-        signed_url = get_signed_url_supabase(file_path, token)
+        signed_url = await get_signed_url_supabase(file_path, user)
+        encoding = (await signed_url_encodings([file_path], user)).get(file_path)
+        if encoding:
+            # The URL serves the compressed bytes as stored
+            return {"status": "success", "result": signed_url, "content_encoding": encoding}
         return {"status": "success", "result": signed_url}
     except Exception as e:
         return {"status": "error", "message": str(e)}
+
+@router.post("/get_signed_urls")
+async def get_signed_urls(
+    file_paths: list[str] = Body(..., embed=True),
+    user: TokenData = Depends(get_current_user)
+):
+    try:
+        result = await get_signed_urls_supabase(file_paths, user)
+        return {"status": "success", "result": result}
+    except HTTPException:
+        raise
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
     
-@router.post("/rename_dir")
-async def rename_directory(
+@router.post("/rename_dir", status_code=status.HTTP_202_ACCEPTED)
+async def rename_dir(
     old_dir_path: str = Form(...),
     new_dir_name: str = Form(...),
-    token: str = Depends(oauth2_scheme)
+    user: TokenData = Depends(get_current_user)
 ):
+    # Runs as a background job whose id is also the rename id, so the
+    # rename_dir/{id} status, resume and rollback routes work on it too
     try:
-        result = rename_directory_supabase(old_dir_path, new_dir_name, token)
+        result = submit_job("rename_dir", {"old_dir_path": old_dir_path, "new_dir_name": new_dir_name}, user)
         return {"status": "success", "result": result}
+    except HTTPException:
+        raise
     except Exception as e:
          raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to rename directory: {str(e)}"
         )
 
+@router.get("/jobs")
+async def get_jobs(user: TokenData = Depends(get_current_user)):
+    return {"status": "success", "result": list_jobs(user)}
+
+@router.get("/jobs/{job_id}")
+async def get_job_status(
+    job_id: str,
+    user: TokenData = Depends(get_current_user)
+):
+    return {"status": "success", "result": get_job(job_id, user)}
+
+@router.get("/rename_dir/{rename_id}")
+async def rename_dir_status(
+    rename_id: str,
+    user: TokenData = Depends(get_current_user)
+):
+    result = get_rename_status(rename_id, user)
+    return {"status": "success", "result": result}
+
+@router.post("/rename_dir/{rename_id}/resume", status_code=status.HTTP_202_ACCEPTED)
+async def resume_rename_dir(
+    rename_id: str,
+    user: TokenData = Depends(get_current_user)
+):
+    # Runs as a background job under the rename's id, refused with 409
+    # while the rename or another pass over it is still in progress
+    try:
+        check_resumable(rename_id, user)
+        result = submit_job("resume_rename", {}, user, job_id=rename_id)
+        return {"status": "success", "result": result}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to resume rename: {str(e)}"
+        )
+
+@router.post("/rename_dir/{rename_id}/rollback", status_code=status.HTTP_202_ACCEPTED)
+async def rollback_rename_dir(
+    rename_id: str,
+    user: TokenData = Depends(get_current_user)
+):
+    # Runs as a background job under the rename's id, like resume
+    try:
+        get_rename_status(rename_id, user)
+        result = submit_job("rollback_rename", {}, user, job_id=rename_id)
+        return {"status": "success", "result": result}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to roll back rename: {str(e)}"
+        )
+
 @router.post("/rename_file")
 async def rename_file(
     old_file_path: str = Form(...),
     new_file_name: str = Form(...),
-    token: str = Depends(oauth2_scheme)
+    user: TokenData = Depends(get_current_user)
 ):
     try:
-        result = rename_file_supabase(old_file_path, new_file_name, token)
+        result = await rename_file_supabase(old_file_path, new_file_name, user)
         return {"status": "success", "result": result}
     except Exception as e:
          raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to rename file: {str(e)}"
-        )
\ No newline at end of file
+        )
+
+@router.post("/reindex")
+async def reindex_files(user: TokenData = Depends(get_current_user)):
+    if not database_enabled():
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Metadata index is not configured"
+        )
+    try:
+        count = await reconcile_user_index(user.user_id)
+        return {"status": "success", "result": {"message": "Index rebuilt from storage", "entries": count}}
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to rebuild index: {str(e)}"
+        )
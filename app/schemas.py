@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic import BaseModel, EmailStr
 
 class UserBase(BaseModel):
@@ -19,6 +21,7 @@ class Token(BaseModel):
 class TokenData(BaseModel):
     user_id: str
     session_id: str
+    email: Optional[str] = None
     
 class LoginRequest(BaseModel):
     email: EmailStr
@@ -40,6 +43,12 @@ class ForgotPasswordRequest(BaseModel):
 class ResetPasswordRequest(BaseModel):
     token: str
     new_password: str
+
+class UploadSessionCreate(BaseModel):
+    path: str
+    filename: str
+    total_size: int
+    chunk_size: int
     
 
  
\ No newline at end of file
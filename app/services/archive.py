@@ -0,0 +1,182 @@
+"""
+Streaming ZIP download of a directory.
+
+The archive is written on the fly into an unseekable sink, so zipfile uses
+data descriptors and nothing is kept beyond the bytes not yet sent.
+Objects are fetched DOWNLOAD_DIR_PREFETCH at a time ahead of the writer,
+each through a queue of at most DOWNLOAD_DIR_QUEUE_CHUNKS chunks, which
+bounds memory regardless of folder size.
+"""
+import asyncio
+import os
+import time
+import zipfile
+from datetime import datetime
+from urllib.parse import quote
+
+import anyio
+from fastapi import HTTPException, status
+
+from . import compression
+from .cloud import _safe_join_prefix, iter_object, walk_prefix
+from ..config import get_settings
+from ..schemas import TokenData
+
+settings = get_settings()
+
+# Deflating these again costs CPU for next to no gain
+_COMPRESSED_PREFIXES = ("image/", "video/", "audio/")
+_COMPRESSED_TYPES = {
+    "application/zip",
+    "application/gzip",
+    "application/x-gzip",
+    "application/x-7z-compressed",
+    "application/x-rar-compressed",
+    "application/x-bzip2",
+    "application/x-xz",
+    "application/zstd",
+    "application/pdf",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+}
+# Images that are worth deflating
+_UNCOMPRESSED_IMAGES = {"image/svg+xml", "image/bmp", "image/x-ms-bmp", "image/tiff"}
+
+
+def _is_compressed(mimetype: str) -> bool:
+    mimetype = (mimetype or "").lower()
+    if mimetype in _UNCOMPRESSED_IMAGES:
+        return False
+    return mimetype in _COMPRESSED_TYPES or mimetype.startswith(_COMPRESSED_PREFIXES)
+
+def _zip_date_time(updated_at: str):
+    try:
+        parsed = datetime.fromisoformat(updated_at.replace("Z", "+00:00"))
+        if parsed.year >= 1980:
+            return parsed.timetuple()[:6]
+    except (AttributeError, ValueError):
+        pass
+    return time.localtime()[:6]
+
+
+class _ZipSink:
+    # Unseekable file object for zipfile; the response generator drains it
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def write(self, data) -> int:
+        self._buffer += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+async def _fetch(key: str, queue: asyncio.Queue):
+    # Feeds the object's bytes into `queue`, then None, or the exception
+    try:
+        async for chunk in iter_object(key, settings.UPLOAD_CHUNK_SIZE):
+            await queue.put(chunk)
+        await queue.put(None)
+    except Exception as e:
+        await queue.put(e)
+
+async def _zip_stream(files: list, base_prefix: str):
+    sink = _ZipSink()
+    archive = zipfile.ZipFile(sink, "w", allowZip64=True)
+    prefetch = max(1, settings.DOWNLOAD_DIR_PREFETCH)
+    fetches = {}
+    errors = []
+
+    def start_fetch(index: int):
+        queue = asyncio.Queue(maxsize=settings.DOWNLOAD_DIR_QUEUE_CHUNKS)
+        fetches[index] = (queue, asyncio.create_task(_fetch(files[index][0], queue)))
+
+    try:
+        for index in range(min(prefetch, len(files))):
+            start_fetch(index)
+
+        for index, (key, item) in enumerate(files):
+            queue, _ = fetches.pop(index)
+            if index + prefetch < len(files):
+                start_fetch(index + prefetch)
+
+            arcname = key[len(base_prefix):]
+            metadata = item.get("metadata") or {}
+            first = await queue.get()
+            if isinstance(first, Exception):
+                errors.append(f"{arcname}: {first}")
+                continue
+
+            if os.path.basename(arcname) == ".empty":
+                # Folder placeholder, kept as an (empty) directory entry. The
+                # downloaded folder's own placeholder has no entry to become.
+                if os.path.dirname(arcname):
+                    archive.writestr(zipfile.ZipInfo(f"{os.path.dirname(arcname)}/"), b"")
+                    yield sink.drain()
+                continue
+
+            zinfo = zipfile.ZipInfo(arcname, date_time=_zip_date_time(item.get("updated_at")))
+            deflate = not _is_compressed(metadata.get("mimetype"))
+            zinfo.compress_type = zipfile.ZIP_DEFLATED if deflate else zipfile.ZIP_STORED
+            size = metadata.get("size")
+            if compression.is_compressible(metadata.get("mimetype")):
+                # The listed size may be that of the compressed bytes; zip64
+                # covers whatever the decoded size turns out to be
+                size = (item.get("user_metadata") or {}).get("original_size")
+            if size is not None:
+                zinfo.file_size = size
+
+            with archive.open(zinfo, "w", force_zip64=size is None) as entry:
+                chunk = first
+                while chunk is not None:
+                    if isinstance(chunk, Exception):
+                        # Too late to drop the entry; flag it as truncated
+                        errors.append(f"{arcname}: truncated, {chunk}")
+                        break
+                    if deflate:
+                        await anyio.to_thread.run_sync(entry.write, chunk)
+                    else:
+                        entry.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+                    chunk = await queue.get()
+            yield sink.drain()
+
+        if errors:
+            archive.writestr("DOWNLOAD_ERRORS.txt", "\n".join(errors) + "\n")
+        archive.close()
+        yield sink.drain()
+    finally:
+        # The client may have gone away mid-archive
+        for _, task in fetches.values():
+            task.cancel()
+
+
+async def download_directory_zip(dir_path: str, user: TokenData):
+    """
+    Returns (filename, async byte iterator) for a ZIP of everything below
+    `dir_path`. The folder is walked up front so a missing one is a 404
+    rather than an empty archive.
+    """
+    user_id = user.user_id
+    clean_path = dir_path.strip("/").replace("..", "")
+    base_prefix = _safe_join_prefix(f"{user_id}/{clean_path}")
+
+    files, _ = await walk_prefix(base_prefix)
+    if not files:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Directory not found or empty")
+    files.sort(key=lambda f: f[0])
+
+    filename = f"{os.path.basename(clean_path) or 'files'}.zip"
+    return filename, _zip_stream(files, base_prefix)
+
+def content_disposition(filename: str, disposition_type: str = "attachment") -> str:
+    return f"{disposition_type}; filename*=UTF-8''{quote(filename)}"
@@ -1,15 +1,48 @@
+import asyncio
 from datetime import datetime, timedelta
 import json
+import logging
 from fastapi import HTTPException
 import jwt
-from supabase import create_client
+from ..cache import TTLCache
 from ..config import get_settings
+from .clients import get_http_client
 from ..schemas import ForgotPasswordRequest, ResetPasswordRequest, TokenData, UpdatePasswordRequest, UserCreate, Token, UserProfile
 
 settings = get_settings()
-supabase = create_client(settings.SUPABASE_URL, settings.SUPABASE_KEY)
+logger = logging.getLogger(__name__)
 
-def create_access_token(user_id: str, session_id: str):
+# Auth and the profiles table are called over the shared async HTTP client.
+# Every call carries the token of the user it acts for, so nothing about a
+# session is kept between requests.
+AUTH_URL = f"{settings.SUPABASE_URL}/auth/v1"
+PROFILES_URL = f"{settings.SUPABASE_URL}/rest/v1/profiles"
+
+# Profile rows with the email filled in, keyed by user id
+profile_cache = TTLCache(maxsize=settings.USER_PROFILE_CACHE_SIZE, ttl=settings.USER_PROFILE_CACHE_TTL)
+
+def _headers(access_token: str = None) -> dict:
+    return {
+        "apikey": settings.SUPABASE_KEY,
+        "Authorization": f"Bearer {access_token or settings.SUPABASE_KEY}",
+    }
+
+def _error(response) -> Exception:
+    # GoTrue and PostgREST name the message field differently
+    try:
+        body = response.json()
+    except ValueError:
+        return Exception(f"{response.status_code} - {response.text}")
+    message = body.get("msg") or body.get("error_description") or body.get("message") or body.get("error")
+    return Exception(message or f"{response.status_code} - {response.text}")
+
+async def _auth_call(method: str, path: str, access_token: str = None, **kwargs) -> dict:
+    response = await get_http_client().request(method, f"{AUTH_URL}/{path}", headers=_headers(access_token), **kwargs)
+    if response.status_code >= 400:
+        raise _error(response)
+    return response.json() if response.content else {}
+
+def create_access_token(user_id: str, session_id: str, email: str = None):
     expires_delta = timedelta(days=settings.ACCESS_TOKEN_EXPIRE_DAYS)
     expire = datetime.utcnow() + expires_delta
     payload = {
@@ -17,112 +50,133 @@ def create_access_token(user_id: str, session_id: str):
         "session_id": session_id,
         "exp": expire
     }
+    if email:
+        # Saves a get_user round trip wherever the email is needed
+        payload["email"] = email
     return jwt.encode(payload, settings.JWT_SECRET, algorithm=settings.ALGORITHM)
 
-def signup_user(user: UserCreate):
-    auth_response = supabase.auth.sign_up({
+async def signup_user(user: UserCreate):
+    auth_response = await _auth_call("POST", "signup", json={
         "email": user.email,
         "password": user.password,
-        "options": {
-            "data": {
-                "first_name": user.first_name,
-                "last_name": user.last_name,
-                "phone_number": user.phone_number
-            }   
+        "data": {
+            "first_name": user.first_name,
+            "last_name": user.last_name,
+            "phone_number": user.phone_number
         }
     })
-    
-    user_id = auth_response.user.id
-    
- 
-    supabase.table("profiles").insert({
+    # A session comes back only when email confirmation is off
+    user_id = (auth_response.get("user") or auth_response)["id"]
+
+    response = await get_http_client().post(PROFILES_URL, json={
         "user_id": user_id,
         "first_name": user.first_name,
         "last_name": user.last_name,
         "phone_number": user.phone_number
-    }).execute()
-    
+    }, headers={**_headers(), "Prefer": "return=minimal"})
+    if response.status_code >= 400:
+        raise _error(response)
+
     return user_id
 
-def login_user(email: str, password: str):
-    response = supabase.auth.sign_in_with_password({
+async def _sign_in(email: str, password: str) -> dict:
+    return await _auth_call("POST", "token", params={"grant_type": "password"}, json={
         "email": email,
         "password": password
     })
-    # response is an AuthResponse object. Use __dict__ or str() for debugging.
-    print(f"Supabase Response: {response}")
+
+async def login_user(email: str, password: str):
+    session = await _sign_in(email, password)
+    logger.debug("Signed in user %s", session["user"]["id"])
     return Token(
         access_token=create_access_token(
-            user_id=response.user.id,
-            session_id=response.session.access_token
+            user_id=session["user"]["id"],
+            session_id=session["access_token"],
+            email=session["user"].get("email")
         ),
         token_type="bearer"
     )
 
-def logout_user(token: TokenData):
-    supabase.auth.sign_out()
-
-# 👤 Get Profile
-def get_user_profile(user: TokenData) -> dict:
-    # Step 1: Fetch profile from 'profiles' table
-    profile_result = supabase.table("profiles") \
-        .select("*") \
-        .eq("user_id", user.user_id) \
-        .single() \
-        .execute()
-    
-    if not profile_result.data:
+async def logout_user(token: TokenData):
+    try:
+        await _auth_call("POST", "logout", access_token=token.session_id)
+    except Exception as e:
+        # The Supabase session may have expired before ours did
+        logger.debug("Supabase sign out failed: %s", e)
+
+async def _fetch_profile(user_id: str) -> dict:
+    response = await get_http_client().get(
+        PROFILES_URL, params={"select": "*", "user_id": f"eq.{user_id}"}, headers=_headers()
+    )
+    if response.status_code >= 400:
+        raise _error(response)
+    rows = response.json()
+    if not rows:
         raise HTTPException(status_code=404, detail="Profile not found")
+    return rows[0]
 
-    profile_data = profile_result.data
-
-    # Step 2: Fetch user from Supabase Auth to get email
-    auth_user = supabase.auth.get_user(user.session_id)
-
-    if not auth_user.user:
+async def _fetch_email(user: TokenData) -> str:
+    try:
+        auth_user = await _auth_call("GET", "user", access_token=user.session_id)
+    except Exception:
         raise HTTPException(status_code=404, detail="User email not found")
+    return auth_user["email"]
 
-    profile_data["email"] = auth_user.user.email
-
-    return profile_data
+# 👤 Get Profile
+async def get_user_profile(user: TokenData) -> dict:
+    cached = profile_cache.get(user.user_id)
+    if cached is not None:
+        return dict(cached)
+
+    if user.email:
+        profile_data = await _fetch_profile(user.user_id)
+        email = user.email
+    else:
+        # Older tokens carry no email, so ask auth for it alongside the profile
+        profile_data, email = await asyncio.gather(_fetch_profile(user.user_id), _fetch_email(user))
+    profile_data["email"] = email
+    profile_cache.set(user.user_id, profile_data)
+    return dict(profile_data)
 
 
 # ✏️ Update Profile
-def update_user_profile(user: TokenData, updated_data: UserProfile):
-    supabase.table("profiles").update(updated_data.dict()).eq("user_id", user.user_id).execute()
+async def update_user_profile(user: TokenData, updated_data: UserProfile):
+    response = await get_http_client().patch(
+        PROFILES_URL, params={"user_id": f"eq.{user.user_id}"}, json=updated_data.dict(),
+        headers={**_headers(), "Prefer": "return=minimal"}
+    )
+    if response.status_code >= 400:
+        raise _error(response)
+    profile_cache.pop(user.user_id)
     return {"message": "Profile updated successfully"}
 
 
 # 🔒 Change Password
-def change_user_password(user: TokenData, data: UpdatePasswordRequest):
+async def change_user_password(user: TokenData, data: UpdatePasswordRequest):
     try:
-        # Optional: Validate old password if needed
-        supabase.auth.sign_in_with_password({
-            "email": user.email,
-            "password": data.old_password
-        })
-        supabase.auth.update_user({"password": data.new_password})
+        # Signing in again checks the old password and gives a session that
+        # belongs to this user alone to make the change with
+        email = user.email or await _fetch_email(user)
+        session = await _sign_in(email, data.old_password)
+        await _auth_call("PUT", "user", access_token=session["access_token"], json={"password": data.new_password})
         return {"message": "Password updated successfully"}
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid current password")
 
 
 # 📧 Forgot Password
-def send_reset_email(data: ForgotPasswordRequest):
+async def send_reset_email(data: ForgotPasswordRequest):
     try:
-        supabase.auth.reset_password_email(data.email)
+        await _auth_call("POST", "recover", json={"email": data.email})
         return {"message": "Password reset email sent"}
     except Exception:
         raise HTTPException(status_code=400, detail="Failed to send reset email")
 
 
 # 🔁 Reset Password with Token
-def reset_user_password(data: ResetPasswordRequest):
+async def reset_user_password(data: ResetPasswordRequest):
     try:
-        supabase.auth.update_user(
-            {"password": data.new_password},
-            session_token=data.token
-        )
+        await _auth_call("PUT", "user", access_token=data.token, json={"password": data.new_password})
         return {"message": "Password reset successful"}
     except Exception:
-        raise HTTPException(status_code=400, detail="Failed to reset password")
\ No newline at end of file
+        raise HTTPException(status_code=400, detail="Failed to reset password")
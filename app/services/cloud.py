@@ -1,87 +1,493 @@
  
+import asyncio
+import base64
+import hashlib
 import json
-from fastapi import UploadFile
-import requests
+import logging
+from collections import deque
+from fastapi import HTTPException, UploadFile, status
 import os
 
-from app.dependencies import get_current_user
+from . import compression, content_index, metadata_index, search_index
+from .storage import get_storage
+from ..cache import TTLCache
 
 from ..config import get_settings 
+from ..database import database_enabled, run_db
+from ..schemas import TokenData
+from starlette.concurrency import run_in_threadpool
 import uuid
 import mimetypes
   
 settings = get_settings()
-SUPABASE_URL = settings.SUPABASE_URL
-SUPABASE_KEY = settings.SUPABASE_KEY
-SUPABASE_BUCKET = settings.SUPABASE_BUCKET
+
+logger = logging.getLogger(__name__)
+
+# Callbacks run as listener(user_id, rel_path, size, content_type) after a
+# file has been stored, e.g. to queue text extraction
+upload_listeners = []
+# Callbacks run as listener(full_keys) after objects are deleted or moved away
+removal_listeners = []
+
+# Full object key -> signed URL, dropped a safety margin before the URL expires
+signed_url_cache = TTLCache(
+    settings.SIGNED_URL_CACHE_SIZE,
+    settings.SIGNED_URL_EXPIRES_IN - settings.SIGNED_URL_SAFETY_MARGIN,
+)
+# Storage lookups in flight for one signing request, when the index can't tell
+ENCODING_LOOKUP_CONCURRENCY = 8
+
+def join_key(*parts: str) -> str:
+    # Join path segments without producing empty segments ("u1//a.txt")
+    return "/".join(part.strip("/") for part in parts if part and part.strip("/"))
+
+async def update_index(user_id: str, fn, *args):
+    """
+    Applies a metadata_index mutation after a successful storage call.
+    Storage stays the source of truth: if the index can't keep up, listings
+    for this user go back to storage until the next reconcile.
+    """
+    if not database_enabled():
+        return
+    try:
+        await run_db(fn, user_id, *args)
+    except Exception:
+        logger.exception("Metadata index update failed for user %s", user_id)
+        try:
+            await run_db(metadata_index.invalidate, user_id)
+        except Exception:
+            logger.exception("Could not invalidate metadata index for user %s", user_id)
 
 
 
  
 
-def upload_to_supabase(file: UploadFile, content: bytes, user_path: str, token: str):
+def notify_upload(user_id: str, rel_path: str, size: int, content_type: str):
+    for listener in upload_listeners:
+        try:
+            listener(user_id, rel_path, size, content_type)
+        except Exception:
+            logger.exception("Upload listener failed for %s", rel_path)
+
+async def forget_objects(keys: list):
+    # Drops whatever is cached or indexed for objects that no longer exist
+    for key in keys:
+        signed_url_cache.pop(key)
+    compression.forget(keys)
+    for listener in removal_listeners:
+        try:
+            listener(keys)
+        except Exception:
+            logger.exception("Removal listener failed")
+    if dedup_enabled():
+        try:
+            await run_db(content_index.forget_objects, keys)
+        except Exception:
+            # Dedup checks the source's hash before copying, so a stale entry only costs an upload
+            logger.exception("Content index cleanup failed")
+
+def check_upload_size(size: int):
+    max_size = settings.MAX_UPLOAD_SIZE
+    if max_size and size is not None and size > max_size:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"File exceeds the maximum upload size of {max_size} bytes"
+        )
+
+async def _iter_upload(file: UploadFile, chunk_size: int):
+    # Read the spooled upload a chunk at a time so memory stays flat
+    sent = 0
+    while True:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            break
+        sent += len(chunk)
+        check_upload_size(sent)
+        yield chunk
+
+def _public_url(full_path: str) -> str:
+    return get_storage().public_url(full_path)
+
+def dedup_enabled() -> bool:
+    return settings.DEDUP_ENABLED and database_enabled()
+
+def _dedup_scope(user_id: str) -> str:
+    return "*" if settings.DEDUP_SCOPE == "global" else user_id
+
+def _check_hash_only_allowed():
+    # Across users, a hash and size are no proof of having the bytes, so
+    # only uploads that hash what was actually sent may reuse content
+    if settings.DEDUP_SCOPE == "global":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Hash-only uploads are not available with global deduplication"
+        )
+
+def _is_not_found(error: Exception) -> bool:
+    # Storage reports missing objects as 400 "not_found"
+    code, _, body = str(error).partition(" - ")
+    return code == "404" or (code == "400" and "not_found" in body)
+
+def _check_sha256(sha256: str) -> str:
+    sha256 = sha256.lower()
+    if len(sha256) != 64 or any(c not in "0123456789abcdef" for c in sha256):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid SHA-256 digest: {sha256}")
+    return sha256
+
+def _hash_file(fileobj, chunk_size: int) -> str:
+    digest = hashlib.sha256()
+    fileobj.seek(0)
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        digest.update(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+async def record_content(user_id: str, sha256: str, size: int, full_path: str, content_type: str):
+    # Best effort: a missed entry only costs a future full upload
+    if not dedup_enabled():
+        return
+    try:
+        await run_db(content_index.record_content, _dedup_scope(user_id), sha256, size, full_path, content_type)
+    except Exception:
+        logger.exception("Content index update failed for %s", full_path)
+
+async def _copy_known_content(user_id: str, sha256: str, size: int, full_path: str) -> bool:
+    """
+    Server-side copies an object with the same content to `full_path`.
+    Returns False when there is nothing to copy from, so the caller
+    uploads the bytes itself.
+    """
+    try:
+        found = await run_db(content_index.find_object, _dedup_scope(user_id), sha256, size)
+    except Exception:
+        logger.exception("Content index lookup failed")
+        return False
+    if found is None or found[0] == full_path:
+        return False
+    try:
+        # Uploads keep their hash in the object's metadata, and copies keep
+        # the source's. Anything else may have been replaced since it was
+        # recorded, by a delete and upload outside this app for one.
+        stored = await get_storage().object_metadata(found[0])
+        if stored.get("sha256") != sha256:
+            logger.info("Dedup source %s no longer has the recorded content, uploading instead", found[0])
+            await run_db(content_index.forget_content, _dedup_scope(user_id), sha256, size, found[0])
+            return False
+        await copy_object(found[0], full_path)
+        return True
+    except Exception as e:
+        logger.info("Dedup copy from %s failed (%s), uploading instead", found[0], e)
+        if _is_not_found(e):
+            # The source was deleted since it was recorded
+            await run_db(content_index.forget_content, _dedup_scope(user_id), sha256, size, found[0])
+        return False
+
+async def iter_object(full_path: str, chunk_size: int):
+    # Streams an object's bytes out of the bucket, decoded if stored compressed
+    response = await get_storage().open_object(full_path)
+    try:
+        if response.status_code != 200:
+            await response.aread()
+            raise Exception(f"Download failed: {response.status_code} - {response.text}")
+        body = response.aiter_bytes(chunk_size)
+        info = await compression.encoding_info(full_path, response.headers.get("content-type"))
+        if info is not None:
+            body = compression.decode_stream(body, info["encoding"])
+        async for chunk in body:
+            yield chunk
+    finally:
+        await response.aclose()
+
+async def put_object(full_path: str, body, content_type: str, size: int = None, metadata: dict = None):
+    """
+    Streams `body` (an async iterator of bytes) to `full_path` in the bucket.
+    Returns the public URL of the stored object.
+    """
+    try:
+        await get_storage().stream_put_object(full_path, body, content_type, size, metadata=metadata)
+    except Exception as e:
+        raise Exception(f"Upload failed: {e}")
+    return _public_url(full_path)
+
+async def store_upload(full_path: str, body, content_type: str, size: int, sample: bytes = None, sha256: str = None):
+    """
+    put_object for uploads: compressed on the way when `sample`, the start
+    of the file, shows it's worth it (see compression.py). `sha256`, when
+    known, is kept in the object's metadata for dedup. Returns
+    (public_url, stored_size, encoding), the last two None when the file
+    is stored as is.
+    """
+    metadata = {"sha256": sha256} if sha256 else {}
+    encoding = await compression.choose_encoding(sample) if sample else None
+    if encoding is None:
+        public_url = await put_object(full_path, body, content_type, size, metadata=metadata or None)
+        compression.remember(full_path)
+        return public_url, None, None
+
+    counts = {"original": 0, "stored": 0}
+    public_url = await put_object(
+        full_path, compression.compress_stream(body, encoding, counts), content_type,
+        metadata={**metadata, **compression.stored_metadata(encoding, size)},
+    )
+    compression.record_compressed(full_path, encoding, counts)
+    return public_url, counts["stored"], encoding
+
+async def _copied_encoding(full_path: str, content_type: str):
+    # Copies keep the source's bytes and metadata, compressed or not
+    compression.forget([full_path])
+    try:
+        info = await compression.encoding_info(full_path, content_type)
+    except Exception:
+        logger.exception("Could not read the metadata of %s", full_path)
+        return None
+    return info["encoding"] if info else None
+
+async def store_known_content(user_id: str, sha256: str, size: int, full_path: str, content_type: str):
+    """
+    Creates `full_path` as a server-side copy of content already stored
+    with this hash. Returns (public_url, encoding), or None when there is
+    nothing to copy from and the bytes have to be uploaded.
+    """
+    if not await _copy_known_content(user_id, sha256, size, full_path):
+        return None
+    return _public_url(full_path), await _copied_encoding(full_path, content_type)
+
+async def upload_to_supabase(file: UploadFile, user_path: str, user: TokenData, filename: str = None):
    
-    user = get_current_user(token)
     user_id = user.user_id
+    filename = filename or file.filename
   
     clean_path = user_path.strip("/").replace("..", "")  
-    full_path = f"{user_id}/{clean_path}/{file.filename}"
+    full_path = join_key(user_id, clean_path, filename)
  
-    content_type, _ = mimetypes.guess_type(file.filename)
+    content_type, _ = mimetypes.guess_type(filename)
     content_type = content_type or "application/octet-stream"
 
-    url = f"{SUPABASE_URL}/storage/v1/object/{SUPABASE_BUCKET}/{full_path}"
-    headers = {
-        "apikey": SUPABASE_KEY,
-        "Authorization": f"Bearer {SUPABASE_KEY}",
-        "Content-Type": content_type,
-        "x-upsert": "false"
-    }
+    check_upload_size(file.size)
 
-    response = requests.put(url, data=content, headers=headers)
+    # The part is already spooled locally, so hashing it first lets a
+    # known file become a server-side copy instead of a full transfer
+    sha256 = None
+    copied = None
+    if dedup_enabled() and file.size is not None:
+        sha256 = await run_in_threadpool(_hash_file, file.file, settings.UPLOAD_CHUNK_SIZE)
+        copied = await store_known_content(user_id, sha256, file.size, full_path, content_type)
 
-    if response.status_code in (200, 201):
-        public_url = f"{SUPABASE_URL}/storage/v1/object/public/{SUPABASE_BUCKET}/{full_path}"
-        return {
-            "message": "Upload successful",
-            "url": public_url,
-            "filename": file.filename,
-            "path": clean_path,
-            "content_type": content_type
-        }
+    stored_size = None
+    if copied:
+        public_url, encoding = copied
     else:
-        raise Exception(f"Upload failed: {response.status_code} - {response.text}")
-    
- 
+        sample = None
+        if compression.should_probe(content_type, file.size):
+            sample = await file.read(settings.COMPRESSION_SAMPLE_SIZE)
+            await file.seek(0)
+        body = _iter_upload(file, settings.UPLOAD_CHUNK_SIZE)
+        public_url, stored_size, encoding = await store_upload(full_path, body, content_type, file.size, sample, sha256)
+    await update_index(
+        user_id, metadata_index.record_object, join_key(clean_path, filename), file.size, content_type,
+        None, stored_size, encoding,
+    )
+    if sha256:
+        await record_content(user_id, sha256, file.size, full_path, content_type)
+    notify_upload(user_id, join_key(clean_path, filename), file.size, content_type)
+
+    return {
+        "message": "Upload successful",
+        "url": public_url,
+        "filename": filename,
+        "path": clean_path,
+        "content_type": content_type,
+        "sha256": sha256,
+        "deduplicated": copied is not None,
+        "content_encoding": encoding
+    }
 
-def list_user_files(user_path: str, token: str):
-    user = get_current_user(token)
+async def upload_by_hash(sha256: str, size: int, user_path: str, filename: str, user: TokenData):
+    """
+    Creates `user_path/filename` from content the server already has, for
+    clients that found the hash known via check_hashes and skip the upload.
+    """
     user_id = user.user_id
+    if not dedup_enabled():
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Deduplication is not enabled")
+    _check_hash_only_allowed()
 
+    sha256 = _check_sha256(sha256)
     clean_path = user_path.strip("/").replace("..", "")
-    full_path = f"{user_id}/{clean_path}"
+    filename = os.path.basename(filename)
+    full_path = join_key(user_id, clean_path, filename)
 
-    url = f"{SUPABASE_URL}/storage/v1/object/list/{SUPABASE_BUCKET}"
-    headers = {
-        "apikey": SUPABASE_KEY,
-        "Authorization": f"Bearer {SUPABASE_KEY}"
-    }
-    payload = {
-        "prefix": full_path,
-        "limit": 100,
-        "offset": 0,
+    if not await _copy_known_content(user_id, sha256, size, full_path):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Content not found, upload the file instead")
+
+    content_type, _ = mimetypes.guess_type(filename)
+    content_type = content_type or "application/octet-stream"
+    encoding = await _copied_encoding(full_path, content_type)
+    await update_index(
+        user_id, metadata_index.record_object, join_key(clean_path, filename), size, content_type,
+        None, None, encoding,
+    )
+    await record_content(user_id, sha256, size, full_path, content_type)
+    notify_upload(user_id, join_key(clean_path, filename), size, content_type)
+
+    return {
+        "message": "Upload successful",
+        "url": _public_url(full_path),
+        "filename": filename,
+        "path": clean_path,
+        "content_type": content_type,
+        "sha256": sha256,
+        "deduplicated": True,
+        "content_encoding": encoding
     }
 
-    response = requests.post(url, json=payload, headers=headers)
+async def check_hashes(hashes: list, user: TokenData):
+    # Which of these SHA-256 digests the server can copy without an upload
+    _check_hash_only_allowed()
+    if len(hashes) > settings.BULK_UPLOAD_MAX_FILES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {settings.BULK_UPLOAD_MAX_FILES} hashes can be checked at once"
+        )
+    hashes = [_check_sha256(h) for h in hashes]
+    known = set()
+    if dedup_enabled() and hashes:
+        known = await run_db(content_index.known_hashes, _dedup_scope(user.user_id), hashes)
+    return {
+        "known": [h for h in hashes if h in known],
+        "unknown": [h for h in hashes if h not in known],
+    }
 
-    if response.status_code != 200:
-        raise Exception(f"Failed to list files: {response.text}")
+async def upload_many_to_supabase(files: list, user_path: str, user: TokenData, relative_paths: list = None):
+    """
+    Uploads every file under `user_path`, BULK_UPLOAD_CONCURRENCY at a
+    time. `relative_paths`, when given, holds one "sub/dir/name.ext" per
+    file so a dropped folder keeps its structure. One failed file doesn't
+    stop the others; each gets its own result.
+    """
+    if len(files) > settings.BULK_UPLOAD_MAX_FILES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {settings.BULK_UPLOAD_MAX_FILES} files can be uploaded at once"
+        )
+    if relative_paths and len(relative_paths) != len(files):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="relative_paths must have one entry per file"
+        )
 
-    files = response.json()
+    clean_path = user_path.strip("/").replace("..", "")
+    semaphore = asyncio.Semaphore(settings.BULK_UPLOAD_CONCURRENCY)
+
+    async def upload_one(index: int, file: UploadFile):
+        relative_path = (relative_paths[index] if relative_paths else file.filename) or ""
+        folder, _, name = relative_path.strip("/").replace("..", "").rpartition("/")
+        outcome = {"relative_path": relative_path}
+        if not name:
+            return {**outcome, "status": "error", "message": "Missing file name"}
+        async with semaphore:
+            try:
+                result = await upload_to_supabase(file, join_key(clean_path, folder), user, filename=name)
+                return {**outcome, "status": "success", "result": result}
+            except HTTPException as e:
+                return {**outcome, "status": "error", "message": e.detail}
+            except Exception as e:
+                return {**outcome, "status": "error", "message": str(e)}
+
+    results = await asyncio.gather(*(upload_one(i, f) for i, f in enumerate(files)))
+    uploaded = sum(1 for r in results if r["status"] == "success")
+    return {"uploaded": uploaded, "failed": len(results) - uploaded, "files": results}
     
  
-    if not files or not isinstance(files, list):
+
+def _file_entry(full_path: str, name: str, size, mimetype, updated_at):
+    return {
+        "name": name,
+        "fullPath": f"{full_path}/{name}",
+        "url": _public_url(f"{full_path}/{name}"),
+        "size": size,
+        "mimetype": mimetype,
+        "updatedAt": updated_at
+    }
+
+def _original_size(item: dict):
+    # Size of a listed object before compression, where the listing says
+    info = compression.info_from_metadata(item.get("user_metadata"))
+    if info and info["size"] is not None:
+        return info["size"]
+    return (item.get("metadata") or {}).get("size")
+
+def _encode_cursor(state: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(state, separators=(",", ":")).encode()).decode()
+
+def _decode_cursor(cursor: str, sort: str, order: str) -> dict:
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        state = None
+    if not isinstance(state, dict) or state.get("sort") != sort or state.get("order") != order:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor for this listing")
+    return state
+
+def _listing_result(files: list, directories: list, next_cursor, first_page: bool):
+    # An empty folder has always come back as a bare list
+    if first_page and not files and not directories and next_cursor is None:
         return []
+    return {"files": files, "directories": directories, "next_cursor": next_cursor}
+
+async def _list_from_index(user_id: str, clean_path: str, full_path: str, limit: int, state: dict, sort: str, order: str):
+    # None means "ask storage": index disabled, not built yet, or unavailable
+    if not database_enabled():
+        return None
+    after = state.get("after") if state else None
+    try:
+        page = await run_db(
+            metadata_index.list_directory_page,
+            user_id, clean_path, limit, sort, order, tuple(after) if after else None
+        )
+    except Exception:
+        logger.exception("Metadata index read failed for user %s", user_id)
+        return None
+    if page is None:
+        schedule_reconcile(user_id)
+        return None
+
+    rows, has_more = page
+    filesList = []
+    directories = []
+    for row in rows:
+        if row["is_dir"]:
+            directories.append(row["name"])
+            continue
+        updated_at = row["updated_at"].isoformat() if row["updated_at"] else None
+        filesList.append(_file_entry(full_path, row["name"], row["size"], row["mimetype"], updated_at))
+
+    next_cursor = None
+    if has_more:
+        last = rows[-1]
+        sort_value = last["updated_at"].isoformat() if sort == "updated_at" and last["updated_at"] else None
+        next_cursor = _encode_cursor({
+            "source": "index", "sort": sort, "order": order,
+            "after": [last["is_dir"], sort_value, last["name"]],
+        })
+    return filesList, directories, next_cursor
+
+async def _list_from_storage(full_path: str, limit: int, state: dict, sort: str, order: str):
+    offset = state.get("offset", 0) if state else 0
+
+    try:
+        # One extra entry tells us whether there is another page
+        files = await get_storage().list_objects(full_path, limit + 1, offset, sort, order)
+    except Exception as e:
+        raise Exception(f"Failed to list files: {e}")
+
+    next_cursor = None
+    if len(files) > limit:
+        files = files[:limit]
+        next_cursor = _encode_cursor({"source": "storage", "sort": sort, "order": order, "offset": offset + limit})
 
     filesList = []
     directories=[]
@@ -90,69 +496,126 @@ def list_user_files(user_path: str, token: str):
             directories.append(file["name"])
             continue
     
-        filesList.append({
-            "name": file["name"],
-            "fullPath": f"{full_path}/{file['name']}",
-            "url": f"{SUPABASE_URL}/storage/v1/object/public/{SUPABASE_BUCKET}/{full_path}/{file['name']}",
-            "size": file.get("metadata", {}).get("size"),
-            "mimetype": file.get("metadata", {}).get("mimetype"),
-            "updatedAt": file.get("updated_at")
-        })
+        metadata = file.get("metadata") or {}
+        filesList.append(_file_entry(full_path, file["name"], _original_size(file), metadata.get("mimetype"), file.get("updated_at")))
 
-    return {"files": filesList, "directories": directories}
+    return filesList, directories, next_cursor
 
-def create_directory_supabase(user_path: str,dir_name: str, token: str):
-    user = get_current_user(token)
+async def list_user_files(user_path: str, user: TokenData, limit: int = 100, cursor: str = None, sort: str = "name", order: str = "asc"):
+    """
+    One page of a folder listing. Pass the returned `next_cursor` back to
+    get the following page; it is None on the last page.
+    """
     user_id = user.user_id
+
     clean_path = user_path.strip("/").replace("..", "")
-    full_path = f"{user_id}/{clean_path}/{dir_name}/.empty"
+    full_path = f"{user_id}/{clean_path}"
 
-    url = f"{SUPABASE_URL}/storage/v1/object/{SUPABASE_BUCKET}/{full_path}"
-    headers = {
-        "apikey": SUPABASE_KEY,
-        "Authorization": f"Bearer {SUPABASE_KEY}",
-        "Content-Type": "application/octet-stream"
-    }
-    response = requests.put(url, data=b'', headers=headers)
+    state = _decode_cursor(cursor, sort, order) if cursor else None
+    source = state.get("source") if state else None
+
+    # A cursor keeps paging the source that produced it; the index uses
+    # keyset paging, storage can only page by offset.
+    page = None
+    if source in (None, "index"):
+        page = await _list_from_index(user_id, clean_path, full_path, limit, state, sort, order)
+        if page is None and source == "index":
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="Listing changed while paging, start again from the first page"
+            )
+    if page is None:
+        page = await _list_from_storage(full_path, limit, state, sort, order)
+
+    files, directories, next_cursor = page
+    return _listing_result(files, directories, next_cursor, first_page=cursor is None)
+
+async def search_user_files(q: str, user: TokenData, file_type: str = None, modified_after=None,
+                            modified_before=None, limit: int = 50, cursor: str = None):
+    """
+    Ranked search over the user's metadata index, never touching storage.
+    Pages are linked by `next_cursor` like folder listings.
+    """
+    user_id = user.user_id
+    if not database_enabled():
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Search needs DATABASE_URL")
+    tsquery = search_index.build_tsquery(q)
+    if tsquery is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Search query has no words")
+
+    state = _decode_cursor(cursor, "rank", "desc") if cursor else None
+    offset = state.get("offset", 0) if state else 0
+    page = await run_db(
+        search_index.search, user_id, tsquery, file_type, modified_after, modified_before, limit, offset
+    )
+    if page is None:
+        schedule_reconcile(user_id)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Search index is being built, try again shortly"
+        )
+
+    results, has_more = page
+    next_cursor = None
+    if has_more:
+        next_cursor = _encode_cursor({"source": "search", "sort": "rank", "order": "desc", "offset": offset + limit})
+    return {"results": results, "next_cursor": next_cursor}
+
+async def iter_user_files(user_path: str, user: TokenData, sort: str = "name", order: str = "asc", page_size: int = 1000):
+    """
+    Yields every entry of a folder one at a time, fetching a page at a
+    time, so huge folders never have to be held in memory at once.
+    """
+    cursor = None
+    while True:
+        page = await list_user_files(user_path, user, page_size, cursor, sort, order)
+        if not page:
+            return
+        for name in page["directories"]:
+            yield {"type": "directory", "name": name}
+        for file in page["files"]:
+            yield {"type": "file", **file}
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return
+
+async def create_directory_supabase(user_path: str,dir_name: str, user: TokenData):
+    user_id = user.user_id
+    clean_path = user_path.strip("/").replace("..", "")
+    full_path = join_key(user_id, clean_path, dir_name, ".empty")
 
-    if response.status_code in (200, 201):
-        return {"message": "Directory created successfully", "path": full_path}
-    else:
-        raise Exception(f"Failed to create directory: {response.text}")
+    try:
+        await get_storage().put_object(full_path, b'', "application/octet-stream")
+    except Exception as e:
+        raise Exception(f"Failed to create directory: {e}")
 
-def delete_file_supabase(file_path: str, token: str):
-    user = get_current_user(token)
+    await update_index(user_id, metadata_index.record_object, join_key(clean_path, dir_name, ".empty"), 0, "application/octet-stream")
+    return {"message": "Directory created successfully", "path": full_path}
+
+async def delete_file_supabase(file_path: str, user: TokenData):
     user_id = user.user_id
 
     # Sanitize path
     clean_path = file_path.strip("/").replace("..", "")
     full_path_to_delete = f"{user_id}/{clean_path}"
 
-    delete_url = f"{SUPABASE_URL}/storage/v1/object/{SUPABASE_BUCKET}"
-    headers = {
-        "apikey": SUPABASE_KEY,
-        "Authorization": f"Bearer {SUPABASE_KEY}",
-        "Content-Type": "application/json"
-    }
+    try:
+        await get_storage().delete_objects([full_path_to_delete])
+    except Exception as e:
+        raise Exception(f"Failed to delete file: {e}")
 
-    # Correct body
-    payload = {
-        "prefixes": [full_path_to_delete]
-    }
+    await forget_objects([full_path_to_delete])
+    await update_index(user_id, metadata_index.remove_object, clean_path)
+    return {"message": "File deleted successfully"}
+    
+async def move_object(source_key: str, destination_key: str):
+    await get_storage().move_object(source_key, destination_key)
+    await forget_objects([source_key])
 
-    response = requests.delete(
-        delete_url,
-        json=payload,
-        headers=headers
-    )
+async def copy_object(source_key: str, destination_key: str):
+    await get_storage().copy_object(source_key, destination_key)
 
-    if response.status_code == 200:
-        return {"message": "File deleted successfully"}
-    else:
-        raise Exception(f"Failed to delete file: {response.status_code} - {response.text}")
-    
-def rename_file_supabase(old_file_path: str, new_file_name: str, token: str):
-    user = get_current_user(token)
+async def rename_file_supabase(old_file_path: str, new_file_name: str, user: TokenData):
     user_id = user.user_id
 
     # Sanitize paths to prevent traversal attacks
@@ -167,196 +630,272 @@ def rename_file_supabase(old_file_path: str, new_file_name: str, token: str):
     # Construct the full new path with the new filename
     new_full_path = f"{directory_path}/{new_file_name}".strip("/")
 
-    # ✅ Correct endpoint (no bucket in URL)
-    url = f"{SUPABASE_URL}/storage/v1/object/move"
-    headers = {
-        "apikey": SUPABASE_KEY,
-        "Authorization": f"Bearer {SUPABASE_KEY}",
-        "Content-Type": "application/json"
-    }
-
-    # ✅ Correct payload
-    payload = {
-        "bucketId": SUPABASE_BUCKET,
-        "sourceKey": old_full_path,
-        "destinationKey": new_full_path
-    }
-
-    response = requests.post(url, json=payload, headers=headers)
-
-    if response.status_code == 200:
-        return {
-            "message": "File renamed successfully",
-            "old_path": old_full_path,
-            "new_path": new_full_path
-        }
-    else:
-        raise Exception(f"Failed to rename file: {response.status_code} - {response.text}")
- 
-def rename_directory_supabase(old_dir_path: str, new_dir_name: str, token: str):
-    user = get_current_user(token)
-    user_id = user.user_id
-
-    # Sanitize paths
-    clean_old_dir = old_dir_path.strip("/").replace("..", "")
+    try:
+        await move_object(old_full_path, new_full_path)
+    except Exception as e:
+        raise Exception(f"Failed to rename file: {e}")
 
-    # Add base path with user_id
-    old_full_path = f"{user_id}/{clean_old_dir}".strip("/")
-
-    # Extract parent path (under user_id) and build new path
-    parent_path = os.path.dirname(old_full_path)
-    new_dir_path = f"{parent_path}/{new_dir_name}".strip("/")
-
-    # 1. List all objects inside the old directory
-    list_url = f"{SUPABASE_URL}/storage/v1/object/list/{SUPABASE_BUCKET}"
-    headers = {
-        "apikey": SUPABASE_KEY,
-        "Authorization": f"Bearer {SUPABASE_KEY}",
-        "Content-Type": "application/json"
-    }
-    payload = {
-        "prefix": old_full_path + "/",  # must end with slash for directory
-        "limit": 100,  # todo: implement pagination for large dirs
-        "offset": 0
+    await update_index(
+        user_id, metadata_index.move_object,
+        old_full_path[len(user_id) + 1:], new_full_path[len(user_id) + 1:]
+    )
+    return {
+        "message": "File renamed successfully",
+        "old_path": old_full_path,
+        "new_path": new_full_path
     }
 
-    list_response = requests.post(list_url, json=payload, headers=headers)
-    if list_response.status_code != 200:
-        raise Exception(f"Failed to list files for renaming: {list_response.text}")
-
-    files_to_move = list_response.json()
-    if not files_to_move:
-        return {"message": "Directory is empty, nothing to rename."}
-
-    # 2. Move each file to the new directory
-    move_url = f"{SUPABASE_URL}/storage/v1/object/move"
-    moved_files = []
-
-    for file in files_to_move:
-        # Skip directories (supabase sometimes returns placeholders)
-        if 'id' not in file or file['id'] is None:
-            continue
-
-        old_file_path = f"{old_full_path}/{file['name']}".strip("/")
-        new_file_path = f"{new_dir_path}/{file['name']}".strip("/")
-
-        move_payload = {
-           "bucketId": SUPABASE_BUCKET,
-           "sourceKey": old_file_path,
-           "destinationKey": new_file_path
-        }
-
-        move_response = requests.post(move_url, json=move_payload, headers=headers)
-
-        if move_response.status_code == 200:
-            moved_files.append({
-                "old_path": old_file_path,
-                "new_path": new_file_path
-            })
-        else:
-            print(f"Failed to move {old_file_path}: {move_response.text}")
-
-    if moved_files:
-        return {
-            "message": f"Successfully renamed directory '{clean_old_dir}' → '{new_dir_name}'",
-            "moved_files": moved_files
-        }
-    else:
-        raise Exception("Failed to move any files. Check logs for details.")
-    
-def get_signed_url_supabase(path: str, token: str):
-   user = get_current_user(token)
+async def get_signed_url_supabase(path: str, user: TokenData):
    user_id = user.user_id
    
    # Sanitize the directory path
    clean_path = path.strip("/").replace("..", "")
    full_path_prefix = f"{user_id}/{clean_path}"  # always end with slash
 
-   expires_in = 60 * 5  # 5 minutes
-
-   url = f"{SUPABASE_URL}/storage/v1/object/sign/{SUPABASE_BUCKET}/{full_path_prefix}"
-   headers = {
-       "apikey": SUPABASE_KEY,
-       "Authorization": f"Bearer {SUPABASE_KEY}"  # use service key here, not user JWT
-   }
-   payload = {"expiresIn": expires_in}
+   cached = signed_url_cache.get(full_path_prefix)
+   if cached is not None:
+       return cached
 
-   response = requests.post(url, headers=headers, json=payload)
+   try:
+       signed_url = await get_storage().sign_url(full_path_prefix, settings.SIGNED_URL_EXPIRES_IN)
+   except Exception as e:
+       raise Exception(f"Failed to get signed URL: {e}")
+   signed_url_cache.set(full_path_prefix, signed_url)
+   return signed_url
 
-   if response.status_code == 200:
-       return f"{SUPABASE_URL}/storage/v1/{response.json().get('signedURL')}"
-   else:
-       raise Exception(f"Failed to get signed URL: {response.text}")
+async def signed_url_encodings(paths: list, user: TokenData) -> dict:
+    """
+    {path: encoding} for those of `paths` whose signed URLs serve compressed
+    bytes. Supabase hands out compressed objects as stored; the local
+    backend's route decodes them itself. The metadata index answers when
+    it's built, otherwise storage is asked, and only while compression is
+    on, since nothing else can have stored an object compressed.
+    """
+    if not get_storage().remote:
+        return {}
+    rel_paths = {}
+    for path in paths:
+        rel_path = path.strip("/").replace("..", "")
+        if compression.is_compressible(mimetypes.guess_type(rel_path)[0]):
+            rel_paths[rel_path] = path
+    if not rel_paths:
+        return {}
+
+    if database_enabled():
+        try:
+            found = await run_db(metadata_index.content_encodings, user.user_id, list(rel_paths))
+        except Exception:
+            logger.exception("Could not read content encodings for user %s", user.user_id)
+            found = None
+        if found is not None:
+            return {rel_paths[rel_path]: encoding for rel_path, encoding in found.items()}
+    if not settings.COMPRESSION_ENABLED:
+        return {}
+
+    semaphore = asyncio.Semaphore(ENCODING_LOOKUP_CONCURRENCY)
+
+    async def lookup(rel_path: str):
+        async with semaphore:
+            try:
+                info = await compression.encoding_info(join_key(user.user_id, rel_path))
+            except Exception:
+                return None
+        return info["encoding"] if info else None
+
+    encodings = await asyncio.gather(*(lookup(rel_path) for rel_path in rel_paths))
+    return {rel_paths[rel_path]: encoding for rel_path, encoding in zip(rel_paths, encodings) if encoding}
+
+async def get_signed_urls_supabase(paths: list, user: TokenData):
+    """
+    Signs many files at once. Cached URLs are served as is and the rest
+    are signed in a single multi-sign call. Returns one
+    {"path", "signed_url", "error"} entry per requested path, in order.
+    """
+    if len(paths) > settings.SIGNED_URL_BATCH_MAX:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {settings.SIGNED_URL_BATCH_MAX} paths can be signed at once"
+        )
+
+    keys = {}
+    for path in paths:
+        keys[path] = f"{user.user_id}/{path.strip('/').replace('..', '')}"
+
+    results = {}
+    missing = []
+    for key in dict.fromkeys(keys.values()):
+        cached = signed_url_cache.get(key)
+        if cached is not None:
+            results[key] = {"signed_url": cached, "error": None}
+        else:
+            missing.append(key)
+
+    if missing:
+        try:
+            signed = await get_storage().sign_urls(missing, settings.SIGNED_URL_EXPIRES_IN)
+        except Exception as e:
+            raise Exception(f"Failed to get signed URLs: {e}")
+
+        for item in signed:
+            key = item.get("path")
+            if item.get("signedURL"):
+                signed_url = item["signedURL"]
+                signed_url_cache.set(key, signed_url)
+                results[key] = {"signed_url": signed_url, "error": None}
+            else:
+                results[key] = {"signed_url": None, "error": item.get("error") or "Failed to sign"}
+
+    signed_paths = [path for path in dict.fromkeys(paths) if results.get(keys[path], {}).get("signed_url")]
+    encodings = await signed_url_encodings(signed_paths, user)
+    return [
+        {
+            "path": path,
+            **results.get(keys[path], {"signed_url": None, "error": "Failed to sign"}),
+            "content_encoding": encodings.get(path),
+        }
+        for path in paths
+    ]
 
-def _auth_headers():
-    return {
-        "apikey": SUPABASE_KEY,
-        "Authorization": f"Bearer {SUPABASE_KEY}",
-        "Content-Type": "application/json",
-    }
 def _safe_join_prefix(prefix: str) -> str:
     # Ensure a single trailing slash on non-empty prefixes
     prefix = prefix.strip("/")
     return f"{prefix}/" if prefix else ""
-def delete_directory_supabase(dir_path: str, token: str):
+async def _list_folder(prefix: str, limit: int = 1000):
+    """
+    Returns every list entry directly inside `prefix` (which must end in
+    '/' unless it is the bucket root), paging through the list API.
+    """
+    entries = []
+    offset = 0
+    while True:
+        try:
+            batch = await get_storage().list_objects(prefix, limit, offset)
+        except Exception as e:
+            raise Exception(f"Failed to list '{prefix}': {e}")
+        entries.extend(item for item in batch if item.get("name"))
+
+        if len(batch) < limit:
+            break
+        offset += limit
+
+    return entries
+
+async def walk_tree(base_prefix: str, max_depth: int = None, concurrency: int = None):
+    """
+    Breadth-first walk below `base_prefix` (which must end in '/') that
+    lists up to `concurrency` sibling folders at once.
+
+    Yields (prefix, depth, entries) for each folder as soon as its listing
+    arrives, so order between siblings is not guaranteed. The base folder is
+    depth 0; folders deeper than `max_depth` are not listed.
+    """
+    concurrency = concurrency or settings.TREE_WALK_CONCURRENCY
+    pending = deque([(base_prefix, 0)])
+    in_flight = {}
+
+    try:
+        while pending or in_flight:
+            while pending and len(in_flight) < concurrency:
+                prefix, depth = pending.popleft()
+                in_flight[asyncio.ensure_future(_list_folder(prefix))] = (prefix, depth)
+
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                prefix, depth = in_flight.pop(task)
+                entries = task.result()
+                if max_depth is None or depth < max_depth:
+                    for item in entries:
+                        # Folders have no id; dive deeper by appending '/'
+                        if item.get("id") is None:
+                            pending.append((_safe_join_prefix(f"{prefix}{item['name']}"), depth + 1))
+                yield prefix, depth, entries
+    finally:
+        for task in in_flight:
+            task.cancel()
+
+async def walk_prefix(base_prefix: str):
+    """
+    Lists everything below `base_prefix` (which must end in '/').
+    Returns (files, folders): files as (full_key, list_item) pairs and
+    folders as fully-qualified keys without a trailing slash.
+    """
+    files = []
+    folders = []
+
+    # Supabase returns both files and folder entries.
+    # Folders generally have `id: null`; files have a UUID `id` and metadata.
+    async for prefix, _, entries in walk_tree(base_prefix):
+        for item in entries:
+            full_key = f"{prefix}{item['name']}"  # <-- CRUCIAL: prepend the current prefix
+            if item.get("id") is None:
+                folders.append(full_key)
+            else:
+                # It's a file (including placeholder files like '.empty')
+                files.append((full_key, item))
+
+    return files, folders
+
+def _tree_node(rel_path: str, depth: int) -> dict:
+    return {
+        "name": rel_path.rpartition("/")[2],
+        "path": rel_path,
+        "size": 0,
+        "file_count": 0,
+        "truncated": True,
+        "folders": [],
+        "depth": depth,
+    }
+
+async def get_directory_tree(dir_path: str, user: TokenData, depth: int = None):
+    """
+    Nested folder tree below `dir_path` with each folder's total size and
+    file count, including everything beneath it that was walked.
+    """
+    user_id = user.user_id
+
+    clean_path = dir_path.strip("/").replace("..", "")
+    base_prefix = _safe_join_prefix(f"{user_id}/{clean_path}")
+
+    nodes = {}
+    async for prefix, level, entries in walk_tree(base_prefix, max_depth=depth):
+        rel_path = prefix[len(user_id) + 1:].strip("/")
+        node = nodes.setdefault(prefix, _tree_node(rel_path, level))
+        # Only folders the depth limit kept us from listing stay truncated
+        node["truncated"] = False
+        for item in entries:
+            if item.get("id") is None:
+                child_prefix = _safe_join_prefix(f"{prefix}{item['name']}")
+                child = nodes.setdefault(child_prefix, _tree_node(f"{rel_path}/{item['name']}".strip("/"), level + 1))
+                node["folders"].append(child)
+            else:
+                node["size"] += _original_size(item) or 0
+                node["file_count"] += 1
+
+    # Roll sizes up from the deepest folders
+    for node in sorted(nodes.values(), key=lambda n: n["depth"], reverse=True):
+        for child in node["folders"]:
+            node["size"] += child["size"]
+            node["file_count"] += child["file_count"]
+            node["truncated"] = node["truncated"] or child["truncated"]
+        node["folders"].sort(key=lambda n: n["name"])
+    for node in nodes.values():
+        del node["depth"]
+
+    return nodes[base_prefix]
+
+async def delete_directory_supabase(dir_path: str, user: TokenData, on_progress=None):
     """
     Recursively deletes all objects under `user_id/dir_path/`.
     Walks subfolders and sends fully-qualified keys to /remove.
+    `on_progress(done, total)` is called after each deleted batch.
     """
-    user = get_current_user(token)
     user_id = user.user_id
 
     clean_path = dir_path.strip("/").replace("..", "")
     base_prefix = _safe_join_prefix(f"{user_id}/{clean_path}")  # e.g. "123/abc/" or "123/"
 
-    list_url = f"{SUPABASE_URL}/storage/v1/object/list/{SUPABASE_BUCKET}"
-    remove_url = f"{SUPABASE_URL}/storage/v1/object/{SUPABASE_BUCKET}"
-    headers = _auth_headers()
-
-    # BFS over folders
-    to_visit = [base_prefix]         # queue of prefixes to list
-    all_files = []                   # fully-qualified keys to delete
-    limit = 1000
-
-    while to_visit:
-        current_prefix = to_visit.pop(0)  # FIFO
-
-        offset = 0
-        while True:
-            payload = {
-                "prefix": current_prefix,  # list within this prefix
-                "limit": limit,
-                "offset": offset,
-                # optional: keep things deterministic
-                "sortBy": {"column": "name", "order": "asc"},
-            }
-
-            resp = requests.post(list_url, json=payload, headers=headers)
-            if resp.status_code != 200:
-                raise Exception(f"Failed to list '{current_prefix}': {resp.status_code} - {resp.text}")
-
-            batch = resp.json() or []
-
-            # Supabase returns both files and folder entries.
-            # Folders generally have `id: null`; files have a UUID `id` and metadata.
-            for item in batch:
-                name = item.get("name") or ""
-                if not name:
-                    continue
-
-                full_key = f"{current_prefix}{name}"  # <-- CRUCIAL: prepend the current prefix
-
-                is_folder = item.get("id") is None  # folders have no id
-                if is_folder:
-                    # Dive deeper: list this subfolder by appending '/'
-                    to_visit.append(_safe_join_prefix(full_key))
-                else:
-                    # It's a file (including placeholder files like '.empty')
-                    all_files.append(full_key)
-
-            if len(batch) < limit:
-                break
-            offset += limit
+    files, _ = await walk_prefix(base_prefix)
+    all_files = [full_key for full_key, _ in files]
 
     if not all_files:
         return {"message": f"Directory empty or not found: {base_prefix}"}
@@ -364,11 +903,83 @@ def delete_directory_supabase(dir_path: str, token: str):
     # Delete in batches to be safe
     batch_size = 1000
     deleted = 0
+    if on_progress:
+        on_progress(deleted, len(all_files))
     for i in range(0, len(all_files), batch_size):
         chunk = all_files[i:i + batch_size]
-        resp = requests.delete(remove_url, json={"prefixes": chunk}, headers=headers)
-        if resp.status_code != 200:
-            raise Exception(f"Failed to delete batch {i//batch_size + 1}: {resp.status_code} - {resp.text}")
+        try:
+            await get_storage().delete_objects(chunk)
+        except Exception as e:
+            raise Exception(f"Failed to delete batch {i//batch_size + 1}: {e}")
+        await forget_objects(chunk)
         deleted += len(chunk)
+        if on_progress:
+            on_progress(deleted, len(all_files))
+
+    await update_index(user_id, metadata_index.remove_tree, clean_path)
+    return {"message": f"Deleted {deleted} objects under {base_prefix}"}
 
-    return {"message": f"Deleted {deleted} objects under {base_prefix}"}
\ No newline at end of file
+_reconciling = set()
+_reconcile_tasks = set()
+# Users whose index was rebuilt lately, so a reconcile that keeps failing
+# isn't retried by every listing
+_recent_reconciles = TTLCache(10000, settings.RECONCILE_COOLDOWN)
+# Walks made before giving up on a user whose files keep changing
+RECONCILE_ATTEMPTS = 3
+
+async def reconcile_user_index(user_id: str) -> int:
+    """
+    Rebuilds a user's metadata index from a full storage walk, walking
+    again if the user's files changed meanwhile. Returns the number of
+    indexed entries.
+    """
+    for attempt in range(RECONCILE_ATTEMPTS):
+        generation = await run_db(metadata_index.index_generation, user_id)
+        entries = await _walk_user_entries(user_id)
+        count = await run_db(metadata_index.replace_user_index, user_id, entries, generation)
+        if count is not None:
+            return count
+        logger.info("Files of user %s changed during reconcile %d, walking again", user_id, attempt + 1)
+    raise Exception(f"Files of user {user_id} kept changing, index left as it was")
+
+async def _walk_user_entries(user_id: str) -> list:
+    # replace_user_index entries for everything under the user's folder
+    base_prefix = _safe_join_prefix(user_id)
+    files, folders = await walk_prefix(base_prefix)
+
+    entries = [{"rel_path": key[len(base_prefix):], "is_dir": True} for key in folders]
+    for full_key, item in files:
+        metadata = item.get("metadata") or {}
+        info = compression.info_from_metadata(item.get("user_metadata"))
+        entries.append({
+            "rel_path": full_key[len(base_prefix):],
+            "is_dir": False,
+            "size": _original_size(item),
+            "mimetype": metadata.get("mimetype"),
+            "etag": metadata.get("eTag"),
+            "updated_at": item.get("updated_at"),
+            "stored_size": metadata.get("size") if info else None,
+            "content_encoding": info["encoding"] if info else None,
+        })
+    return entries
+
+async def list_indexed_users():
+    # Every top-level folder in the bucket belongs to one user
+    return [item["name"] for item in await _list_folder("") if item.get("id") is None]
+
+async def _reconcile_in_background(user_id: str):
+    try:
+        await reconcile_user_index(user_id)
+    except Exception:
+        logger.exception("Background reconcile failed for user %s", user_id)
+    finally:
+        _reconciling.discard(user_id)
+
+def schedule_reconcile(user_id: str):
+    if user_id in _reconciling or _recent_reconciles.get(user_id) is not None:
+        return
+    _reconciling.add(user_id)
+    _recent_reconciles.set(user_id, True)
+    task = asyncio.get_running_loop().create_task(_reconcile_in_background(user_id))
+    _reconcile_tasks.add(task)
+    task.add_done_callback(_reconcile_tasks.discard)
@@ -0,0 +1,267 @@
+"""
+Transparent compression of compressible uploads.
+
+With COMPRESSION_ENABLED, text, CSV, JSON and XML uploads are compressed
+with COMPRESSION_ENCODING ("gzip", or "zstd" with the zstandard package
+installed) on their way to storage. Office documents are left alone, they
+are deflated ZIP containers already. The first COMPRESSION_SAMPLE_SIZE
+bytes are compressed as a probe beforehand, and the file is stored as is
+when they don't shrink to COMPRESSION_MAX_RATIO of their size. The encoding and original size are kept in the object's
+metadata and in the metadata index, which the per-user savings report
+reads.
+
+Whatever reads an object asks encoding_info() how it is stored, then
+decodes it on the fly or hands the stored bytes to a client that accepts
+the encoding.
+"""
+import mimetypes
+import zlib
+
+import anyio
+
+from ..cache import TTLCache
+from ..config import get_settings
+from ..metrics import Counter
+from .storage import get_storage
+
+settings = get_settings()
+
+# Besides text/*. Reads check these whatever COMPRESSION_ENABLED says, so
+# turning it off never strands objects that were stored compressed.
+COMPRESSIBLE_TYPES = frozenset({
+    "application/json",
+    "application/x-ndjson",
+    "application/xml",
+    "application/javascript",
+    "application/sql",
+    "application/yaml",
+    "application/x-yaml",
+    "image/svg+xml",
+})
+ENCODINGS = ("gzip", "zstd")
+# Encoded objects start with these; anything else is served as stored
+_MAGIC = {"gzip": b"\x1f\x8b", "zstd": b"\x28\xb5\x2f\xfd"}
+# Decoders hand back at most this much at a time, however well the input compressed
+DECODE_CHUNK = 256 * 1024
+# How long an object's encoding is remembered. Keys are only reused after
+# a delete, so this just bounds how stale another worker's view can be.
+INFO_TTL = 60
+
+# Object key -> {"encoding", "size"}, or {} for objects stored as is
+_info = TTLCache(100000, INFO_TTL)
+
+COMPRESSED_ORIGINAL_BYTES = Counter(
+    "filenest_compression_original_bytes_total", "Size of uploads stored compressed, before compression.",
+    ("encoding",),
+)
+COMPRESSED_STORED_BYTES = Counter(
+    "filenest_compression_stored_bytes_total", "Size of uploads stored compressed, as stored.", ("encoding",),
+)
+COMPRESSION_SKIPPED = Counter(
+    "filenest_compression_skipped_total", "Compressible uploads stored as is.", ("reason",),
+)
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception("zstd needs the zstandard package")
+    return zstandard
+
+def is_compressible(content_type: str) -> bool:
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    return content_type.startswith("text/") or content_type in COMPRESSIBLE_TYPES
+
+
+class _GzipEncoder:
+
+    def __init__(self, level: int):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush()
+
+
+class _ZstdEncoder:
+    # Every chunk becomes a frame of its own, so decoding never holds more
+    # than one chunk's worth of output
+    def __init__(self, level: int):
+        self._compressor = _zstandard().ZstdCompressor(level=level)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return b""
+
+
+class _GzipDecoder:
+
+    def __init__(self):
+        self._decompressor = zlib.decompressobj(31)
+        self._pending = b""
+
+    def feed(self, data: bytes):
+        self._pending = data
+
+    def read(self) -> bytes:
+        # b"" once the input fed so far is used up
+        out = b""
+        while not out and self._pending and not self._decompressor.eof:
+            out = self._decompressor.decompress(self._pending, DECODE_CHUNK)
+            self._pending = self._decompressor.unconsumed_tail
+        return out
+
+
+class _ZstdDecoder:
+
+    def __init__(self):
+        self._new = _zstandard().ZstdDecompressor().decompressobj
+        self._decompressor = self._new()
+        self._pending = b""
+
+    def feed(self, data: bytes):
+        self._pending = data
+
+    def read(self) -> bytes:
+        out = b""
+        while not out and self._pending:
+            out = self._decompressor.decompress(self._pending)
+            self._pending = b""
+            if self._decompressor.eof:
+                self._pending = self._decompressor.unused_data
+                self._decompressor = self._new()
+        return out
+
+
+_ENCODERS = {"gzip": _GzipEncoder, "zstd": _ZstdEncoder}
+_DECODERS = {"gzip": _GzipDecoder, "zstd": _ZstdDecoder}
+
+
+def _ratio(sample: bytes, encoding: str) -> float:
+    encoder = _ENCODERS[encoding](settings.COMPRESSION_LEVEL)
+    return (len(encoder.compress(sample)) + len(encoder.flush())) / len(sample)
+
+def should_probe(content_type: str, size: int) -> bool:
+    # Whether an upload is a candidate for compression at all
+    if not settings.COMPRESSION_ENABLED or not is_compressible(content_type):
+        return False
+    if size is not None and size < settings.COMPRESSION_MIN_SIZE:
+        COMPRESSION_SKIPPED.inc(reason="small")
+        return False
+    return True
+
+async def choose_encoding(sample: bytes):
+    """
+    The encoding to store an upload with, or None to store it as is.
+    `sample` is the start of the file, compressed to see how well it does.
+    """
+    if not sample:
+        return None
+    encoding = settings.COMPRESSION_ENCODING
+    ratio = await anyio.to_thread.run_sync(_ratio, sample[:settings.COMPRESSION_SAMPLE_SIZE], encoding)
+    if ratio > settings.COMPRESSION_MAX_RATIO:
+        COMPRESSION_SKIPPED.inc(reason="ratio")
+        return None
+    return encoding
+
+async def compress_stream(body, encoding: str, counts: dict):
+    """
+    Passes `body` through compressed with `encoding`, off the event loop.
+    Adds the bytes read and written to counts["original"] and counts["stored"].
+    """
+    encoder = _ENCODERS[encoding](settings.COMPRESSION_LEVEL)
+    async for chunk in body:
+        counts["original"] += len(chunk)
+        out = await anyio.to_thread.run_sync(encoder.compress, chunk)
+        if out:
+            counts["stored"] += len(out)
+            yield out
+    out = encoder.flush()
+    if out:
+        counts["stored"] += len(out)
+        yield out
+
+async def decode_stream(body, encoding: str):
+    # Passes `body` through decoded, unless it turns out not to be encoded after all
+    decoder = None
+    async for chunk in body:
+        if not chunk:
+            continue
+        if decoder is None:
+            if not chunk.startswith(_MAGIC[encoding]):
+                yield chunk
+                async for chunk in body:
+                    yield chunk
+                return
+            decoder = _DECODERS[encoding]()
+        decoder.feed(chunk)
+        while True:
+            out = await anyio.to_thread.run_sync(decoder.read)
+            if not out:
+                break
+            yield out
+
+
+def stored_metadata(encoding: str, size: int) -> dict:
+    # What goes into the object's metadata alongside the compressed bytes
+    return {"content_encoding": encoding, "original_size": size}
+
+def info_from_metadata(metadata: dict):
+    metadata = metadata or {}
+    if metadata.get("content_encoding") not in ENCODINGS:
+        return None
+    return {"encoding": metadata["content_encoding"], "size": metadata.get("original_size")}
+
+def remember(key: str, info: dict = None):
+    _info.set(key, info or {})
+
+def forget(keys: list):
+    for key in keys:
+        _info.pop(key)
+
+def record_compressed(key: str, encoding: str, counts: dict):
+    remember(key, {"encoding": encoding, "size": counts["original"]})
+    COMPRESSED_ORIGINAL_BYTES.inc(counts["original"], encoding=encoding)
+    COMPRESSED_STORED_BYTES.inc(counts["stored"], encoding=encoding)
+
+async def encoding_info(key: str, content_type: str = None):
+    """
+    How the object at `key` is stored: {"encoding", "size"} with its
+    original size, or None when it is stored as is. Pass the stored
+    mimetype when there is one; otherwise the name decides whether the
+    object could have been compressed at all.
+    """
+    if not is_compressible(content_type or mimetypes.guess_type(key)[0]):
+        return None
+    info = _info.get(key)
+    if info is None:
+        info = info_from_metadata(await get_storage().object_metadata(key)) or {}
+        _info.set(key, info)
+    return info or None
+
+
+def accepts(request_headers, encoding: str) -> bool:
+    # Whether the client's Accept-Encoding allows `encoding`
+    for item in request_headers.get("accept-encoding", "").split(","):
+        name, _, params = item.partition(";")
+        if name.strip().lower() != encoding:
+            continue
+        params = params.strip().replace(" ", "")
+        if params.startswith("q="):
+            try:
+                return float(params[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+def encoded_etag(etag: str, encoding: str) -> str:
+    # The stored bytes are a different representation from the decoded ones
+    if not etag:
+        return etag
+    return f'{etag[:-1]}-{encoding}"' if etag.endswith('"') else f"{etag}-{encoding}"
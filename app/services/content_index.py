@@ -0,0 +1,49 @@
+"""
+SHA-256 -> storage key lookups for upload dedup (see models.CONTENT_INDEX).
+Functions are blocking; call them through database.run_db from async code.
+"""
+from ..database import get_connection
+
+
+def find_object(scope: str, sha256: str, size: int):
+    # Returns (object_key, mimetype) or None
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            "SELECT object_key, mimetype FROM content_index WHERE scope = %s AND sha256 = %s AND size = %s",
+            (scope, sha256, size),
+        )
+        return cur.fetchone()
+
+def known_hashes(scope: str, hashes: list) -> set:
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            "SELECT DISTINCT sha256 FROM content_index WHERE scope = %s AND sha256 = ANY(%s)",
+            (scope, list(hashes)),
+        )
+        return {row[0] for row in cur.fetchall()}
+
+def record_content(scope: str, sha256: str, size: int, object_key: str, mimetype: str = None):
+    # The newest copy wins, it is the least likely to have been deleted since
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO content_index (scope, sha256, size, object_key, mimetype)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (scope, sha256, size) DO UPDATE
+            SET object_key = EXCLUDED.object_key, mimetype = EXCLUDED.mimetype, updated_at = now()
+            """,
+            (scope, sha256, size, object_key, mimetype),
+        )
+
+def forget_objects(object_keys: list):
+    # Entries pointing at objects that were deleted or moved away
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute("DELETE FROM content_index WHERE object_key = ANY(%s)", (list(object_keys),))
+
+def forget_content(scope: str, sha256: str, size: int, object_key: str):
+    # Drop a stale entry whose object is gone from storage
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            "DELETE FROM content_index WHERE scope = %s AND sha256 = %s AND size = %s AND object_key = %s",
+            (scope, sha256, size, object_key),
+        )
@@ -0,0 +1,281 @@
+"""
+Recursive directory rename.
+
+Storage has no folder rename, so every object below the old prefix is moved
+one by one, RENAME_CONCURRENCY at a time. Each outcome is appended to a
+JSONL journal under RENAME_JOURNAL_DIR so an interrupted or partly failed
+rename can be inspected, resumed or rolled back later.
+
+Every entry point takes an optional `on_progress(done, total, error=None)`
+callback, called once per finished move.
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+
+from fastapi import HTTPException, status
+from starlette.concurrency import run_in_threadpool
+
+from . import metadata_index
+from .cloud import move_object, update_index, walk_prefix
+from ..config import get_settings
+from ..schemas import TokenData
+
+settings = get_settings()
+JOURNAL_DIR = settings.RENAME_JOURNAL_DIR
+
+
+# A failed attempt journaled after a successful one doesn't undo it
+_NO_DOWNGRADE = {"failed": "moved", "rollback_failed": "rolled_back"}
+_ROLLED_BACK = ("rolled_back", "rollback_partial")
+
+
+class _Journal:
+    """
+    Appends events to a rename's JSONL journal. Writes run in the
+    threadpool, off the event loop, one at a time.
+    """
+
+    def __init__(self, path: str):
+        self._file = open(path, "a")
+        self._lock = threading.Lock()
+
+    def _write(self, line: str):
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    async def append(self, event: dict):
+        await run_in_threadpool(self._write, json.dumps(event) + "\n")
+
+    def close(self):
+        self._file.close()
+
+
+def _journal_path(rename_id: str) -> str:
+    if not rename_id.isalnum():
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Rename not found")
+    return os.path.join(JOURNAL_DIR, f"{rename_id}.jsonl")
+
+def _read_journal(rename_id: str, user_id: str) -> list:
+    try:
+        with open(_journal_path(rename_id)) as f:
+            events = [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Rename not found")
+    if not events or events[0].get("user_id") != user_id:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Rename not found")
+    return events
+
+def _purge_old_journals():
+    if not os.path.isdir(JOURNAL_DIR):
+        return
+    cutoff = time.time() - settings.RENAME_JOURNAL_TTL_HOURS * 3600
+    for name in os.listdir(JOURNAL_DIR):
+        path = os.path.join(JOURNAL_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except FileNotFoundError:
+            continue
+
+def _summarize(events: list) -> dict:
+    start = events[0]
+    # Latest outcome per original key wins, except that a failure never
+    # hides an earlier success of the same kind
+    objects = {}
+    for event in events[1:]:
+        if event["event"] in ("object", "rollback"):
+            previous = objects.get(event["old"])
+            if previous and previous["status"] == _NO_DOWNGRADE.get(event["status"]):
+                continue
+            objects[event["old"]] = event
+
+    counts = {"moved": 0, "failed": 0, "rolled_back": 0, "rollback_failed": 0}
+    for outcome in objects.values():
+        counts[outcome["status"]] += 1
+
+    finishes = [event for event in events if event["event"] == "finish"]
+    state = finishes[-1]["status"] if finishes else "running"
+
+    return {
+        "rename_id": start["rename_id"],
+        "status": state,
+        "old_path": start["old_prefix"],
+        "new_path": start["new_prefix"],
+        **counts,
+        "objects": [
+            {
+                "old_path": outcome["old"],
+                "new_path": outcome["new"],
+                "status": outcome["status"],
+                "error": outcome.get("error"),
+            }
+            for outcome in objects.values()
+        ],
+    }
+
+async def _move_all(journal: _Journal, moves: list, event: str, ok_status: str, failed_status: str, on_progress=None):
+    """
+    Runs every (source, destination, old_path, new_path) move through a
+    fixed pool of workers and journals each outcome against the object's
+    original old/new paths. Returns the (source, destination) pairs that
+    succeeded.
+    """
+    pending = iter(moves)
+    succeeded = []
+    done = 0
+
+    async def worker():
+        nonlocal done
+        # Workers share one iterator, so each move is taken exactly once
+        for source, destination, old_path, new_path in pending:
+            outcome = {"event": event, "old": old_path, "new": new_path}
+            try:
+                await move_object(source, destination)
+                outcome["status"] = ok_status
+                succeeded.append((source, destination))
+            except Exception as e:
+                outcome.update(status=failed_status, error=str(e))
+            await journal.append(outcome)
+            done += 1
+            if on_progress:
+                on_progress(done, len(moves), outcome.get("error"))
+
+    if on_progress:
+        on_progress(0, len(moves))
+    workers = min(settings.RENAME_CONCURRENCY, len(moves))
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    return succeeded
+
+async def _run_moves(rename_id: str, events: list, user_id: str, on_progress=None) -> dict:
+    start = events[0]
+    old_prefix, new_prefix = start["old_prefix"], start["new_prefix"]
+
+    # Whatever is still under the old prefix still needs moving, which makes
+    # a resume just another pass of the same loop.
+    files, _ = await walk_prefix(f"{old_prefix}/")
+    moves = []
+    for key, _ in files:
+        new_key = f"{new_prefix}{key[len(old_prefix):]}"
+        moves.append((key, new_key, key, new_key))
+
+    journal = _Journal(_journal_path(rename_id))
+    try:
+        succeeded = await _move_all(journal, moves, "object", "moved", "failed", on_progress)
+        state = "completed" if len(succeeded) == len(moves) else "partial"
+        await journal.append({"event": "finish", "status": state})
+    finally:
+        journal.close()
+
+    first_run = len(events) == 1
+    rel = len(user_id) + 1
+    if first_run and state == "completed":
+        await update_index(user_id, metadata_index.move_tree, old_prefix[rel:], new_prefix[rel:])
+    else:
+        # A pass cut off before its index update left its moves journaled
+        # but unindexed; move_objects is safe to repeat for the rest
+        earlier = [] if first_run else [
+            (o["old_path"], o["new_path"]) for o in _summarize(events)["objects"] if o["status"] == "moved"
+        ]
+        moved = earlier + succeeded
+        if moved:
+            await update_index(user_id, metadata_index.move_objects, [(s[rel:], d[rel:]) for s, d in moved])
+
+    return _summarize(_read_journal(rename_id, user_id))
+
+
+async def rename_directory(old_dir_path: str, new_dir_name: str, user: TokenData, on_progress=None, rename_id: str = None):
+    user_id = user.user_id
+
+    # Sanitize paths
+    clean_old_dir = old_dir_path.strip("/").replace("..", "")
+    new_dir_name = new_dir_name.strip("/").replace("..", "")
+    if not clean_old_dir or not new_dir_name or "/" in new_dir_name:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid directory name")
+
+    # Add base path with user_id
+    old_full_path = f"{user_id}/{clean_old_dir}"
+
+    # Extract parent path (under user_id) and build new path
+    parent_path = os.path.dirname(old_full_path)
+    new_dir_path = f"{parent_path}/{new_dir_name}"
+
+    _purge_old_journals()
+    os.makedirs(JOURNAL_DIR, exist_ok=True)
+
+    rename_id = rename_id or uuid.uuid4().hex
+    start = {
+        "event": "start",
+        "rename_id": rename_id,
+        "user_id": user_id,
+        "old_prefix": old_full_path,
+        "new_prefix": new_dir_path,
+        "created_at": time.time(),
+    }
+    journal = _Journal(_journal_path(rename_id))
+    try:
+        await journal.append(start)
+    finally:
+        journal.close()
+
+    result = await _run_moves(rename_id, [start], user_id, on_progress)
+
+    if result["moved"] == 0 and result["failed"] == 0:
+        return {**result, "message": "Directory is empty, nothing to rename."}
+    if result["moved"] == 0:
+        raise Exception(f"Failed to move any files (rename {rename_id}). Check its status for details.")
+
+    return {
+        **result,
+        "message": f"Successfully renamed directory '{clean_old_dir}' → '{new_dir_name}'"
+        if result["status"] == "completed"
+        else f"Renamed directory '{clean_old_dir}' → '{new_dir_name}' with {result['failed']} failures, resume rename {rename_id} to retry",
+        "moved_files": [
+            {"old_path": o["old_path"], "new_path": o["new_path"]}
+            for o in result["objects"] if o["status"] == "moved"
+        ],
+    }
+
+def rename_exists(rename_id: str) -> bool:
+    return os.path.exists(_journal_path(rename_id))
+
+def get_rename_status(rename_id: str, user: TokenData):
+    return _summarize(_read_journal(rename_id, user.user_id))
+
+def check_resumable(rename_id: str, user: TokenData) -> list:
+    # The rename's journal, once it's known to be one that can be resumed
+    events = _read_journal(rename_id, user.user_id)
+    if _summarize(events)["status"] in _ROLLED_BACK:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Rename was rolled back and can't be resumed")
+    return events
+
+async def resume_rename(rename_id: str, user: TokenData, on_progress=None):
+    events = check_resumable(rename_id, user)
+    return await _run_moves(rename_id, events, user.user_id, on_progress)
+
+async def rollback_rename(rename_id: str, user: TokenData, on_progress=None):
+    user_id = user.user_id
+    summary = _summarize(_read_journal(rename_id, user_id))
+
+    # Move back everything this rename has moved so far
+    moves = [
+        (o["new_path"], o["old_path"], o["old_path"], o["new_path"])
+        for o in summary["objects"] if o["status"] in ("moved", "rollback_failed")
+    ]
+
+    journal = _Journal(_journal_path(rename_id))
+    try:
+        succeeded = await _move_all(journal, moves, "rollback", "rolled_back", "rollback_failed", on_progress)
+        await journal.append({"event": "finish", "status": "rolled_back" if len(succeeded) == len(moves) else "rollback_partial"})
+    finally:
+        journal.close()
+
+    if succeeded:
+        rel = len(user_id) + 1
+        await update_index(user_id, metadata_index.move_objects, [(s[rel:], d[rel:]) for s, d in succeeded])
+
+    return _summarize(_read_journal(rename_id, user_id))
@@ -0,0 +1,494 @@
+"""
+Background jobs for long-running file operations.
+
+Recursive deletes and renames can outlive a request, so the routes only
+submit a job and return its id. Jobs run on a small pool of asyncio
+workers, or in a process pool when JOB_BACKEND is "process", and every job
+is a JSON file under JOB_DIR. A job whose operation finished with errors
+on some objects ends up "partial".
+
+The queue lives in the app process, so it needs a long-lived one (uvicorn
+or gunicorn on a server or container) with a writable JOB_DIR. It does not
+work on serverless hosts such as Vercel: the filesystem outside /tmp is
+read-only there and the instance is frozen once the response is sent, so a
+submitted job would never make progress.
+
+Each app process that runs jobs is an owner with a directory under
+JOB_DIR/owners holding one claim file per job it has queued or running.
+The owner touches its heartbeat file to renew the lease on all of them.
+Once an owner has missed JOB_LEASE_SECONDS of heartbeats, whichever live
+process notices first moves its claims into its own directory and runs
+those jobs. Moving a claim is an atomic rename, so a job is only ever
+picked up by one process, and several workers can share JOB_DIR.
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from fastapi import HTTPException, status
+
+from ..config import get_settings
+from ..schemas import TokenData
+from .clients import close_http_client
+from .cloud import delete_directory_supabase, forget_objects, removal_listeners
+from .dir_rename import rename_directory, rename_exists, resume_rename, rollback_rename
+from .tagger import retag_directory
+
+settings = get_settings()
+JOB_DIR = settings.JOB_DIR
+logger = logging.getLogger(__name__)
+
+# Only the first few errors are kept on the job, the rest are just counted
+MAX_JOB_ERRORS = 50
+# Progress is written to disk at most this often
+PROGRESS_INTERVAL = 0.5
+# Told to users at JOB_MAX_ACTIVE_PER_USER; jobs take a while to finish
+JOB_RETRY_AFTER = 5
+FINISHED_STATUSES = ("succeeded", "partial", "failed")
+OWNERS_DIR = os.path.join(JOB_DIR, "owners")
+HEARTBEAT = ".heartbeat"
+# A process restarted under the same pid is a new owner
+OWNER_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+_queue: asyncio.Queue = None
+_workers = []
+_lease_keeper: asyncio.Task = None
+_process_pool = None
+# user_id -> jobs queued or running
+_active = {}
+
+
+def _job_path(job_id: str) -> str:
+    if not job_id.isalnum():
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+    return os.path.join(JOB_DIR, f"{job_id}.json")
+
+def _save_job(job: dict):
+    # Write then rename, so readers never see a half-written job
+    path = _job_path(job["job_id"])
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(job, f)
+    os.replace(tmp_path, path)
+
+def _load_job(job_id: str):
+    try:
+        with open(_job_path(job_id)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def _purge_old_jobs():
+    cutoff = time.time() - settings.JOB_TTL_HOURS * 3600
+    for name in os.listdir(JOB_DIR):
+        path = os.path.join(JOB_DIR, name)
+        try:
+            if os.path.isfile(path) and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except FileNotFoundError:
+            continue
+
+def _claim_path(job_id: str, owner: str = OWNER_ID) -> str:
+    return os.path.join(OWNERS_DIR, owner, job_id)
+
+def _heartbeat():
+    # Renews the lease on every job this process has claimed
+    owner_dir = os.path.join(OWNERS_DIR, OWNER_ID)
+    os.makedirs(owner_dir, exist_ok=True)
+    path = os.path.join(owner_dir, HEARTBEAT)
+    with open(path, "a"):
+        pass
+    os.utime(path)
+
+def _claim(job_id: str):
+    open(_claim_path(job_id), "x").close()
+
+def _release(job_id: str):
+    try:
+        os.remove(_claim_path(job_id))
+    except FileNotFoundError:
+        pass
+
+def _last_seen(owner_dir: str) -> float:
+    # A new owner's directory counts as a heartbeat until it writes one
+    seen = 0.0
+    for path in (owner_dir, os.path.join(owner_dir, HEARTBEAT)):
+        try:
+            seen = max(seen, os.path.getmtime(path))
+        except FileNotFoundError:
+            continue
+    return seen
+
+def _take_over_expired() -> list:
+    """
+    Moves the claims of every owner whose lease ran out to this process
+    and returns their job ids. Renames are atomic, so when several
+    processes do this at once each claim still ends up with just one.
+    """
+    cutoff = time.time() - settings.JOB_LEASE_SECONDS
+    taken = []
+    for owner in os.listdir(OWNERS_DIR):
+        owner_dir = os.path.join(OWNERS_DIR, owner)
+        if owner == OWNER_ID or _last_seen(owner_dir) >= cutoff:
+            continue
+        try:
+            names = os.listdir(owner_dir)
+        except FileNotFoundError:
+            continue
+        for name in names:
+            if name == HEARTBEAT:
+                continue
+            try:
+                os.rename(os.path.join(owner_dir, name), _claim_path(name))
+            except FileNotFoundError:
+                continue
+            taken.append(name)
+        for remove, path in ((os.remove, os.path.join(owner_dir, HEARTBEAT)), (os.rmdir, owner_dir)):
+            try:
+                remove(path)
+            except OSError:
+                pass
+    return taken
+
+def _public(job: dict) -> dict:
+    progress = job["progress"]
+    started_at = job.get("started_at")
+    elapsed = None
+    if started_at:
+        elapsed = (job.get("finished_at") or time.time()) - started_at
+    return {
+        "job_id": job["job_id"],
+        "kind": job["kind"],
+        "status": job["status"],
+        "params": {k: v for k, v in job["params"].items() if k != "user_id"},
+        "progress": progress,
+        "elapsed_seconds": elapsed,
+        "throughput": progress["done"] / elapsed if elapsed else None,
+        "errors": job["errors"],
+        "result": job.get("result"),
+        "created_at": job["created_at"],
+        "started_at": started_at,
+        "finished_at": job.get("finished_at"),
+    }
+
+
+class _ClaimLost(Exception):
+    # Another process took the job over, so this one must stop running it
+    pass
+
+
+class _Progress:
+    """
+    The on_progress(done, total, error=None) callback handed to the file
+    operations. Counts are kept on the job and flushed to disk in batches,
+    as long as this process still holds the job's claim.
+    """
+
+    def __init__(self, job: dict, claim_path: str):
+        self.job = job
+        self.claim_path = claim_path
+        self._saved_at = 0.0
+
+    def __call__(self, done: int, total: int, error: str = None):
+        progress = self.job["progress"]
+        progress.update(done=done, total=total)
+        if error:
+            progress["failed"] += 1
+            if len(self.job["errors"]) < MAX_JOB_ERRORS:
+                self.job["errors"].append(error)
+        if time.monotonic() - self._saved_at >= PROGRESS_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if not os.path.exists(self.claim_path):
+            raise _ClaimLost()
+        _save_job(self.job)
+        self._saved_at = time.monotonic()
+
+
+def _job_user(params: dict) -> TokenData:
+    # Jobs act for the user by id alone; their session token is never written to disk
+    return TokenData(user_id=params["user_id"], session_id="")
+
+async def _delete_dir(job: dict, progress: _Progress):
+    params = job["params"]
+    user = _job_user(params)
+    return await delete_directory_supabase(params["dir_path"], user, on_progress=progress)
+
+async def _rename_dir(job: dict, progress: _Progress):
+    params = job["params"]
+    user = _job_user(params)
+    # The rename shares the job's id, so a job that was interrupted
+    # mid-rename resumes from its journal instead of starting over
+    if rename_exists(job["job_id"]):
+        return await resume_rename(job["job_id"], user, on_progress=progress)
+    return await rename_directory(
+        params["old_dir_path"], params["new_dir_name"], user,
+        on_progress=progress, rename_id=job["job_id"]
+    )
+
+async def _resume_rename(job: dict, progress: _Progress):
+    return await resume_rename(job["job_id"], _job_user(job["params"]), on_progress=progress)
+
+async def _rollback_rename(job: dict, progress: _Progress):
+    return await rollback_rename(job["job_id"], _job_user(job["params"]), on_progress=progress)
+
+async def _retag(job: dict, progress: _Progress):
+    params = job["params"]
+    return await retag_directory(params["user_id"], params["dir_path"], on_progress=progress)
+
+JOB_HANDLERS = {
+    "delete_dir": _delete_dir,
+    "rename_dir": _rename_dir,
+    "resume_rename": _resume_rename,
+    "rollback_rename": _rollback_rename,
+    "retag": _retag,
+}
+
+
+async def _execute(job_id: str, claim_path: str):
+    job = _load_job(job_id)
+    if job is None or job["status"] in FINISHED_STATUSES:
+        return
+    job.update(status="running", started_at=job.get("started_at") or time.time())
+    progress = _Progress(job, claim_path)
+
+    try:
+        progress.flush()
+        try:
+            job["result"] = await JOB_HANDLERS[job["kind"]](job, progress)
+            job["status"] = "partial" if job["errors"] or job["progress"]["failed"] else "succeeded"
+        except _ClaimLost:
+            raise
+        except HTTPException as e:
+            job["status"] = "failed"
+            job["errors"].append(str(e.detail))
+        except Exception as e:
+            logger.exception("Job %s failed", job_id)
+            job["status"] = "failed"
+            job["errors"].append(str(e))
+        job["finished_at"] = time.time()
+        progress.flush()
+    except _ClaimLost:
+        logger.warning("Job %s was taken over by another process, stopping", job_id)
+
+def _execute_in_process(job_id: str, claim_path: str) -> list:
+    """
+    Runs in a pool process, with its own event loop and HTTP client.
+    Returns the keys the job deleted or moved away, so the parent can drop
+    them from its own caches.
+    """
+    removed = []
+    listener = removed.extend
+    removal_listeners.append(listener)
+
+    async def main():
+        try:
+            await _execute(job_id, claim_path)
+        finally:
+            await close_http_client()
+    try:
+        asyncio.run(main())
+    finally:
+        removal_listeners.remove(listener)
+    return removed
+
+def _new_process_pool() -> ProcessPoolExecutor:
+    # spawn, not fork: the parent already has an event loop and threads
+    return ProcessPoolExecutor(
+        max_workers=settings.JOB_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+
+def _replace_broken_pool(pool: ProcessPoolExecutor):
+    # Every job in a broken pool fails at once; only the first one replaces it
+    global _process_pool
+    if _process_pool is pool:
+        pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = _new_process_pool()
+
+def _fail_crashed(job_id: str, claim_path: str, error: str):
+    # Ends a job whose worker process died, so it doesn't stay "running"
+    job = _load_job(job_id)
+    if job is None or job["status"] in FINISHED_STATUSES:
+        return
+    job["status"] = "failed"
+    job["errors"].append(error)
+    job["finished_at"] = time.time()
+    try:
+        _Progress(job, claim_path).flush()
+    except _ClaimLost:
+        pass
+
+def _enqueue(job: dict):
+    user_id = job["params"]["user_id"]
+    _active[user_id] = _active.get(user_id, 0) + 1
+    _queue.put_nowait((job["job_id"], user_id))
+
+def _finished(user_id: str):
+    _active[user_id] -= 1
+    if not _active[user_id]:
+        del _active[user_id]
+
+async def _worker():
+    while True:
+        job_id, user_id = await _queue.get()
+        claim_path = _claim_path(job_id)
+        try:
+            if _process_pool is not None:
+                pool = _process_pool
+                try:
+                    removed = await asyncio.get_running_loop().run_in_executor(
+                        pool, _execute_in_process, job_id, claim_path
+                    )
+                    await forget_objects(removed)
+                except BrokenProcessPool:
+                    # A worker died (most likely killed for memory); start afresh
+                    logger.error("Worker process of job %s died", job_id)
+                    _replace_broken_pool(pool)
+                    _fail_crashed(job_id, claim_path, "Job worker process crashed")
+            else:
+                await _execute(job_id, claim_path)
+        except Exception:
+            logger.exception("Job %s crashed", job_id)
+        finally:
+            # A job that crashed stays claimed, rather than run again now
+            job = _load_job(job_id)
+            if job is None or job["status"] in FINISHED_STATUSES:
+                _release(job_id)
+            _finished(user_id)
+            _queue.task_done()
+
+def _adopt_expired():
+    # Queues the unfinished jobs of owners whose lease ran out, oldest first
+    unfinished = []
+    for job_id in _take_over_expired():
+        job = _load_job(job_id)
+        if job and job["status"] not in FINISHED_STATUSES:
+            unfinished.append(job)
+        else:
+            _release(job_id)
+    for job in sorted(unfinished, key=lambda j: j["created_at"]):
+        logger.info("Taking over %s job %s", job["kind"], job["job_id"])
+        _enqueue(job)
+
+async def _keep_lease():
+    while True:
+        try:
+            _heartbeat()
+            _adopt_expired()
+        except Exception:
+            logger.exception("Could not renew the job lease")
+        await asyncio.sleep(settings.JOB_LEASE_SECONDS / 4)
+
+
+async def start_job_runner():
+    global _queue, _process_pool, _lease_keeper
+    os.makedirs(JOB_DIR, exist_ok=True)
+    _purge_old_jobs()
+    _heartbeat()
+
+    _queue = asyncio.Queue()
+    if settings.JOB_BACKEND == "process":
+        _process_pool = _new_process_pool()
+    _workers.extend(asyncio.create_task(_worker()) for _ in range(settings.JOB_WORKERS))
+    # Also picks up what a previous run of this app left unfinished, once
+    # its lease has run out
+    _lease_keeper = asyncio.create_task(_keep_lease())
+
+async def stop_job_runner():
+    global _queue, _process_pool, _lease_keeper
+    # Unfinished jobs keep their claims and are taken over by another
+    # process, or the next start, once the lease runs out
+    for task in (*_workers, _lease_keeper):
+        task.cancel()
+    await asyncio.gather(*_workers, _lease_keeper, return_exceptions=True)
+    _workers.clear()
+    _lease_keeper = None
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+    _queue = None
+    _active.clear()
+
+def _claimed_anywhere(job_id: str) -> bool:
+    return any(os.path.exists(_claim_path(job_id, owner)) for owner in os.listdir(OWNERS_DIR))
+
+def _replace_finished_job(job: dict, user: TokenData):
+    """
+    Saves `job` over the finished job with the same id. Refused with 409
+    while that job is queued, running, or still claimed by a process
+    wrapping it up. The marker file makes check and replace one step
+    between processes.
+    """
+    conflict = HTTPException(status_code=status.HTTP_409_CONFLICT, detail="A job on this rename is still in progress")
+    marker = f"{_job_path(job['job_id'])}.replacing"
+    try:
+        open(marker, "x").close()
+    except FileExistsError:
+        raise conflict
+    try:
+        current = _load_job(job["job_id"])
+        if current is not None and current["params"]["user_id"] != user.user_id:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+        if (current is not None and current["status"] not in FINISHED_STATUSES) or _claimed_anywhere(job["job_id"]):
+            raise conflict
+        _claim(job["job_id"])
+        _save_job(job)
+    finally:
+        os.remove(marker)
+
+def submit_job(kind: str, params: dict, user: TokenData, job_id: str = None) -> dict:
+    """
+    Queues a job and returns its public view. Passing the `job_id` of a
+    finished job runs a new operation under the same id, the way resuming
+    or rolling back a rename does.
+    """
+    if _queue is None:
+        raise Exception("Job runner is not running")
+    limit = settings.JOB_MAX_ACTIVE_PER_USER
+    if limit > 0 and _active.get(user.user_id, 0) >= limit:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many jobs in progress",
+            headers={"Retry-After": str(JOB_RETRY_AFTER)},
+        )
+    job = {
+        "job_id": job_id or uuid.uuid4().hex,
+        "kind": kind,
+        "status": "queued",
+        "params": {**params, "user_id": user.user_id},
+        "progress": {"done": 0, "total": None, "failed": 0},
+        "errors": [],
+        "created_at": time.time(),
+    }
+    if job_id is None:
+        _claim(job["job_id"])
+        _save_job(job)
+    else:
+        _replace_finished_job(job, user)
+    _enqueue(job)
+    return _public(job)
+
+def get_job(job_id: str, user: TokenData) -> dict:
+    job = _load_job(job_id)
+    if job is None or job["params"]["user_id"] != user.user_id:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+    return _public(job)
+
+def list_jobs(user: TokenData) -> list:
+    jobs = []
+    if os.path.isdir(JOB_DIR):
+        for name in os.listdir(JOB_DIR):
+            if name.endswith(".json"):
+                job = _load_job(name[:-len(".json")])
+                if job and job["params"]["user_id"] == user.user_id:
+                    jobs.append(_public(job))
+    return sorted(jobs, key=lambda j: j["created_at"], reverse=True)
@@ -0,0 +1,354 @@
+"""
+Postgres mirror of each user's storage tree (see models.FILE_INDEX).
+
+All paths here are relative to the user's root folder, without leading or
+trailing slashes. Functions are blocking; call them through
+database.run_db from async code.
+"""
+from datetime import datetime, timezone
+
+from psycopg2.extras import execute_values
+
+from ..database import get_connection
+
+
+def split_path(rel_path: str):
+    parent, _, name = rel_path.strip("/").rpartition("/")
+    return parent, name
+
+def _like_children(rel_dir: str) -> str:
+    # LIKE pattern for everything below `rel_dir`
+    escaped = rel_dir.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"{escaped}/%"
+
+def _bump_generation(cur, user_id: str):
+    # Every change to a user's rows goes through here first, which also
+    # orders its lock on the state row before any lock on file_index
+    cur.execute(
+        """
+        INSERT INTO file_index_state (user_id, generation) VALUES (%s, 1)
+        ON CONFLICT (user_id) DO UPDATE SET generation = file_index_state.generation + 1
+        """,
+        (user_id,),
+    )
+
+def _ensure_ancestors(cur, user_id: str, parent: str):
+    parts = [p for p in parent.split("/") if p]
+    rows = [(user_id, "/".join(parts[:i]), parts[i]) for i in range(len(parts))]
+    if rows:
+        execute_values(
+            cur,
+            "INSERT INTO file_index (user_id, parent, name, is_dir) VALUES %s ON CONFLICT DO NOTHING",
+            [(u, p, n, True) for u, p, n in rows],
+        )
+
+def _prune_empty_dirs(cur, user_id: str, parent: str):
+    # Storage folders only exist while something is inside them
+    while parent:
+        cur.execute(
+            "SELECT 1 FROM file_index WHERE user_id = %s AND parent = %s LIMIT 1",
+            (user_id, parent),
+        )
+        if cur.fetchone():
+            return
+        grandparent, name = split_path(parent)
+        cur.execute(
+            "DELETE FROM file_index WHERE user_id = %s AND parent = %s AND name = %s AND is_dir",
+            (user_id, grandparent, name),
+        )
+        parent = grandparent
+
+
+def record_object(user_id: str, rel_path: str, size: int = None, mimetype: str = None, etag: str = None,
+                  stored_size: int = None, content_encoding: str = None):
+    # `stored_size` and `content_encoding` only for objects stored compressed
+    parent, name = split_path(rel_path)
+    with get_connection() as conn, conn.cursor() as cur:
+        _bump_generation(cur, user_id)
+        _ensure_ancestors(cur, user_id, parent)
+        cur.execute(
+            """
+            INSERT INTO file_index (user_id, parent, name, is_dir, size, mimetype, etag, updated_at,
+                                    stored_size, content_encoding)
+            VALUES (%s, %s, %s, FALSE, %s, %s, %s, now(), %s, %s)
+            ON CONFLICT (user_id, parent, name) DO UPDATE
+            SET is_dir = FALSE, size = EXCLUDED.size, mimetype = EXCLUDED.mimetype,
+                etag = EXCLUDED.etag, updated_at = EXCLUDED.updated_at,
+                stored_size = EXCLUDED.stored_size, content_encoding = EXCLUDED.content_encoding
+            """,
+            (user_id, parent, name, size, mimetype, etag, stored_size, content_encoding),
+        )
+
+def remove_object(user_id: str, rel_path: str):
+    parent, name = split_path(rel_path)
+    with get_connection() as conn, conn.cursor() as cur:
+        _bump_generation(cur, user_id)
+        cur.execute(
+            "DELETE FROM file_index WHERE user_id = %s AND parent = %s AND name = %s AND NOT is_dir",
+            (user_id, parent, name),
+        )
+        _prune_empty_dirs(cur, user_id, parent)
+
+def remove_tree(user_id: str, rel_dir: str):
+    rel_dir = rel_dir.strip("/")
+    parent, name = split_path(rel_dir)
+    with get_connection() as conn, conn.cursor() as cur:
+        _bump_generation(cur, user_id)
+        if rel_dir:
+            cur.execute(
+                "DELETE FROM file_index WHERE user_id = %s AND parent = %s AND name = %s",
+                (user_id, parent, name),
+            )
+            cur.execute(
+                "DELETE FROM file_index WHERE user_id = %s AND (parent = %s OR parent LIKE %s)",
+                (user_id, rel_dir, _like_children(rel_dir)),
+            )
+            _prune_empty_dirs(cur, user_id, parent)
+        else:
+            cur.execute("DELETE FROM file_index WHERE user_id = %s", (user_id,))
+
+def move_object(user_id: str, old_rel_path: str, new_rel_path: str):
+    old_parent, old_name = split_path(old_rel_path)
+    new_parent, new_name = split_path(new_rel_path)
+    with get_connection() as conn, conn.cursor() as cur:
+        _bump_generation(cur, user_id)
+        _ensure_ancestors(cur, user_id, new_parent)
+        cur.execute(
+            """
+            UPDATE file_index SET parent = %s, name = %s, updated_at = now()
+            WHERE user_id = %s AND parent = %s AND name = %s AND NOT is_dir
+            """,
+            (new_parent, new_name, user_id, old_parent, old_name),
+        )
+        _prune_empty_dirs(cur, user_id, old_parent)
+
+def move_objects(user_id: str, moves: list):
+    # Same as move_object for many (old_rel_path, new_rel_path) pairs in one transaction
+    with get_connection() as conn, conn.cursor() as cur:
+        _bump_generation(cur, user_id)
+        old_parents = set()
+        for old_rel_path, new_rel_path in moves:
+            old_parent, old_name = split_path(old_rel_path)
+            new_parent, new_name = split_path(new_rel_path)
+            _ensure_ancestors(cur, user_id, new_parent)
+            cur.execute(
+                """
+                UPDATE file_index SET parent = %s, name = %s, updated_at = now()
+                WHERE user_id = %s AND parent = %s AND name = %s AND NOT is_dir
+                """,
+                (new_parent, new_name, user_id, old_parent, old_name),
+            )
+            old_parents.add(old_parent)
+        # Deepest first so emptied parents are pruned after their children
+        for old_parent in sorted(old_parents, key=lambda p: p.count("/"), reverse=True):
+            _prune_empty_dirs(cur, user_id, old_parent)
+
+def move_tree(user_id: str, old_rel_dir: str, new_rel_dir: str):
+    old_rel_dir, new_rel_dir = old_rel_dir.strip("/"), new_rel_dir.strip("/")
+    old_parent, old_name = split_path(old_rel_dir)
+    below = "user_id = %s AND (parent = %s OR parent LIKE %s)"
+    below_args = (user_id, old_rel_dir, _like_children(old_rel_dir))
+    new_parent_expr = "%s || substr(parent, length(%s) + 1)"
+    with get_connection() as conn, conn.cursor() as cur:
+        _bump_generation(cur, user_id)
+        # The target folder may already exist, so folder rows are merged
+        # rather than renamed in place
+        _ensure_ancestors(cur, user_id, new_rel_dir)
+        cur.execute(
+            "DELETE FROM file_index WHERE user_id = %s AND parent = %s AND name = %s AND is_dir",
+            (user_id, old_parent, old_name),
+        )
+        cur.execute(
+            f"""
+            INSERT INTO file_index (user_id, parent, name, is_dir)
+            SELECT user_id, {new_parent_expr}, name, TRUE FROM file_index WHERE {below} AND is_dir
+            ON CONFLICT DO NOTHING
+            """,
+            (new_rel_dir, old_rel_dir, *below_args),
+        )
+        cur.execute(f"DELETE FROM file_index WHERE {below} AND is_dir", below_args)
+        cur.execute(
+            f"UPDATE file_index SET parent = {new_parent_expr} WHERE {below}",
+            (new_rel_dir, old_rel_dir, *below_args),
+        )
+        _prune_empty_dirs(cur, user_id, old_parent)
+
+# Columns a listing may be ordered by; folders always sort by name
+SORT_COLUMNS = {"name": "name", "updated_at": "updated_at"}
+
+def list_directory_page(user_id: str, rel_dir: str, limit: int, sort: str = "name", order: str = "asc", after=None):
+    """
+    Keyset-paginated listing of one folder: folders first, then files.
+    `after` is the (is_dir, sort value, name) of the last row already
+    returned. Returns (rows, has_more), or None when the user's index
+    hasn't been built yet.
+    """
+    column = SORT_COLUMNS[sort]
+    op, direction = (">", "ASC") if order == "asc" else ("<", "DESC")
+    rel_dir = rel_dir.strip("/")
+    select = "SELECT name, is_dir, size, mimetype, etag, updated_at FROM file_index WHERE user_id = %s AND parent = %s"
+
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT 1 FROM file_index_state WHERE user_id = %s AND reconciled_at IS NOT NULL", (user_id,))
+        if cur.fetchone() is None:
+            return None
+
+        rows = []
+        if after is None or after[0]:
+            where, params = "", []
+            if after is not None:
+                where, params = f" AND name {op} %s", [after[2]]
+            cur.execute(
+                f"{select} AND is_dir{where} ORDER BY name {direction} LIMIT %s",
+                [user_id, rel_dir, *params, limit + 1],
+            )
+            rows = cur.fetchall()
+            after = None
+
+        if len(rows) <= limit:
+            where, params = "", []
+            if after is not None:
+                if column == "name":
+                    where, params = f" AND name {op} %s", [after[2]]
+                else:
+                    where, params = f" AND ({column}, name) {op} (%s, %s)", [after[1], after[2]]
+            order_by = f"name {direction}" if column == "name" else f"{column} {direction}, name {direction}"
+            cur.execute(
+                f"{select} AND NOT is_dir{where} ORDER BY {order_by} LIMIT %s",
+                [user_id, rel_dir, *params, limit + 1 - len(rows)],
+            )
+            rows += cur.fetchall()
+
+    rows = [
+        {"name": name, "is_dir": is_dir, "size": size, "mimetype": mimetype, "etag": etag, "updated_at": updated_at}
+        for name, is_dir, size, mimetype, etag, updated_at in rows
+    ]
+    return rows[:limit], len(rows) > limit
+
+def content_encodings(user_id: str, rel_paths: list):
+    """
+    {rel_path: encoding} for those of `rel_paths` stored compressed, or None
+    when the user's index hasn't been built yet.
+    """
+    parents, names = zip(*(split_path(p) for p in rel_paths)) if rel_paths else ((), ())
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT 1 FROM file_index_state WHERE user_id = %s AND reconciled_at IS NOT NULL", (user_id,))
+        if cur.fetchone() is None:
+            return None
+        cur.execute(
+            """
+            SELECT f.parent, f.name, f.content_encoding FROM file_index f
+            JOIN unnest(%s::text[], %s::text[]) AS p(parent, name) ON f.parent = p.parent AND f.name = p.name
+            WHERE f.user_id = %s AND f.content_encoding IS NOT NULL
+            """,
+            (list(parents), list(names), user_id),
+        )
+        return {f"{parent}/{name}".strip("/"): encoding for parent, name, encoding in cur.fetchall()}
+
+def storage_savings(user_id: str) -> dict:
+    # What compression saves this user, over the files in their index
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT count(*), count(content_encoding), coalesce(sum(size), 0),
+                   coalesce(sum(coalesce(stored_size, size)), 0)
+            FROM file_index WHERE user_id = %s AND NOT is_dir
+            """,
+            (user_id,),
+        )
+        files, compressed, original_bytes, stored_bytes = cur.fetchone()
+    return {
+        "files": files,
+        "compressed_files": compressed,
+        "original_bytes": int(original_bytes),
+        "stored_bytes": int(stored_bytes),
+        "saved_bytes": int(original_bytes - stored_bytes),
+    }
+
+
+def invalidate(user_id: str):
+    # Listings fall back to storage until the next reconcile
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            "UPDATE file_index_state SET reconciled_at = NULL, generation = generation + 1 WHERE user_id = %s",
+            (user_id,),
+        )
+
+def index_generation(user_id: str) -> int:
+    # Taken before a storage walk and handed to replace_user_index
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            "INSERT INTO file_index_state (user_id) VALUES (%s) ON CONFLICT (user_id) DO NOTHING", (user_id,)
+        )
+        cur.execute("SELECT generation FROM file_index_state WHERE user_id = %s", (user_id,))
+        return cur.fetchone()[0]
+
+def replace_user_index(user_id: str, entries: list, generation: int):
+    """
+    Atomically swap a user's rows for `entries`, as produced by a full
+    storage walk: dicts with rel_path, is_dir, size, mimetype, etag,
+    updated_at and, for compressed objects, stored_size and content_encoding.
+    `generation` is what index_generation returned before the walk. If the
+    rows changed since, the walk may have missed that change, so nothing is
+    replaced and None is returned.
+    """
+    now = datetime.now(timezone.utc)
+    rows = {}
+    for entry in entries:
+        parent, name = split_path(entry["rel_path"])
+        updated_at = entry.get("updated_at")
+        if not entry["is_dir"] and not updated_at:
+            # Files always carry a timestamp so keyset paging never compares NULLs
+            updated_at = now
+        # First entry wins if storage reports a file and folder of the same name
+        rows.setdefault((parent, name), (
+            user_id, parent, name, entry["is_dir"], entry.get("size"),
+            entry.get("mimetype"), entry.get("etag"), updated_at,
+            entry.get("stored_size"), entry.get("content_encoding"),
+        ))
+    rows = list(rows.values())
+    with get_connection() as conn, conn.cursor() as cur:
+        # Held until commit, so changes made from here on wait and apply on top
+        cur.execute("SELECT generation FROM file_index_state WHERE user_id = %s FOR UPDATE", (user_id,))
+        row = cur.fetchone()
+        if row is None or row[0] != generation:
+            return None
+        # Upsert and delete what's gone instead of deleting everything, so
+        # rows referencing file_index (extracted text) survive a reconcile
+        cur.execute("CREATE TEMP TABLE reconciled (parent TEXT, name TEXT) ON COMMIT DROP")
+        if rows:
+            # Storage listings that don't carry object metadata report the
+            # stored size of a compressed object; when that matches what was
+            # recorded at upload, the row keeps its original size and encoding
+            kept = "EXCLUDED.content_encoding IS NULL AND file_index.stored_size = EXCLUDED.size"
+            execute_values(
+                cur,
+                f"""
+                INSERT INTO file_index (user_id, parent, name, is_dir, size, mimetype, etag, updated_at,
+                                        stored_size, content_encoding)
+                VALUES %s ON CONFLICT (user_id, parent, name) DO UPDATE
+                SET is_dir = EXCLUDED.is_dir, mimetype = EXCLUDED.mimetype,
+                    etag = EXCLUDED.etag, updated_at = EXCLUDED.updated_at,
+                    size = CASE WHEN {kept} THEN file_index.size ELSE EXCLUDED.size END,
+                    content_encoding = CASE WHEN {kept} THEN file_index.content_encoding ELSE EXCLUDED.content_encoding END,
+                    stored_size = CASE WHEN {kept} THEN file_index.stored_size ELSE EXCLUDED.stored_size END
+                """,
+                rows,
+                page_size=1000,
+            )
+            execute_values(cur, "INSERT INTO reconciled (parent, name) VALUES %s", [r[1:3] for r in rows], page_size=1000)
+        cur.execute(
+            """
+            DELETE FROM file_index f WHERE f.user_id = %s
+            AND NOT EXISTS (SELECT 1 FROM reconciled r WHERE r.parent = f.parent AND r.name = f.name)
+            """,
+            (user_id,),
+        )
+        cur.execute(
+            """
+            UPDATE file_index_state SET reconciled_at = now(), generation = generation + 1
+            WHERE user_id = %s
+            """,
+            (user_id,),
+        )
+    return len(rows)
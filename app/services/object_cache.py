@@ -0,0 +1,397 @@
+"""
+Proxied file downloads backed by a disk cache of hot objects.
+
+Objects up to DOWNLOAD_CACHE_MAX_OBJECT_SIZE are fetched once into a
+per-process directory under DOWNLOAD_CACHE_DIR and served from there by
+FileResponse, which handles Range/If-Range and hands the file to the server
+(pathsend) where supported. The cache is LRU, bounded by
+DOWNLOAD_CACHE_MAX_BYTES, and entries are revalidated with a conditional
+GET once they are DOWNLOAD_CACHE_TTL seconds old. Concurrent misses for the
+same object share a single storage fetch. Larger objects are streamed
+straight from storage, Range and validators passed along.
+
+Objects stored compressed are cached as stored. Clients that accept the
+encoding get those bytes with Content-Encoding; the rest get the whole
+file decoded on the fly, without Range.
+"""
+import asyncio
+import hashlib
+import os
+import shutil
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import aclosing
+from email.utils import formatdate, parsedate_to_datetime
+
+import anyio
+from fastapi import HTTPException, status
+from fastapi.responses import FileResponse, Response, StreamingResponse
+
+from ..cache import TTLCache
+from ..config import get_settings
+from ..schemas import TokenData
+from . import compression
+from .archive import content_disposition
+from .cloud import join_key, removal_listeners, upload_listeners
+from .storage import get_storage
+
+settings = get_settings()
+
+# Request headers passed on to storage when an object is streamed through
+_PROXY_REQUEST_HEADERS = ("range", "if-range", "if-none-match", "if-modified-since")
+_PROXY_RESPONSE_HEADERS = (
+    "content-type", "content-length", "content-range", "accept-ranges", "etag", "last-modified",
+)
+# Browsers may keep a copy but must check back, which costs them a 304
+CACHE_CONTROL = "private, no-cache"
+
+
+class _Entry:
+    __slots__ = (
+        "path", "size", "etag", "last_modified", "content_type", "encoding", "original_size",
+        "validated_at", "readers", "evicted",
+    )
+
+    def __init__(self, path: str, size: int, etag: str, last_modified: float, content_type: str,
+                 encoding: str = None, original_size: int = None):
+        self.path = path
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_type = content_type
+        # Set for objects stored compressed; `size` is then the stored size
+        self.encoding = encoding
+        self.original_size = original_size
+        self.validated_at = time.monotonic()
+        # Responses still reading the file; an evicted entry is removed
+        # from disk once the last of them is done
+        self.readers = 0
+        self.evicted = False
+
+
+_entries = OrderedDict()
+_size = 0
+_dir = None
+# Object key -> fetch in progress, shared by every request that misses
+_inflight = {}
+# Object keys known to be over DOWNLOAD_CACHE_MAX_OBJECT_SIZE
+_too_large = TTLCache(10000, settings.DOWNLOAD_CACHE_TTL)
+_stats = {"hits": 0, "misses": 0, "revalidated": 0, "passthrough": 0}
+
+
+def _cache_dir() -> str:
+    global _dir
+    if _dir is None:
+        # One directory per process, since the index of what's in it lives
+        # in memory. Directories left behind by dead processes are cleared.
+        os.makedirs(settings.DOWNLOAD_CACHE_DIR, exist_ok=True)
+        for name in os.listdir(settings.DOWNLOAD_CACHE_DIR):
+            if name.isdigit() and not _pid_alive(int(name)):
+                shutil.rmtree(os.path.join(settings.DOWNLOAD_CACHE_DIR, name), ignore_errors=True)
+        _dir = os.path.join(settings.DOWNLOAD_CACHE_DIR, str(os.getpid()))
+        shutil.rmtree(_dir, ignore_errors=True)
+        os.makedirs(_dir)
+    return _dir
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+def close_object_cache():
+    global _dir, _size
+    if _dir is not None:
+        shutil.rmtree(_dir, ignore_errors=True)
+        _dir = None
+    _entries.clear()
+    _size = 0
+
+def cache_stats() -> dict:
+    return {**_stats, "entries": len(_entries), "bytes": _size, "max_bytes": settings.DOWNLOAD_CACHE_MAX_BYTES}
+
+
+def _discard(entry: _Entry):
+    entry.evicted = True
+    if entry.readers == 0:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+def _drop(key: str):
+    global _size
+    entry = _entries.pop(key, None)
+    if entry is not None:
+        _size -= entry.size
+        _discard(entry)
+
+def _store(key: str, entry: _Entry):
+    global _size
+    _drop(key)
+    _entries[key] = entry
+    _size += entry.size
+    # Least recently used first; files being served are deleted once released
+    while _size > settings.DOWNLOAD_CACHE_MAX_BYTES and len(_entries) > 1:
+        _drop(next(iter(_entries)))
+
+def _release(entry: _Entry):
+    entry.readers -= 1
+    if entry.evicted:
+        _discard(entry)
+
+def invalidate(keys: list):
+    for key in keys:
+        _drop(key)
+        _too_large.pop(key)
+
+def _on_upload(user_id: str, rel_path: str, size: int = None, content_type: str = None):
+    invalidate([join_key(user_id, rel_path)])
+
+upload_listeners.append(_on_upload)
+removal_listeners.append(invalidate)
+
+
+def _parse_http_date(value: str):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+async def _fetch(key: str, entry: _Entry = None):
+    """
+    Fetches `key` into the cache, or just revalidates `entry` when storage
+    says it hasn't changed. Returns the cached entry, or None when the
+    object has to be streamed from storage instead.
+    """
+    headers = {"If-None-Match": entry.etag} if entry else None
+    async with aclosing(await get_storage().open_object(key, headers)) as response:
+        if response.status_code == 304 and entry is not None:
+            if entry.evicted:
+                # Pushed out while being revalidated; serve this one from storage
+                return None
+            entry.validated_at = time.monotonic()
+            _stats["revalidated"] += 1
+            return entry
+        if response.status_code != 200:
+            await response.aread()
+            if response.status_code in (400, 404):
+                # Storage reports missing objects as 400 "not_found"
+                _drop(key)
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found")
+            raise Exception(f"Download failed: {response.status_code} - {response.text}")
+
+        max_size = min(settings.DOWNLOAD_CACHE_MAX_OBJECT_SIZE, settings.DOWNLOAD_CACHE_MAX_BYTES)
+        length = response.headers.get("content-length")
+        if length is not None and int(length) > max_size:
+            _too_large.set(key, True)
+            _drop(key)
+            return None
+
+        etag = response.headers.get("etag")
+        digest = None if etag else hashlib.md5(usedforsecurity=False)
+        path = os.path.join(_cache_dir(), uuid.uuid4().hex)
+        size = 0
+        try:
+            async with await anyio.open_file(path, "wb") as f:
+                async for chunk in response.aiter_bytes(settings.UPLOAD_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > max_size:
+                        raise OverflowError
+                    if digest is not None:
+                        digest.update(chunk)
+                    await f.write(chunk)
+        except OverflowError:
+            os.remove(path)
+            _too_large.set(key, True)
+            _drop(key)
+            return None
+        except BaseException:
+            os.remove(path)
+            raise
+
+    content_type = response.headers.get("content-type", "application/octet-stream")
+    try:
+        info = await compression.encoding_info(key, content_type)
+    except BaseException:
+        os.remove(path)
+        raise
+    fetched = _Entry(
+        path,
+        size,
+        etag or f'"{digest.hexdigest()}"',
+        _parse_http_date(response.headers.get("last-modified")) or time.time(),
+        content_type,
+        info["encoding"] if info else None,
+        info["size"] if info else None,
+    )
+    _store(key, fetched)
+    return fetched
+
+async def _get_entry(key: str):
+    entry = _entries.get(key)
+    if entry is not None:
+        _entries.move_to_end(key)
+        if time.monotonic() - entry.validated_at < settings.DOWNLOAD_CACHE_TTL:
+            _stats["hits"] += 1
+            return entry
+    else:
+        _stats["misses"] += 1
+
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_fetch(key, entry))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # Shielded, so a client hanging up doesn't cancel the fetch for the others
+    return await asyncio.shield(task)
+
+
+class _CachedFileResponse(FileResponse):
+    # Holds a reader on the cache entry until the response is done, however
+    # it ends, so eviction can't delete the file from under it
+    def __init__(self, entry: _Entry, **kwargs):
+        super().__init__(entry.path, **kwargs)
+        self.entry = entry
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            _release(self.entry)
+
+class _DecodedResponse(StreamingResponse):
+    # A cached compressed file, decoded for a client that can't take it as stored
+    def __init__(self, entry: _Entry, **kwargs):
+        super().__init__(compression.decode_stream(self._read(entry.path), entry.encoding), **kwargs)
+        self.entry = entry
+
+    @staticmethod
+    async def _read(path: str):
+        async with await anyio.open_file(path, "rb") as f:
+            while chunk := await f.read(compression.DECODE_CHUNK):
+                yield chunk
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            _release(self.entry)
+
+def _not_modified(request_headers, etag: str, last_modified: float) -> bool:
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in tags or etag.removeprefix("W/") in tags
+    since = _parse_http_date(request_headers.get("if-modified-since"))
+    return since is not None and int(last_modified) <= since
+
+async def _relay(response):
+    # Closes the storage response even when the client hangs up early
+    try:
+        async for chunk in response.aiter_raw(settings.UPLOAD_CHUNK_SIZE):
+            yield chunk
+    finally:
+        await response.aclose()
+
+async def _decoded_relay(response, encoding: str):
+    try:
+        async for chunk in compression.decode_stream(response.aiter_raw(settings.UPLOAD_CHUNK_SIZE), encoding):
+            yield chunk
+    finally:
+        await response.aclose()
+
+async def _passthrough(key: str, request_headers):
+    _stats["passthrough"] += 1
+    # Bytes are relayed as is, so they must not come back compressed
+    headers = {name: request_headers[name] for name in _PROXY_REQUEST_HEADERS if name in request_headers}
+    headers["Accept-Encoding"] = "identity"
+    try:
+        info = await compression.encoding_info(key)
+    except Exception:
+        # Most likely missing, which the download itself reports
+        info = None
+    encoded = info is not None and compression.accepts(request_headers, info["encoding"])
+    if info is not None and encoded and "if-none-match" in headers:
+        # Storage knows the stored object by its own etag
+        suffix = f'-{info["encoding"]}"'
+        headers["if-none-match"] = headers["if-none-match"].replace(suffix, '"')
+    elif info is not None and not encoded:
+        # Decoded bytes can't be cut by ranges of the stored ones
+        headers.pop("range", None)
+        headers.pop("if-range", None)
+    response = await get_storage().open_object(key, headers)
+    if response.status_code not in (200, 206, 304, 416):
+        await response.aread()
+        await response.aclose()
+        if response.status_code in (400, 404):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found")
+        raise Exception(f"Download failed: {response.status_code} - {response.text}")
+
+    headers = {name: response.headers[name] for name in _PROXY_RESPONSE_HEADERS if name in response.headers}
+    headers["cache-control"] = CACHE_CONTROL
+    if info is None:
+        return StreamingResponse(_relay(response), status_code=response.status_code, headers=headers)
+
+    headers["vary"] = "accept-encoding"
+    if encoded:
+        headers["content-encoding"] = info["encoding"]
+        if "etag" in headers:
+            headers["etag"] = compression.encoded_etag(headers["etag"], info["encoding"])
+        return StreamingResponse(_relay(response), status_code=response.status_code, headers=headers)
+    headers.pop("content-length", None)
+    headers.pop("accept-ranges", None)
+    if response.status_code == 200 and info["size"] is not None:
+        headers["content-length"] = str(info["size"])
+    if response.status_code != 200:
+        return StreamingResponse(_relay(response), status_code=response.status_code, headers=headers)
+    return StreamingResponse(_decoded_relay(response, info["encoding"]), headers=headers)
+
+async def download_file(path: str, user: TokenData, request_headers) -> Response:
+    """
+    Response for GET /file/download: 304 when the client's copy is still
+    current, otherwise the file (or the requested range of it) from the
+    disk cache, or streamed from storage when it's too large to cache.
+    """
+    clean_path = path.strip("/").replace("..", "")
+    if not clean_path:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="File path is required")
+    key = join_key(user.user_id, clean_path)
+
+    # Local objects are on disk already, and too large ones aren't cached
+    if not get_storage().remote or _too_large.get(key) is not None:
+        return await _passthrough(key, request_headers)
+    entry = await _get_entry(key)
+    if entry is None:
+        return await _passthrough(key, request_headers)
+
+    encoded = entry.encoding is not None and compression.accepts(request_headers, entry.encoding)
+    headers = {
+        "etag": compression.encoded_etag(entry.etag, entry.encoding) if encoded else entry.etag,
+        "last-modified": formatdate(entry.last_modified, usegmt=True),
+        "cache-control": CACHE_CONTROL,
+    }
+    if entry.encoding is not None:
+        headers["vary"] = "accept-encoding"
+    if _not_modified(request_headers, headers["etag"], entry.last_modified):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    entry.readers += 1
+    if entry.encoding is not None and not encoded:
+        headers["content-disposition"] = content_disposition(os.path.basename(clean_path), "inline")
+        if entry.original_size is not None:
+            headers["content-length"] = str(entry.original_size)
+        return _DecodedResponse(entry, headers=headers, media_type=entry.content_type)
+    if encoded:
+        headers["content-encoding"] = entry.encoding
+    return _CachedFileResponse(
+        entry,
+        headers=headers,
+        media_type=entry.content_type,
+        filename=os.path.basename(clean_path),
+        content_disposition_type="inline",
+    )
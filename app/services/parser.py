@@ -0,0 +1,257 @@
+"""
+Text extraction for uploaded documents: xlsx, csv, txt and pdf.
+
+Extraction runs off the request path. After an upload the object is
+streamed from storage into a temp file, parsed by a process pool worker and
+the result is stored in file_text (see models.FILE_TEXT) for search and
+tagging. Every reader streams its input and stops at PARSER_MAX_CHARS, and
+pool workers run under an address-space limit of PARSER_MEMORY_LIMIT_MB.
+"""
+import asyncio
+import csv
+import logging
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import anyio
+
+from . import text_index
+from .cloud import iter_object, join_key, upload_listeners
+from ..config import get_settings
+from ..database import database_enabled, run_db
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+# Callbacks run as listener(user_id, rel_path) once a file's text is stored
+extraction_listeners = []
+
+_pool = None
+_slots = None
+# Strong references to in-flight extractions so they aren't garbage collected
+_pending = set()
+
+
+class _TextBuffer:
+    # Collects text up to `max_chars`, then reports itself full
+    def __init__(self, max_chars: int):
+        self.parts = []
+        self.size = 0
+        self.max_chars = max_chars
+        self.truncated = False
+
+    def add(self, text: str) -> bool:
+        remaining = self.max_chars - self.size
+        if len(text) > remaining:
+            text = text[:remaining]
+            self.truncated = True
+        self.parts.append(text)
+        self.size += len(text)
+        return not self.truncated
+
+    def text(self) -> str:
+        return "".join(self.parts)
+
+
+def _extract_xlsx(path: str, buffer: _TextBuffer) -> dict:
+    from openpyxl import load_workbook
+
+    # read_only streams rows from the sheet XML instead of building the workbook
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    sheets = rows = 0
+    try:
+        for sheet in workbook.worksheets:
+            sheets += 1
+            if not buffer.add(f"# {sheet.title}\n"):
+                break
+            for row in sheet.iter_rows(values_only=True):
+                cells = ["" if value is None else str(value) for value in row]
+                while cells and not cells[-1]:
+                    cells.pop()
+                if not cells:
+                    continue
+                rows += 1
+                if not buffer.add("\t".join(cells) + "\n"):
+                    break
+            if buffer.truncated:
+                break
+    finally:
+        workbook.close()
+    return {"sheets": sheets, "rows": rows}
+
+def _extract_csv(path: str, buffer: _TextBuffer) -> dict:
+    rows = 0
+    with open(path, newline="", encoding="utf-8-sig", errors="replace") as f:
+        try:
+            dialect = csv.Sniffer().sniff(f.read(8192))
+        except csv.Error:
+            dialect = csv.excel
+        f.seek(0)
+        for row in csv.reader(f, dialect):
+            if not any(row):
+                continue
+            rows += 1
+            if not buffer.add("\t".join(row) + "\n"):
+                break
+    return {"rows": rows}
+
+def _extract_txt(path: str, buffer: _TextBuffer) -> dict:
+    with open(path, encoding="utf-8", errors="replace") as f:
+        while True:
+            chunk = f.read(64 * 1024)
+            if not chunk or not buffer.add(chunk):
+                break
+    return {}
+
+def _extract_pdf(path: str, buffer: _TextBuffer) -> dict:
+    from pypdf import PdfReader
+
+    reader = PdfReader(path)
+    pages = 0
+    for page in reader.pages:
+        pages += 1
+        if not buffer.add((page.extract_text() or "") + "\n"):
+            break
+    metadata = {"pages": len(reader.pages), "pages_read": pages}
+    info = reader.metadata
+    if info and info.title:
+        metadata["title"] = str(info.title)
+    return metadata
+
+EXTRACTORS = {
+    ".xlsx": ("xlsx", _extract_xlsx),
+    ".xlsm": ("xlsx", _extract_xlsx),
+    ".csv": ("csv", _extract_csv),
+    ".txt": ("txt", _extract_txt),
+    ".pdf": ("pdf", _extract_pdf),
+}
+
+def can_extract(filename: str) -> bool:
+    return os.path.splitext(filename)[1].lower() in EXTRACTORS
+
+def extract_document(path: str, filename: str, max_chars: int) -> dict:
+    """
+    Extracts text from the local file at `path`, picking the reader from
+    `filename`'s extension. Never raises: failures come back in "error".
+    """
+    kind, extractor = EXTRACTORS[os.path.splitext(filename)[1].lower()]
+    buffer = _TextBuffer(max_chars)
+    try:
+        metadata = extractor(path, buffer)
+        error = None
+    except MemoryError:
+        metadata, error = {}, "Document exceeds the parser memory limit"
+    except Exception as e:
+        metadata, error = {}, f"{type(e).__name__}: {e}"
+    return {
+        "kind": kind,
+        "text": buffer.text(),
+        "truncated": buffer.truncated,
+        "metadata": {**metadata, "chars": buffer.size},
+        "error": error,
+    }
+
+
+def _limit_worker_memory(limit_mb: int):
+    # Runs in each pool worker; a runaway document then fails with
+    # MemoryError instead of taking the host down
+    if not limit_mb:
+        return
+    try:
+        import resource
+        limit = limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (ImportError, ValueError, OSError):
+        pass
+
+def get_parser_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn, not fork: the app process has an event loop and threads
+        _pool = ProcessPoolExecutor(
+            max_workers=settings.PARSER_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_limit_worker_memory,
+            initargs=(settings.PARSER_MEMORY_LIMIT_MB,),
+            max_tasks_per_child=settings.PARSER_TASKS_PER_WORKER or None,
+        )
+    return _pool
+
+def close_parser_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+async def _download(full_path: str, dest: str):
+    size = 0
+    async with await anyio.open_file(dest, "wb") as f:
+        async for chunk in iter_object(full_path, settings.UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > settings.PARSER_MAX_FILE_SIZE:
+                raise Exception(f"File exceeds the parser limit of {settings.PARSER_MAX_FILE_SIZE} bytes")
+            await f.write(chunk)
+
+async def extract_object(user_id: str, rel_path: str) -> dict:
+    """
+    Downloads `rel_path` from the user's folder, extracts its text in the
+    process pool and stores the result. Returns the stored result.
+    """
+    global _slots
+    if _slots is None:
+        # Bounds downloads and temp files to what the pool can work through
+        _slots = asyncio.Semaphore(settings.PARSER_WORKERS * 2)
+
+    suffix = os.path.splitext(rel_path)[1].lower()
+    async with _slots:
+        fd, tmp_path = tempfile.mkstemp(suffix=suffix)
+        os.close(fd)
+        try:
+            await _download(join_key(user_id, rel_path), tmp_path)
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(
+                get_parser_pool(), extract_document, tmp_path, rel_path, settings.PARSER_MAX_CHARS
+            )
+        except BrokenProcessPool:
+            # A worker died (most likely killed for memory); start afresh
+            close_parser_pool()
+            result = {"kind": EXTRACTORS[suffix][0], "error": "Parser worker crashed"}
+        except Exception as e:
+            result = {"kind": EXTRACTORS[suffix][0], "error": str(e)}
+        finally:
+            os.remove(tmp_path)
+
+    if not await run_db(text_index.store_text, user_id, rel_path, result):
+        logger.info("Not storing text for %s/%s, it isn't in the metadata index", user_id, rel_path)
+        return result
+    for listener in extraction_listeners:
+        try:
+            listener(user_id, rel_path)
+        except Exception:
+            logger.exception("Extraction listener failed for %s", rel_path)
+    return result
+
+async def _extract_logged(user_id: str, rel_path: str):
+    try:
+        await extract_object(user_id, rel_path)
+    except Exception:
+        logger.exception("Text extraction failed for %s/%s", user_id, rel_path)
+
+def will_extract(rel_path: str, size: int = None) -> bool:
+    # Whether an upload of this file gets its text extracted
+    if not (settings.PARSER_ENABLED and database_enabled() and can_extract(rel_path)):
+        return False
+    return size is None or size <= settings.PARSER_MAX_FILE_SIZE
+
+def schedule_extraction(user_id: str, rel_path: str, size: int = None, content_type: str = None):
+    if not will_extract(rel_path, size):
+        return
+    task = asyncio.create_task(_extract_logged(user_id, rel_path))
+    _pending.add(task)
+    task.add_done_callback(_pending.discard)
+
+upload_listeners.append(schedule_extraction)
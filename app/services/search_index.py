@@ -0,0 +1,95 @@
+"""
+Ranked search over the metadata index (see models.SEARCH_INDEX).
+Functions are blocking; call them through database.run_db from async code.
+"""
+import re
+
+from ..database import get_connection
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def build_tsquery(q: str):
+    # Every word must match, each as a prefix so "invo" finds "invoice"
+    words = _WORD.findall(q.lower())
+    return " & ".join(f"{word}:*" for word in words) or None
+
+def search(user_id: str, tsquery: str, file_type: str = None, modified_after=None, modified_before=None,
+           limit: int = 50, offset: int = 0):
+    """
+    Files and folders whose name, path or extracted text match `tsquery`,
+    best match first. Name and path hits come from file_index, content
+    hits from file_text, each through its own GIN index. Returns
+    (rows, has_more), or None when the user's index hasn't been built.
+    """
+    filters, params = [], []
+    if file_type:
+        # A tagger category ("image"), a mimetype or its prefix ("image/png",
+        # "image"), or an extension ("pdf")
+        file_type = file_type.lower().lstrip(".")
+        filters.append(
+            "AND NOT f.is_dir AND (g.category = %s OR f.mimetype = %s OR f.mimetype LIKE %s OR lower(f.name) LIKE %s)"
+        )
+        params += [file_type, file_type, f"{file_type}/%", f"%.{file_type}"]
+    if modified_after is not None:
+        filters.append("AND f.updated_at >= %s")
+        params.append(modified_after)
+    if modified_before is not None:
+        filters.append("AND f.updated_at < %s")
+        params.append(modified_before)
+
+    query = f"""
+        WITH q AS (
+            SELECT to_tsquery('simple', %s) AS names, to_tsquery('english', %s) AS content
+        ),
+        hits AS (
+            SELECT f.parent, f.name FROM file_index f, q
+            WHERE f.user_id = %s AND f.search_vector @@ q.names
+            UNION
+            SELECT t.parent, t.name FROM file_text t, q
+            WHERE t.user_id = %s AND t.search_vector @@ q.content
+        ),
+        ranked AS (
+            SELECT f.parent, f.name, f.is_dir, f.size, f.mimetype, f.updated_at, g.category, g.tags,
+                   2 * ts_rank(f.search_vector, q.names) + coalesce(ts_rank(t.search_vector, q.content), 0) AS rank
+            FROM hits h
+            CROSS JOIN q
+            JOIN file_index f ON f.user_id = %s AND f.parent = h.parent AND f.name = h.name
+            LEFT JOIN file_text t ON t.user_id = f.user_id AND t.parent = f.parent AND t.name = f.name
+            LEFT JOIN file_tags g ON g.user_id = f.user_id AND g.parent = f.parent AND g.name = f.name
+            WHERE TRUE {" ".join(filters)}
+            ORDER BY rank DESC, f.parent, f.name
+            LIMIT %s OFFSET %s
+        )
+        SELECT r.parent, r.name, r.is_dir, r.size, r.mimetype, r.updated_at, r.category, r.tags, r.rank,
+               CASE WHEN t.search_vector @@ q.content
+                    THEN ts_headline('english', left(t.content, 20000), q.content, 'MaxWords=20, MinWords=8')
+               END AS snippet
+        FROM ranked r
+        CROSS JOIN q
+        LEFT JOIN file_text t ON t.user_id = %s AND t.parent = r.parent AND t.name = r.name
+        ORDER BY r.rank DESC, r.parent, r.name
+    """
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT 1 FROM file_index_state WHERE user_id = %s AND reconciled_at IS NOT NULL", (user_id,))
+        if cur.fetchone() is None:
+            return None
+        cur.execute(query, [tsquery, tsquery, user_id, user_id, user_id, *params, limit + 1, offset, user_id])
+        rows = cur.fetchall()
+
+    results = [
+        {
+            "path": f"{parent}/{name}".strip("/"),
+            "name": name,
+            "is_dir": is_dir,
+            "size": size,
+            "mimetype": mimetype,
+            "updated_at": updated_at.isoformat() if updated_at else None,
+            "category": category,
+            "tags": tags or [],
+            "rank": round(rank, 4),
+            "snippet": snippet,
+        }
+        for parent, name, is_dir, size, mimetype, updated_at, category, tags, rank, snippet in rows
+    ]
+    return results[:limit], len(results) > limit
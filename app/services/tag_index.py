@@ -0,0 +1,109 @@
+"""
+Stored file tags (see models.FILE_TAGS). Functions are blocking; call them
+through database.run_db from async code.
+"""
+import json
+
+from psycopg2.extras import execute_values
+
+from ..database import get_connection
+from .metadata_index import _like_children, split_path
+
+# Files plus the start of their extracted text, if any
+_SELECT_FILES = """
+    SELECT f.parent, f.name, f.mimetype, left(t.content, %s)
+    FROM file_index f
+    LEFT JOIN file_text t ON t.user_id = f.user_id AND t.parent = f.parent AND t.name = f.name
+    WHERE f.user_id = %s AND NOT f.is_dir
+"""
+
+
+def _docs(rows: list) -> list:
+    return [
+        {"path": f"{parent}/{name}".strip("/"), "mimetype": mimetype, "text": text or ""}
+        for parent, name, mimetype, text in rows
+    ]
+
+def count_files(user_id: str, rel_dir: str) -> int:
+    rel_dir = rel_dir.strip("/")
+    with get_connection() as conn, conn.cursor() as cur:
+        if rel_dir:
+            cur.execute(
+                "SELECT count(*) FROM file_index WHERE user_id = %s AND NOT is_dir AND (parent = %s OR parent LIKE %s)",
+                (user_id, rel_dir, _like_children(rel_dir)),
+            )
+        else:
+            cur.execute("SELECT count(*) FROM file_index WHERE user_id = %s AND NOT is_dir", (user_id,))
+        return cur.fetchone()[0]
+
+def fetch_batch(user_id: str, rel_dir: str, after, limit: int, max_chars: int) -> list:
+    """
+    Next `limit` files anywhere below `rel_dir`, keyset-paginated on
+    (parent, name) after `after`, as tagger documents.
+    """
+    rel_dir = rel_dir.strip("/")
+    query, params = _SELECT_FILES, [max_chars, user_id]
+    if rel_dir:
+        query += " AND (f.parent = %s OR f.parent LIKE %s)"
+        params += [rel_dir, _like_children(rel_dir)]
+    if after is not None:
+        query += " AND (f.parent, f.name) > (%s, %s)"
+        params += list(after)
+    query += " ORDER BY f.parent, f.name LIMIT %s"
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute(query, params + [limit])
+        return _docs(cur.fetchall())
+
+def fetch_files(user_id: str, rel_paths: list, max_chars: int) -> list:
+    keys = [split_path(p) for p in rel_paths]
+    if not keys:
+        return []
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            _SELECT_FILES + " AND (f.parent, f.name) IN (SELECT * FROM unnest(%s::text[], %s::text[]))",
+            [max_chars, user_id, [k[0] for k in keys], [k[1] for k in keys]],
+        )
+        return _docs(cur.fetchall())
+
+def store_tags(user_id: str, results: list):
+    """
+    Upserts tagger results. Files deleted since they were read are
+    skipped rather than tripping the foreign key.
+    """
+    rows = []
+    for result in results:
+        parent, name = split_path(result["path"])
+        rows.append((user_id, parent, name, result["category"], result["tags"], json.dumps(result["scores"])))
+    if not rows:
+        return
+    with get_connection() as conn, conn.cursor() as cur:
+        execute_values(
+            cur,
+            """
+            INSERT INTO file_tags (user_id, parent, name, category, tags, scores)
+            SELECT v.user_id, v.parent, v.name, v.category, v.tags, v.scores::jsonb
+            FROM (VALUES %s) AS v (user_id, parent, name, category, tags, scores)
+            JOIN file_index f ON f.user_id = v.user_id AND f.parent = v.parent AND f.name = v.name
+            ON CONFLICT (user_id, parent, name) DO UPDATE
+            SET category = EXCLUDED.category, tags = EXCLUDED.tags,
+                scores = EXCLUDED.scores, tagged_at = now()
+            """,
+            rows,
+            template="(%s, %s, %s, %s, %s::text[], %s)",
+            page_size=1000,
+        )
+
+def list_tags(user_id: str, rel_dir: str) -> list:
+    # Tags of the files directly inside `rel_dir`
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT name, category, tags, tagged_at FROM file_tags
+            WHERE user_id = %s AND parent = %s ORDER BY name
+            """,
+            (user_id, rel_dir.strip("/")),
+        )
+        return [
+            {"name": name, "category": category, "tags": tags, "tagged_at": tagged_at.isoformat()}
+            for name, category, tags, tagged_at in cur.fetchall()
+        ]
@@ -0,0 +1,181 @@
+"""
+Offline auto-tagging of files from their name, mimetype and extracted text.
+
+Each file gets one category, from its mimetype or extension, and up to
+TAGGER_MAX_TAGS topic tags from a keyword classifier. Keyword hits are
+weighted TF-IDF style across the batch being tagged: sublinear term
+frequency times inverse document frequency, with filename hits boosted.
+Tagging is always done in batches, in the parser's process pool. Live
+uploads are collected for TAGGER_FLUSH_SECONDS before being tagged
+together, and a folder can be retagged in full through the job runner.
+"""
+import asyncio
+import logging
+import math
+import os
+import re
+from collections import Counter, defaultdict
+
+from . import tag_index
+from .cloud import upload_listeners
+from .parser import extraction_listeners, get_parser_pool, will_extract
+from ..config import get_settings
+from ..database import database_enabled, run_db
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+CATEGORY_BY_EXTENSION = {
+    "document": {".pdf", ".doc", ".docx", ".odt", ".rtf", ".txt", ".md"},
+    "spreadsheet": {".xlsx", ".xlsm", ".xls", ".ods", ".csv", ".tsv"},
+    "presentation": {".ppt", ".pptx", ".odp", ".key"},
+    "image": {".jpg", ".jpeg", ".png", ".gif", ".webp", ".svg", ".bmp", ".tiff", ".heic"},
+    "video": {".mp4", ".mov", ".avi", ".mkv", ".webm"},
+    "audio": {".mp3", ".wav", ".flac", ".ogg", ".m4a", ".aac"},
+    "archive": {".zip", ".tar", ".gz", ".tgz", ".rar", ".7z", ".bz2", ".xz"},
+    "code": {".py", ".js", ".ts", ".java", ".c", ".cpp", ".go", ".rs", ".html", ".css", ".json", ".xml", ".yml", ".yaml", ".sql", ".sh"},
+}
+_CATEGORY_BY_MIME_PREFIX = {"image/": "image", "video/": "video", "audio/": "audio", "text/": "document"}
+
+TAG_KEYWORDS = {
+    "finance": "invoice receipt budget payment tax salary expense expenses bank account accounts balance transaction transactions refund billing bill price quote revenue profit",
+    "education": "student students school college university course courses class exam exams grade grades syllabus assignment homework teacher enrollment admission semester",
+    "hr": "resume employee employees payroll hiring candidate interview onboarding leave appraisal recruitment",
+    "legal": "contract agreement nda terms clause liability license licence policy compliance signature signed",
+    "report": "report summary analysis quarterly annual review findings results overview metrics",
+    "project": "project roadmap milestone milestones sprint task tasks deadline plan planning requirements specification",
+    "meeting": "meeting minutes agenda attendees discussion notes",
+    "medical": "patient doctor prescription medical hospital diagnosis clinic health insurance",
+    "travel": "flight hotel booking itinerary travel trip ticket passport visa reservation",
+    "personal": "family birthday wedding holiday vacation personal",
+    "marketing": "campaign marketing brand social audience leads newsletter seo",
+    "template": "template sample example draft",
+}
+# term -> tags it votes for
+_KEYWORD_TAGS = defaultdict(list)
+for _tag, _words in TAG_KEYWORDS.items():
+    for _word in _words.split():
+        _KEYWORD_TAGS[_word].append(_tag)
+
+_TOKEN = re.compile(r"[a-z]{2,}")
+# A keyword in the file name counts as much as this many hits in the text
+FILENAME_BOOST = 3.0
+
+_queued = defaultdict(set)
+_flusher = None
+
+
+def categorize(path: str, mimetype: str = None) -> str:
+    ext = os.path.splitext(path)[1].lower()
+    for category, extensions in CATEGORY_BY_EXTENSION.items():
+        if ext in extensions:
+            return category
+    for prefix, category in _CATEGORY_BY_MIME_PREFIX.items():
+        if (mimetype or "").startswith(prefix):
+            return category
+    return "other"
+
+def _keyword_counts(text: str) -> Counter:
+    # Only vocabulary terms matter, so everything else is dropped up front
+    return Counter(t for t in _TOKEN.findall(text.lower()) if t in _KEYWORD_TAGS)
+
+def tag_documents(docs: list, min_score: float, max_tags: int) -> list:
+    """
+    Tags a batch of {"path", "mimetype", "text"} documents. Document
+    frequencies are taken over the batch, so a term that shows up in most
+    of it (a shared template, say) counts for less. Pure CPU work, meant
+    to run in a pool worker.
+    """
+    text_counts = [_keyword_counts(doc["text"]) for doc in docs]
+    name_counts = [_keyword_counts(os.path.basename(doc["path"]).replace("_", " ")) for doc in docs]
+
+    df = Counter()
+    for text, name in zip(text_counts, name_counts):
+        df.update(set(text) | set(name))
+    n = len(docs)
+
+    results = []
+    for doc, text, name in zip(docs, text_counts, name_counts):
+        scores = defaultdict(float)
+        for term in set(text) | set(name):
+            idf = math.log((1 + n) / (1 + df[term])) + 1
+            weight = (1 + math.log(text[term]) if text[term] else 0) + FILENAME_BOOST * (term in name)
+            for tag in _KEYWORD_TAGS[term]:
+                scores[tag] += weight * idf
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        results.append({
+            "path": doc["path"],
+            "category": categorize(doc["path"], doc.get("mimetype")),
+            "tags": [tag for tag, score in ranked if score >= min_score][:max_tags],
+            "scores": {tag: round(score, 3) for tag, score in ranked},
+        })
+    return results
+
+
+async def _tag_batch(user_id: str, docs: list):
+    loop = asyncio.get_running_loop()
+    results = await loop.run_in_executor(
+        get_parser_pool(), tag_documents, docs, settings.TAGGER_MIN_SCORE, settings.TAGGER_MAX_TAGS
+    )
+    await run_db(tag_index.store_tags, user_id, results)
+
+async def retag_directory(user_id: str, rel_dir: str, on_progress=None) -> dict:
+    """
+    Retags every indexed file below `rel_dir` in TAGGER_BATCH_SIZE batches.
+    The next batch is read from the database while the current one is
+    being tagged. `on_progress(done, total)` is called after each batch.
+    """
+    rel_dir = rel_dir.strip("/").replace("..", "")
+    total = await run_db(tag_index.count_files, user_id, rel_dir)
+    limit, max_chars = settings.TAGGER_BATCH_SIZE, settings.TAGGER_MAX_CHARS
+
+    done = 0
+    if on_progress:
+        on_progress(done, total)
+    docs = await run_db(tag_index.fetch_batch, user_id, rel_dir, None, limit, max_chars)
+    while docs:
+        after = tuple(docs[-1]["path"].rpartition("/")[::2])
+        upcoming = asyncio.ensure_future(run_db(tag_index.fetch_batch, user_id, rel_dir, after, limit, max_chars))
+        try:
+            await _tag_batch(user_id, docs)
+        except BaseException:
+            upcoming.cancel()
+            raise
+        done += len(docs)
+        if on_progress:
+            on_progress(done, total)
+        docs = await upcoming
+
+    return {"message": f"Tagged {done} files", "tagged": done}
+
+async def _flush_queue():
+    global _flusher
+    await asyncio.sleep(settings.TAGGER_FLUSH_SECONDS)
+    _flusher = None
+    while _queued:
+        user_id, rel_paths = _queued.popitem()
+        rel_paths = sorted(rel_paths)
+        for i in range(0, len(rel_paths), settings.TAGGER_BATCH_SIZE):
+            try:
+                docs = await run_db(
+                    tag_index.fetch_files, user_id, rel_paths[i:i + settings.TAGGER_BATCH_SIZE], settings.TAGGER_MAX_CHARS
+                )
+                await _tag_batch(user_id, docs)
+            except Exception:
+                logger.exception("Tagging failed for %d files of user %s", len(rel_paths), user_id)
+
+def queue_tagging(user_id: str, rel_path: str):
+    global _flusher
+    if not (settings.TAGGER_ENABLED and database_enabled()):
+        return
+    _queued[user_id].add(rel_path)
+    if _flusher is None:
+        _flusher = asyncio.create_task(_flush_queue())
+
+def _on_upload(user_id: str, rel_path: str, size: int = None, content_type: str = None):
+    # Files getting their text extracted are queued once that's stored
+    if not will_extract(rel_path, size):
+        queue_tagging(user_id, rel_path)
+
+upload_listeners.append(_on_upload)
+extraction_listeners.append(queue_tagging)
@@ -0,0 +1,62 @@
+"""
+Extracted document text (see models.FILE_TEXT). Functions are blocking;
+call them through database.run_db from async code.
+"""
+import json
+
+from psycopg2 import errors
+
+from ..database import get_connection
+from .metadata_index import split_path
+
+
+def store_text(user_id: str, rel_path: str, result: dict) -> bool:
+    """
+    Saves one parser.extract_document result. Returns False when the file
+    has no file_index row (yet) to hang the text on.
+    """
+    parent, name = split_path(rel_path)
+    # Postgres text can't hold NUL characters
+    content = (result.get("text") or "").replace("\x00", "")
+    try:
+        with get_connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO file_text (user_id, parent, name, kind, content, truncated, metadata, error, extracted_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, now())
+                ON CONFLICT (user_id, parent, name) DO UPDATE
+                SET kind = EXCLUDED.kind, content = EXCLUDED.content, truncated = EXCLUDED.truncated,
+                    metadata = EXCLUDED.metadata, error = EXCLUDED.error, extracted_at = EXCLUDED.extracted_at
+                """,
+                (
+                    user_id, parent, name, result.get("kind") or "unknown", content,
+                    bool(result.get("truncated")), json.dumps(result.get("metadata") or {}), result.get("error"),
+                ),
+            )
+    except errors.ForeignKeyViolation:
+        return False
+    return True
+
+def get_text(user_id: str, rel_path: str):
+    parent, name = split_path(rel_path)
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT kind, content, truncated, metadata, error, extracted_at
+            FROM file_text WHERE user_id = %s AND parent = %s AND name = %s
+            """,
+            (user_id, parent, name),
+        )
+        row = cur.fetchone()
+    if row is None:
+        return None
+    kind, content, truncated, metadata, error, extracted_at = row
+    return {
+        "path": rel_path,
+        "kind": kind,
+        "text": content,
+        "truncated": truncated,
+        "metadata": metadata,
+        "error": error,
+        "extracted_at": extracted_at.isoformat(),
+    }
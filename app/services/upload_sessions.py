@@ -0,0 +1,287 @@
+import hashlib
+import json
+import math
+import mimetypes
+import os
+import shutil
+import threading
+import time
+import uuid
+
+import anyio
+from fastapi import HTTPException, Request, status
+from starlette.concurrency import run_in_threadpool
+
+from ..config import get_settings
+from ..schemas import TokenData, UploadSessionCreate
+from . import compression, metadata_index
+from .cloud import (
+    check_upload_size, dedup_enabled, join_key, notify_upload, record_content, store_known_content, store_upload,
+    update_index,
+)
+
+settings = get_settings()
+SESSION_DIR = settings.UPLOAD_SESSION_DIR
+_create_lock = threading.Lock()
+
+
+def _session_path(session_id: str) -> str:
+    # Session ids are uuid4 hex, anything else can't be ours
+    if not session_id.isalnum():
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload session not found")
+    return os.path.join(SESSION_DIR, session_id)
+
+def _session_gone() -> HTTPException:
+    return HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload session finalized or unknown")
+
+def _chunk_path(session_dir: str, index: int) -> str:
+    return os.path.join(session_dir, f"{index}.part")
+
+def _expected_chunk_size(meta: dict, index: int) -> int:
+    if index == meta["total_chunks"] - 1:
+        return meta["total_size"] - index * meta["chunk_size"]
+    return meta["chunk_size"]
+
+def _load_meta(session_id: str, user_id: str) -> dict:
+    session_dir = _session_path(session_id)
+    try:
+        with open(os.path.join(session_dir, "meta.json")) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload session not found")
+    if meta["user_id"] != user_id:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload session not found")
+    return meta
+
+def _received_chunks(session_dir: str) -> list:
+    return sorted(
+        int(name[:-len(".part")])
+        for name in os.listdir(session_dir)
+        if name.endswith(".part")
+    )
+
+def _purge_expired_sessions():
+    if not os.path.isdir(SESSION_DIR):
+        return
+    cutoff = time.time() - settings.UPLOAD_SESSION_TTL_HOURS * 3600
+    for name in os.listdir(SESSION_DIR):
+        session_dir = os.path.join(SESSION_DIR, name)
+        try:
+            if os.path.getmtime(session_dir) < cutoff:
+                shutil.rmtree(session_dir, ignore_errors=True)
+        except FileNotFoundError:
+            continue
+
+def _open_sessions(user_id: str) -> int:
+    # Sessions being finalized still hold their chunks, so they count too
+    if not os.path.isdir(SESSION_DIR):
+        return 0
+    count = 0
+    for name in os.listdir(SESSION_DIR):
+        try:
+            with open(os.path.join(SESSION_DIR, name, "meta.json")) as f:
+                count += json.load(f)["user_id"] == user_id
+        except (FileNotFoundError, NotADirectoryError, ValueError, KeyError):
+            continue
+    return count
+
+
+def create_upload_session(data: UploadSessionCreate, user: TokenData):
+    # Blocking: scans every open session, so routes call it in the threadpool
+    if data.total_size < 0:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="total_size must not be negative")
+    if data.chunk_size <= 0 or data.chunk_size > settings.UPLOAD_SESSION_MAX_CHUNK_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"chunk_size must be between 1 and {settings.UPLOAD_SESSION_MAX_CHUNK_SIZE} bytes"
+        )
+    check_upload_size(data.total_size)
+
+    _purge_expired_sessions()
+
+    session_id = uuid.uuid4().hex
+    session_dir = _session_path(session_id)
+    meta = {
+        "session_id": session_id,
+        "user_id": user.user_id,
+        "path": data.path.strip("/").replace("..", ""),
+        "filename": os.path.basename(data.filename),
+        "total_size": data.total_size,
+        "chunk_size": data.chunk_size,
+        # An empty file is still one (empty) chunk
+        "total_chunks": max(1, math.ceil(data.total_size / data.chunk_size)),
+        "created_at": time.time(),
+    }
+    # Count and create together, so parallel creates can't both squeeze in
+    with _create_lock:
+        limit = settings.UPLOAD_SESSION_MAX_PER_USER
+        if limit > 0 and _open_sessions(user.user_id) >= limit:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail=f"At most {limit} upload sessions can be open at once, finalize or abort one first"
+            )
+        os.makedirs(session_dir)
+        with open(os.path.join(session_dir, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+    return meta
+
+async def put_upload_chunk(session_id: str, index: int, request: Request, user: TokenData):
+    meta = _load_meta(session_id, user.user_id)
+    session_dir = _session_path(session_id)
+
+    if index < 0 or index >= meta["total_chunks"]:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Chunk index must be between 0 and {meta['total_chunks'] - 1}"
+        )
+    expected = _expected_chunk_size(meta, index)
+
+    # Write to a temp name and rename so a dropped connection never leaves a
+    # half-written chunk that looks complete. The temp name is unique per
+    # request so parallel retries of the same chunk don't clobber each other.
+    final_path = _chunk_path(session_dir, index)
+    tmp_path = f"{final_path}.{uuid.uuid4().hex}.tmp"
+    received = 0
+    try:
+        # A finalize moves the session directory away, before or during the write
+        try:
+            f = await anyio.open_file(tmp_path, "wb")
+        except FileNotFoundError:
+            raise _session_gone()
+        async with f:
+            async for data in request.stream():
+                received += len(data)
+                if received > expected:
+                    raise HTTPException(
+                        status_code=status.HTTP_400_BAD_REQUEST,
+                        detail=f"Chunk {index} must be exactly {expected} bytes"
+                    )
+                await f.write(data)
+        if received != expected:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Chunk {index} must be exactly {expected} bytes, got {received}"
+            )
+        try:
+            os.replace(tmp_path, final_path)
+        except FileNotFoundError:
+            raise _session_gone()
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return {"session_id": session_id, "index": index, "size": received}
+
+def get_upload_session_status(session_id: str, user: TokenData):
+    meta = _load_meta(session_id, user.user_id)
+    received = _received_chunks(_session_path(session_id))
+
+    # Collapse received chunks into contiguous byte ranges [start, end)
+    ranges = []
+    for index in received:
+        start = index * meta["chunk_size"]
+        end = start + _expected_chunk_size(meta, index)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+
+    received_set = set(received)
+    return {
+        **meta,
+        "received_chunks": received,
+        "missing_chunks": [i for i in range(meta["total_chunks"]) if i not in received_set],
+        "received_bytes": sum(end - start for start, end in ranges),
+        "received_ranges": ranges,
+    }
+
+def _hash_chunks(session_dir: str, total_chunks: int, read_size: int) -> str:
+    digest = hashlib.sha256()
+    for index in range(total_chunks):
+        with open(_chunk_path(session_dir, index), "rb") as f:
+            while data := f.read(read_size):
+                digest.update(data)
+    return digest.hexdigest()
+
+async def _iter_chunks(session_dir: str, total_chunks: int, read_size: int):
+    for index in range(total_chunks):
+        async with await anyio.open_file(_chunk_path(session_dir, index), "rb") as f:
+            while True:
+                data = await f.read(read_size)
+                if not data:
+                    break
+                yield data
+
+async def finalize_upload_session(session_id: str, user: TokenData):
+    meta = _load_meta(session_id, user.user_id)
+    session_dir = _session_path(session_id)
+
+    missing = set(range(meta["total_chunks"])) - set(_received_chunks(session_dir))
+    if missing:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Upload incomplete, missing chunks: {sorted(missing)}"
+        )
+
+    # Claim the session so a concurrent finalize can't upload it twice
+    claimed_dir = f"{session_dir}.finalizing"
+    try:
+        os.rename(session_dir, claimed_dir)
+    except FileNotFoundError:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Upload session is already being finalized")
+
+    full_path = join_key(user.user_id, meta["path"], meta["filename"])
+    content_type, _ = mimetypes.guess_type(meta["filename"])
+    content_type = content_type or "application/octet-stream"
+
+    try:
+        # Hashed up front so the hash can go into the object's metadata
+        sha256 = None
+        if dedup_enabled():
+            sha256 = await run_in_threadpool(_hash_chunks, claimed_dir, meta["total_chunks"], settings.UPLOAD_CHUNK_SIZE)
+        copied = None
+        if sha256:
+            copied = await store_known_content(user.user_id, sha256, meta["total_size"], full_path, content_type)
+        stored_size = None
+        if copied:
+            public_url, encoding = copied
+        else:
+            sample = None
+            if compression.should_probe(content_type, meta["total_size"]):
+                async with await anyio.open_file(_chunk_path(claimed_dir, 0), "rb") as f:
+                    sample = await f.read(settings.COMPRESSION_SAMPLE_SIZE)
+            body = _iter_chunks(claimed_dir, meta["total_chunks"], settings.UPLOAD_CHUNK_SIZE)
+            public_url, stored_size, encoding = await store_upload(
+                full_path, body, content_type, meta["total_size"], sample, sha256
+            )
+    except Exception:
+        # Hand the chunks back so the client can retry the finalize
+        os.rename(claimed_dir, session_dir)
+        raise
+
+    shutil.rmtree(claimed_dir, ignore_errors=True)
+    await update_index(
+        user.user_id, metadata_index.record_object,
+        join_key(meta["path"], meta["filename"]), meta["total_size"], content_type,
+        None, stored_size, encoding
+    )
+    # Recorded so later uploads of the same bytes become copies
+    if sha256:
+        await record_content(user.user_id, sha256, meta["total_size"], full_path, content_type)
+    notify_upload(user.user_id, join_key(meta["path"], meta["filename"]), meta["total_size"], content_type)
+    return {
+        "message": "Upload successful",
+        "url": public_url,
+        "filename": meta["filename"],
+        "path": meta["path"],
+        "content_type": content_type,
+        "sha256": sha256,
+        "deduplicated": copied is not None,
+        "content_encoding": encoding
+    }
+
+def abort_upload_session(session_id: str, user: TokenData):
+    _load_meta(session_id, user.user_id)
+    shutil.rmtree(_session_path(session_id), ignore_errors=True)
+    return {"message": "Upload session aborted"}
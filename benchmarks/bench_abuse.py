@@ -0,0 +1,164 @@
+"""
+Noisy-neighbour benchmark for per-user admission control.
+
+Starts benchmarks/fake_storage.py and app.main:app like bench_endpoints, then
+has a well-behaved user list a folder one request at a time, first alone and
+then while an abusive user keeps --abuse-concurrency uploads of --file-size
+bytes going and retries the moment anything fails. This runs once with the
+limits off and once with them on (the app's defaults, or whatever
+RATE_LIMIT_* and UPLOAD_BANDWIDTH_PER_USER are set to in the environment).
+Prints JSON with the well-behaved user's p50/p95/p99 in each phase and how
+the abuser's requests were answered. The abuser runs in its own process,
+so give it a spare core or it competes with the app for CPU.
+
+    python -m benchmarks.bench_abuse --latency-ms 20 --abuse-concurrency 200
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import httpx
+import jwt
+
+from .bench_endpoints import _free_port, _start, _summary, _wait_until_up
+
+LIMITS_OFF = {"RATE_LIMIT_PER_SECOND": "0", "RATE_LIMIT_MAX_HEAVY": "0", "UPLOAD_BANDWIDTH_PER_USER": "0"}
+
+
+async def _login(client: httpx.AsyncClient, email: str) -> dict:
+    response = await client.post("/auth/login", json={"email": email, "password": "bench"})
+    response.raise_for_status()
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+async def _victim(client: httpx.AsyncClient, headers: dict, n: int) -> dict:
+    latencies, errors = [], []
+    start = time.perf_counter()
+    for _ in range(n):
+        began = time.perf_counter()
+        response = await client.get("/file/files", params={"path": "victim"}, headers=headers)
+        if response.status_code == 200:
+            latencies.append(time.perf_counter() - began)
+        else:
+            errors.append(f"{response.status_code} {response.text[:200]}")
+    return _summary(latencies, errors, time.perf_counter() - start, None)
+
+async def _abuse(base_url: str, headers: dict, args, stop, results):
+    payload = os.urandom(args.file_size)
+    statuses = Counter()
+
+    async def one_connection(n: int):
+        i = 0
+        while not stop.is_set():
+            i += 1
+            try:
+                response = await client.post(
+                    "/file/upload", files={"file": (f"a{n}-{i}.bin", payload)}, data={"path": "abuse"}, headers=headers
+                )
+                statuses[response.status_code] += 1
+            except httpx.HTTPError as e:
+                statuses[type(e).__name__] += 1
+
+    async with httpx.AsyncClient(
+        base_url=base_url, timeout=120,
+        limits=httpx.Limits(max_connections=None, max_keepalive_connections=None),
+    ) as client:
+        await asyncio.gather(*(one_connection(n) for n in range(args.abuse_concurrency)))
+    results.put({str(k): v for k, v in statuses.items()})
+
+def _abuser(base_url: str, headers: dict, args, stop, results):
+    asyncio.run(_abuse(base_url, headers, args, stop, results))
+
+async def _run(base_url: str, args) -> dict:
+    client = httpx.AsyncClient(
+        base_url=base_url, timeout=120,
+        limits=httpx.Limits(max_connections=None, max_keepalive_connections=None),
+    )
+    try:
+        victim = await _login(client, "victim@example.com")
+        abuser = await _login(client, "abuser@example.com")
+        for i in range(10):
+            response = await client.post(
+                "/file/upload", files={"file": (f"v{i}.bin", b"v")}, data={"path": "victim"}, headers=victim
+            )
+            response.raise_for_status()
+
+        alone = await _victim(client, victim, args.victim_requests)
+
+        context = multiprocessing.get_context("spawn")
+        stop, results = context.Event(), context.Queue()
+        process = context.Process(target=_abuser, args=(base_url, abuser, args, stop, results))
+        process.start()
+        # Let the flood build up before measuring
+        await asyncio.sleep(2)
+        during = await _victim(client, victim, args.victim_requests)
+        stop.set()
+        statuses = await asyncio.to_thread(results.get)
+        process.join()
+        return {"alone": alone, "under_abuse": during, "abuser_responses": statuses}
+    finally:
+        await client.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--victim-requests", type=int, default=200)
+    parser.add_argument("--abuse-concurrency", type=int, default=200)
+    parser.add_argument("--file-size", type=int, default=256 * 1024)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_abuse_")
+    storage_port = _free_port()
+    storage_url = f"http://127.0.0.1:{storage_port}"
+    log = open(os.path.join(workdir, "servers.log"), "w")
+    storage = _start("benchmarks.fake_storage:app", storage_port, {"FAKE_LATENCY_MS": str(args.latency_ms)}, log)
+    report = {"latency_ms": args.latency_ms, "abuse_concurrency": args.abuse_concurrency, "results": {}}
+    try:
+        _wait_until_up(f"{storage_url}/auth/v1/user", storage)
+        for mode in ("limits_off", "limits_on"):
+            app_port = _free_port()
+            app_env = {
+                "SUPABASE_URL": storage_url,
+                "SUPABASE_KEY": jwt.encode({"role": "service_role"}, "bench", algorithm="HS256"),
+                "SUPABASE_BUCKET": "bench",
+                "STORAGE_BACKEND": "supabase",
+                "JWT_SECRET": "bench-secret",
+                "DATABASE_URL": "",
+                "UPLOAD_SESSION_DIR": os.path.join(workdir, mode, "sessions"),
+                "RENAME_JOURNAL_DIR": os.path.join(workdir, mode, "renames"),
+                "JOB_DIR": os.path.join(workdir, mode, "jobs"),
+                "DOWNLOAD_CACHE_DIR": os.path.join(workdir, mode, "cache"),
+                **(LIMITS_OFF if mode == "limits_off" else {}),
+            }
+            app = _start("app.main:app", app_port, app_env, log)
+            try:
+                _wait_until_up(f"http://127.0.0.1:{app_port}/", app)
+                report["results"][mode] = asyncio.run(_run(f"http://127.0.0.1:{app_port}", args))
+                print(f"{mode}: {report['results'][mode]}", file=sys.stderr)
+            finally:
+                app.terminate()
+                app.wait()
+    finally:
+        storage.terminate()
+        storage.wait()
+        log.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
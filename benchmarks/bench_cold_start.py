@@ -0,0 +1,193 @@
+"""
+Cold-start benchmark.
+
+Each run uses fresh processes and measures:
+
+- import: `python -X importtime -c "import app.main"`. Reports the total and
+  the self time summed per top-level package, heaviest first.
+- first response: app.main:app is started under uvicorn against
+  benchmarks/fake_storage.py. Reports the time from spawning the process to
+  the first answered GET /, then the first authenticated /file/files and
+  the first /auth/login, each timed on its own.
+
+    python -m benchmarks.bench_cold_start --runs 5 --output cold_start.json
+    python -m benchmarks.bench_cold_start --runs 5 --baseline cold_start.json
+
+With --baseline, the medians are compared with a saved report. The exit
+status is 1 when any of them is more than --tolerance slower.
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import httpx
+import jwt
+
+from .bench_endpoints import _free_port, _start
+
+# Medians compared against --baseline
+TRACKED = ("import_ms", "first_response_ms", "first_file_request_ms", "first_login_ms")
+_IMPORT_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)")
+
+
+def _import_profile() -> dict:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app.main"],
+        capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr[-2000:])
+    total = 0
+    by_package = defaultdict(int)
+    for line in result.stderr.splitlines():
+        match = _IMPORT_LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        by_package[name.split(".")[0]] += int(self_us)
+        if not indent:
+            total += int(cumulative_us)
+    return {"import_ms": total / 1000, "by_package_ms": {k: v / 1000 for k, v in by_package.items()}}
+
+def _poll(client: httpx.Client, url: str, proc: subprocess.Popen, timeout: float = 30) -> httpx.Response:
+    # Tight loop on one client, so the measured time isn't rounded up to a
+    # sleep interval or spent building a client per attempt
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{url} exited with {proc.returncode}")
+        try:
+            return client.get(url)
+        except httpx.TransportError:
+            time.sleep(0.002)
+    raise RuntimeError(f"{url} did not answer")
+
+def _first_requests(storage_url: str, workdir: str, log) -> dict:
+    port = _free_port()
+    base = f"http://127.0.0.1:{port}"
+    env = {
+        "SUPABASE_URL": storage_url,
+        "SUPABASE_KEY": jwt.encode({"role": "service_role"}, "bench", algorithm="HS256"),
+        "SUPABASE_BUCKET": "bench",
+        "STORAGE_BACKEND": "supabase",
+        "JWT_SECRET": "bench-secret",
+        "DATABASE_URL": "",
+        "UPLOAD_SESSION_DIR": os.path.join(workdir, "sessions"),
+        "RENAME_JOURNAL_DIR": os.path.join(workdir, "renames"),
+        "JOB_DIR": os.path.join(workdir, "jobs"),
+        "DOWNLOAD_CACHE_DIR": os.path.join(workdir, "cache"),
+        "RATE_LIMIT_PER_SECOND": "0",
+        "RATE_LIMIT_MAX_HEAVY": "0",
+    }
+    token = jwt.encode({"sub": "bench", "session_id": "bench", "exp": time.time() + 600}, "bench-secret", algorithm="HS256")
+
+    client = httpx.Client(timeout=30)
+    start = time.perf_counter()
+    proc = _start("app.main:app", port, env, log)
+    try:
+        _poll(client, f"{base}/", proc)
+        first_response = time.perf_counter() - start
+
+        start = time.perf_counter()
+        response = client.get(f"{base}/file/files", params={"path": ""}, headers={"Authorization": f"Bearer {token}"})
+        response.raise_for_status()
+        first_file_request = time.perf_counter() - start
+
+        start = time.perf_counter()
+        response = client.post(f"{base}/auth/login", json={"email": "bench@example.com", "password": "bench"})
+        response.raise_for_status()
+        first_login = time.perf_counter() - start
+    finally:
+        proc.terminate()
+        proc.wait()
+        client.close()
+    return {
+        "first_response_ms": first_response * 1000,
+        "first_file_request_ms": first_file_request * 1000,
+        "first_login_ms": first_login * 1000,
+    }
+
+
+def _summary(values: list) -> dict:
+    return {
+        "median": round(statistics.median(values), 1),
+        "min": round(min(values), 1),
+        "max": round(max(values), 1),
+    }
+
+def _compare(report: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for name in TRACKED:
+        before = baseline["results"].get(name, {}).get("median")
+        after = report["results"][name]["median"]
+        if before and after > before * (1 + tolerance):
+            regressions.append({"metric": name, "baseline_ms": before, "current_ms": after,
+                                "change": round(after / before - 1, 3)})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--latency-ms", type=float, default=0, help="injected storage/auth latency")
+    parser.add_argument("--top", type=int, default=15, help="packages listed in the import profile")
+    parser.add_argument("--output", help="write the JSON report here as well as to stdout")
+    parser.add_argument("--baseline", help="report from an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown, as a fraction")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_cold_start_")
+    log = open(os.path.join(workdir, "servers.log"), "w")
+    storage_port = _free_port()
+    storage_url = f"http://127.0.0.1:{storage_port}"
+    storage = _start("benchmarks.fake_storage:app", storage_port, {"FAKE_LATENCY_MS": str(args.latency_ms)}, log)
+    samples = defaultdict(list)
+    packages = defaultdict(list)
+    try:
+        with httpx.Client() as client:
+            _poll(client, f"{storage_url}/auth/v1/user", storage)
+        # Untimed run, so .pyc files are written before anything is measured
+        _import_profile()
+        for _ in range(args.runs):
+            profile = _import_profile()
+            samples["import_ms"].append(profile["import_ms"])
+            for name, ms in profile["by_package_ms"].items():
+                packages[name].append(ms)
+            for name, ms in _first_requests(storage_url, workdir, log).items():
+                samples[name].append(ms)
+    finally:
+        storage.terminate()
+        storage.wait()
+        log.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    heaviest = sorted(packages.items(), key=lambda item: statistics.median(item[1]), reverse=True)
+    report = {
+        "runs": args.runs,
+        "python": sys.version.split()[0],
+        "results": {name: _summary(values) for name, values in samples.items()},
+        "import_by_package_ms": {name: round(statistics.median(values), 1) for name, values in heaviest[:args.top]},
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["regressions"] = _compare(report, json.load(f), args.tolerance)
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    if report.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+"""
+End-to-end endpoint benchmark.
+
+Starts benchmarks/fake_storage.py (storage and auth stand-in, with
+--latency-ms of injected latency) and app.main:app under uvicorn pointed at
+it, logs in through /auth/login, then drives login, upload, list, sign,
+rename_dir and delete_dir at each concurrency level. rename_dir and delete_dir are
+timed from submission until their job finishes. Prints JSON with p50, p95
+and p99 latency, throughput and errors per scenario and level, and the app
+process's peak RSS.
+
+    python -m benchmarks.bench_endpoints --latency-ms 20 --requests 200 --concurrency 1,8,32
+
+Pass --database-url to run with the metadata index; without it listings go
+to storage every time. Nothing outside a temp directory is written.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import jwt
+
+SCENARIOS = ("login", "upload", "list", "sign", "rename_dir", "delete_dir")
+# Sampling interval for the app's RSS while a level runs
+RSS_INTERVAL = 0.05
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _wait_until_up(url: str, proc: subprocess.Popen, timeout: float = 20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{url} exited with {proc.returncode}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.TransportError:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} did not start")
+
+def _start(module: str, port: int, env: dict, log) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", module, "--port", str(port), "--log-level", "warning", "--no-access-log"],
+        env={**os.environ, **env}, stdout=log, stderr=log,
+    )
+
+def _rss_mb(pid: int, field: str = "VmRSS"):
+    # Linux only; None elsewhere
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        return None
+    return None
+
+
+def _percentile(ordered: list, pct: float) -> float:
+    # Nearest-rank percentile of a sorted list, in ms
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return round(ordered[index] * 1000, 2)
+
+def _summary(latencies: list, errors: list, wall: float, peak_rss) -> dict:
+    ordered = sorted(latencies)
+    summary = {
+        "requests": len(latencies) + len(errors),
+        "errors": len(errors),
+        "wall_s": round(wall, 3),
+        "throughput_rps": round(len(latencies) / wall, 1) if wall else None,
+        "peak_rss_mb": peak_rss,
+    }
+    if ordered:
+        summary.update(
+            p50_ms=_percentile(ordered, 50),
+            p95_ms=_percentile(ordered, 95),
+            p99_ms=_percentile(ordered, 99),
+            max_ms=round(ordered[-1] * 1000, 2),
+        )
+    if errors:
+        summary["first_error"] = errors[0]
+    return summary
+
+
+class Bench:
+
+    def __init__(self, base_url: str, app_pid: int, args):
+        self.base_url = base_url
+        self.app_pid = app_pid
+        self.args = args
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=120,
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=None),
+        )
+        self.headers = {}
+        self.payload = os.urandom(args.file_size)
+
+    async def login(self):
+        response = await self.client.post("/auth/login", json={"email": "bench@example.com", "password": "bench"})
+        response.raise_for_status()
+        self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    async def _check(self, response: httpx.Response) -> dict:
+        # Most routes report failures in a 200 body, so both are checked
+        if response.status_code >= 400:
+            raise Exception(f"{response.status_code} {response.text[:200]}")
+        body = response.json()
+        if isinstance(body, dict) and body.get("status") == "error":
+            raise Exception(body.get("message"))
+        return body
+
+    async def _wait_for_job(self, body: dict):
+        job_id = body["result"]["job_id"]
+        while True:
+            job = (await self._check(await self.client.get(f"/file/jobs/{job_id}", headers=self.headers)))["result"]
+            if job["status"] == "succeeded":
+                return
+            if job["status"] in ("partial", "failed"):
+                raise Exception(f"job {job['status']}: {job['errors'][:1]}")
+            await asyncio.sleep(0.02)
+
+    async def _upload_dir(self, path: str, count: int):
+        files = [("files", (f"f{i}.bin", self.payload)) for i in range(count)]
+        body = await self._check(await self.client.post("/file/upload_bulk", files=files, data={"path": path}, headers=self.headers))
+        if body["result"]["failed"]:
+            raise Exception(f"setup upload to {path} failed")
+
+    async def _gather(self, coroutines, concurrency: int):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def bounded(coroutine):
+            async with semaphore:
+                return await coroutine
+        await asyncio.gather(*(bounded(c) for c in coroutines))
+
+    async def setup(self, scenario: str, level: int, n: int) -> list:
+        """
+        Untimed preparation; returns one argument per timed request.
+        """
+        prefix = f"bench/{scenario}/c{level}"
+        if scenario == "login":
+            return [f"bench{i}@example.com" for i in range(n)]
+        if scenario == "upload":
+            return [(prefix, f"u{i}.bin") for i in range(n)]
+        if scenario == "list":
+            await self._upload_dir(prefix, self.args.list_size)
+            return [prefix] * n
+        if scenario == "sign":
+            await self._upload_dir(prefix, min(n, self.args.list_size))
+            return [f"{prefix}/f{i % min(n, self.args.list_size)}.bin" for i in range(n)]
+        # rename_dir / delete_dir: one folder of --dir-files files per request
+        dirs = [f"{prefix}/d{i}" for i in range(n)]
+        await self._gather((self._upload_dir(d, self.args.dir_files) for d in dirs), 16)
+        return dirs
+
+    async def request(self, scenario: str, arg):
+        if scenario == "login":
+            await self._check(await self.client.post("/auth/login", json={"email": arg, "password": "bench"}))
+        elif scenario == "upload":
+            path, name = arg
+            await self._check(await self.client.post(
+                "/file/upload", files={"file": (name, self.payload)}, data={"path": path}, headers=self.headers
+            ))
+        elif scenario == "list":
+            await self._check(await self.client.get("/file/files", params={"path": arg, "limit": 100}, headers=self.headers))
+        elif scenario == "sign":
+            await self._check(await self.client.get("/file/get_signed_url", params={"file_path": arg}, headers=self.headers))
+        elif scenario == "rename_dir":
+            await self._wait_for_job(await self._check(await self.client.post(
+                "/file/rename_dir", data={"old_dir_path": arg, "new_dir_name": f"{arg.rpartition('/')[2]}-renamed"},
+                headers=self.headers
+            )))
+        elif scenario == "delete_dir":
+            await self._wait_for_job(await self._check(await self.client.request(
+                "DELETE", "/file/delete_dir", json={"dir_path": arg}, headers=self.headers
+            )))
+
+    async def _sample_rss(self, peak: list):
+        while True:
+            rss = _rss_mb(self.app_pid)
+            if rss is not None:
+                peak[0] = max(peak[0] or 0, rss)
+            await asyncio.sleep(RSS_INTERVAL)
+
+    async def run_level(self, scenario: str, level: int, n: int) -> dict:
+        args = await self.setup(scenario, level, n)
+        latencies, errors = [], []
+
+        async def one(arg):
+            start = time.perf_counter()
+            try:
+                await self.request(scenario, arg)
+                latencies.append(time.perf_counter() - start)
+            except Exception as e:
+                errors.append(str(e))
+
+        peak = [None]
+        sampler = asyncio.create_task(self._sample_rss(peak))
+        start = time.perf_counter()
+        try:
+            await self._gather((one(a) for a in args), level)
+        finally:
+            wall = time.perf_counter() - start
+            sampler.cancel()
+        return _summary(latencies, errors, wall, peak[0])
+
+    async def run(self) -> dict:
+        await self.login()
+        results = {}
+        levels = [int(c) for c in self.args.concurrency.split(",") if c]
+        for scenario in self.args.scenarios.split(","):
+            n = self.args.job_requests if scenario in ("rename_dir", "delete_dir") else self.args.requests
+            results[scenario] = {}
+            for level in levels:
+                results[scenario][level] = await self.run_level(scenario, level, n)
+                print(f"{scenario} c={level}: {results[scenario][level]}", file=sys.stderr)
+        await self.client.aclose()
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario and level")
+    parser.add_argument("--job-requests", type=int, default=40, help="rename_dir/delete_dir requests per level")
+    parser.add_argument("--concurrency", default="1,8,32")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--file-size", type=int, default=64 * 1024)
+    parser.add_argument("--list-size", type=int, default=100, help="files in the listed folder")
+    parser.add_argument("--dir-files", type=int, default=10, help="files per renamed/deleted folder")
+    parser.add_argument("--database-url", default="")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    unknown = set(args.scenarios.split(",")) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    workdir = tempfile.mkdtemp(prefix="bench_endpoints_")
+    storage_port, app_port = _free_port(), _free_port()
+    storage_url = f"http://127.0.0.1:{storage_port}"
+    app_env = {
+        "SUPABASE_URL": storage_url,
+        # The supabase client insists on a JWT-shaped key
+        "SUPABASE_KEY": jwt.encode({"role": "service_role"}, "bench", algorithm="HS256"),
+        "SUPABASE_BUCKET": "bench",
+        "STORAGE_BACKEND": "supabase",
+        "JWT_SECRET": "bench-secret",
+        "DATABASE_URL": args.database_url,
+        # One user drives every request, so per-user limits would only get in the way
+        "RATE_LIMIT_PER_SECOND": "0",
+        "RATE_LIMIT_MAX_HEAVY": "0",
+        "JOB_MAX_ACTIVE_PER_USER": "0",
+        "UPLOAD_SESSION_DIR": os.path.join(workdir, "sessions"),
+        "RENAME_JOURNAL_DIR": os.path.join(workdir, "renames"),
+        "JOB_DIR": os.path.join(workdir, "jobs"),
+        "DOWNLOAD_CACHE_DIR": os.path.join(workdir, "cache"),
+    }
+
+    log = open(os.path.join(workdir, "servers.log"), "w")
+    storage = _start("benchmarks.fake_storage:app", storage_port, {"FAKE_LATENCY_MS": str(args.latency_ms)}, log)
+    app = None
+    try:
+        _wait_until_up(f"{storage_url}/auth/v1/user", storage)
+        app = _start("app.main:app", app_port, app_env, log)
+        _wait_until_up(f"http://127.0.0.1:{app_port}/", app)
+        start_rss = _rss_mb(app.pid)
+        results = asyncio.run(Bench(f"http://127.0.0.1:{app_port}", app.pid, args).run())
+        report = {
+            "latency_ms": args.latency_ms,
+            "file_size": args.file_size,
+            "database": bool(args.database_url),
+            "app_start_rss_mb": start_rss,
+            "app_peak_rss_mb": _rss_mb(app.pid, "VmHWM"),
+            "results": results,
+        }
+    finally:
+        for proc in (app, storage):
+            if proc is not None:
+                proc.terminate()
+                proc.wait()
+        log.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
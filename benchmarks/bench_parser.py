@@ -0,0 +1,153 @@
+"""
+Throughput benchmark for app/services/parser.py.
+
+Generates a corpus of xlsx, csv, txt and pdf files (plus the sample
+spreadsheet in uploads/ when present), then extracts all of them in-process
+one by one and through process pools of increasing size. Prints JSON.
+
+    python -m benchmarks.bench_parser --docs 40 --rows 5000 --workers 1,2,4
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from app.services.parser import _limit_worker_memory, extract_document
+
+WORDS = "storage folder upload invoice student report budget quarterly summary archive".split()
+SAMPLE_XLSX = os.path.join("uploads", "Student_Import_Template.xlsx")
+
+
+def _sentence(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+def make_pdf(pages: list) -> bytes:
+    """Minimal single-font PDF with one line of text per page."""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # page tree, filled in once the page ids are known
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    page_ids = []
+    for text in pages:
+        escaped = text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+        stream = f"BT /F1 12 Tf 72 720 Td ({escaped}) Tj ET".encode()
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (len(objects))
+        )
+        page_ids.append(len(objects))
+    kids = " ".join(f"{i} 0 R" for i in page_ids).encode()
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(page_ids))
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+def build_corpus(directory: str, docs: int, rows: int, seed: int = 0) -> list:
+    from openpyxl import Workbook
+
+    rng = random.Random(seed)
+    paths = []
+    for i in range(docs):
+        kind = ("xlsx", "csv", "txt", "pdf")[i % 4]
+        path = os.path.join(directory, f"doc{i}.{kind}")
+        if kind == "xlsx":
+            workbook = Workbook(write_only=True)
+            sheet = workbook.create_sheet("Data")
+            for r in range(rows):
+                sheet.append([r, _sentence(rng, 3), rng.random() * 1000, rng.choice(WORDS)])
+            workbook.save(path)
+        elif kind == "csv":
+            with open(path, "w", newline="") as f:
+                writer = csv.writer(f)
+                for r in range(rows):
+                    writer.writerow([r, _sentence(rng, 3), rng.random() * 1000, rng.choice(WORDS)])
+        elif kind == "txt":
+            with open(path, "w") as f:
+                for _ in range(rows):
+                    f.write(_sentence(rng, 12) + "\n")
+        else:
+            with open(path, "wb") as f:
+                f.write(make_pdf([_sentence(rng, 12) for _ in range(max(1, rows // 100))]))
+        paths.append(path)
+    if os.path.exists(SAMPLE_XLSX):
+        paths.append(shutil.copy(SAMPLE_XLSX, directory))
+    return paths
+
+
+def _run(paths: list, max_chars: int, workers: int, memory_limit_mb: int, warmup: str) -> dict:
+    if workers == 0:
+        start = time.perf_counter()
+        results = [extract_document(p, p, max_chars) for p in paths]
+        wall = time.perf_counter() - start
+    else:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_limit_worker_memory,
+            initargs=(memory_limit_mb,),
+        ) as pool:
+            # The app keeps its pool alive, so worker start-up isn't timed
+            list(pool.map(extract_document, [warmup] * workers, [warmup] * workers, [max_chars] * workers))
+            start = time.perf_counter()
+            results = list(pool.map(extract_document, paths, paths, [max_chars] * len(paths)))
+            wall = time.perf_counter() - start
+    size = sum(os.path.getsize(p) for p in paths)
+    return {
+        "mode": "serial" if workers == 0 else f"pool-{workers}",
+        "docs": len(paths),
+        "errors": sum(1 for r in results if r["error"]),
+        "wall_s": round(wall, 3),
+        "docs_per_s": round(len(paths) / wall, 1),
+        "mb_per_s": round(size / wall / 1e6, 2),
+        "chars": sum(len(r["text"]) for r in results),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=40)
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--max-chars", type=int, default=1_000_000)
+    parser.add_argument("--memory-limit-mb", type=int, default=1024)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="bench_parser_")
+    try:
+        paths = build_corpus(directory, args.docs, args.rows)
+        warmup = os.path.join(directory, "warmup.txt")
+        with open(warmup, "w") as f:
+            f.write("warm up\n")
+        report = {
+            "corpus_mb": round(sum(os.path.getsize(p) for p in paths) / 1e6, 2),
+            "runs": [_run(paths, args.max_chars, 0, args.memory_limit_mb, warmup)],
+        }
+        for workers in [int(w) for w in args.workers.split(",") if w]:
+            report["runs"].append(_run(paths, args.max_chars, workers, args.memory_limit_mb, warmup))
+        # Peak RSS of the largest pool worker, i.e. per-document memory
+        report["worker_peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)
+        print(json.dumps(report, indent=2))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Before/after benchmark for storage calls made from async route handlers.
+
+"before" issues each call the way cloud.py used to: a module-level
+requests.post (new TCP connection, blocking the event loop) inside a
+coroutine. "after" uses the shared pooled client from
+app/services/clients.py. Both run N calls at each concurrency level against
+benchmarks/fake_storage.py with injected latency and print JSON.
+
+    python -m benchmarks.bench_storage_client --latency-ms 20 --requests 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import requests
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _start_fake_storage(port: int, latency_ms: float) -> subprocess.Popen:
+    env = {**os.environ, "FAKE_LATENCY_MS": str(latency_ms)}
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "benchmarks.fake_storage:app",
+         "--port", str(port), "--log-level", "warning"],
+        env=env,
+    )
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            requests.post(f"http://127.0.0.1:{port}/storage/v1/object/list/bench", json={"prefix": ""})
+            return proc
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("fake storage did not start")
+
+def _summary(latencies: list, wall: float) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "wall_s": round(wall, 4),
+        "throughput_rps": round(len(latencies) / wall, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 2),
+    }
+
+
+async def _run(call, total: int, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            await call()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(total)))
+    return _summary(latencies, time.perf_counter() - start)
+
+async def bench(base_url: str, total: int, levels: list) -> dict:
+    list_url = f"{base_url}/storage/v1/object/list/bench"
+    payload = {"prefix": "bench", "limit": 100, "offset": 0}
+
+    async def before():
+        requests.post(list_url, json=payload)
+
+    from app.services.clients import close_http_client, get_http_client, open_http_client
+    await open_http_client()
+
+    async def after():
+        await get_http_client().post(list_url, json=payload)
+
+    results = {}
+    try:
+        for concurrency in levels:
+            results[concurrency] = {
+                "before": await _run(before, total, concurrency),
+                "after": await _run(after, total, concurrency),
+            }
+    finally:
+        await close_http_client()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", default="1,8,32,64")
+    args = parser.parse_args()
+
+    port = _free_port()
+    proc = _start_fake_storage(port, args.latency_ms)
+    try:
+        levels = [int(c) for c in args.concurrency.split(",")]
+        results = asyncio.run(bench(f"http://127.0.0.1:{port}", args.requests, levels))
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    print(json.dumps({"latency_ms": args.latency_ms, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
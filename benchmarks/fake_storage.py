@@ -0,0 +1,276 @@
+"""
+In-memory stand-in for the Supabase storage REST API, good enough to drive
+app/services/cloud.py without a live project, plus the auth endpoints and
+profiles table app/services/auth_service.py uses. Any email/password pair
+signs in.
+
+    FAKE_LATENCY_MS=20 uvicorn benchmarks.fake_storage:app --port 9999
+
+FAKE_LATENCY_MS adds a fixed delay to every storage and auth call to mimic
+the round trip to a hosted project.
+"""
+import asyncio
+import base64
+import json
+import os
+import re
+import uuid
+from datetime import datetime, timezone
+from email.utils import format_datetime
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+LATENCY = float(os.getenv("FAKE_LATENCY_MS", "0")) / 1000
+
+# object key (without bucket) -> stored object
+objects = {}
+# access token -> email of the signed in user
+sessions = {}
+# user id -> profiles row
+profiles = {}
+
+
+async def _latency():
+    if LATENCY:
+        await asyncio.sleep(LATENCY)
+
+def _split_key(key: str):
+    bucket, _, path = key.partition("/")
+    return bucket, path
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+async def put_object(request: Request):
+    await _latency()
+    bucket, path = _split_key(request.path_params["key"])
+    if path in objects and request.headers.get("x-upsert", "false") != "true":
+        return JSONResponse({"statusCode": "409", "error": "Duplicate", "message": "The resource already exists"}, 400)
+
+    body = bytearray()
+    async for chunk in request.stream():
+        body.extend(chunk)
+    objects[path] = {
+        "id": str(uuid.uuid4()),
+        "data": bytes(body),
+        "mimetype": request.headers.get("content-type", "application/octet-stream"),
+        "updated_at": _now(),
+        "metadata": json.loads(base64.b64decode(request.headers["x-metadata"])) if "x-metadata" in request.headers else {},
+    }
+    return JSONResponse({"Key": f"{bucket}/{path}"})
+
+async def object_info(request: Request):
+    await _latency()
+    bucket, path = _split_key(request.path_params["key"])
+    obj = objects.get(path)
+    if obj is None:
+        return JSONResponse({"error": "not_found", "message": "Object not found"}, 400)
+    return JSONResponse({
+        "id": obj["id"],
+        "name": f"{bucket}/{path}",
+        "size": len(obj["data"]),
+        "content_type": obj["mimetype"],
+        "etag": f'"{obj["id"]}"',
+        "metadata": obj.get("metadata") or {},
+    })
+
+async def get_object(request: Request):
+    await _latency()
+    _, path = _split_key(request.path_params["key"])
+    obj = objects.get(path)
+    if obj is None:
+        return JSONResponse({"error": "not_found", "message": "Object not found"}, 400)
+    etag = f'"{obj["id"]}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": format_datetime(datetime.fromisoformat(obj["updated_at"]), usegmt=True),
+        "Accept-Ranges": "bytes",
+    }
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    data = obj["data"]
+    match = re.fullmatch(r"bytes=(\d+)-(\d*)", request.headers.get("range", ""))
+    if match and int(match[1]) < len(data):
+        start = int(match[1])
+        end = min(int(match[2]), len(data) - 1) if match[2] else len(data) - 1
+        headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+        return Response(data[start:end + 1], 206, media_type=obj["mimetype"], headers=headers)
+    return Response(data, media_type=obj["mimetype"], headers=headers)
+
+async def list_objects(request: Request):
+    await _latency()
+    body = await request.json()
+    prefix = body.get("prefix", "").strip("/")
+    limit = body.get("limit", 100)
+    offset = body.get("offset", 0)
+    sort_by = body.get("sortBy") or {"column": "name", "order": "asc"}
+    base = f"{prefix}/" if prefix else ""
+
+    files, folders = {}, set()
+    for key, obj in objects.items():
+        if not key.startswith(base):
+            continue
+        rest = key[len(base):]
+        if "/" in rest:
+            folders.add(rest.split("/", 1)[0])
+        else:
+            files[rest] = obj
+
+    # Like the real API: folders first, both groups sorted by the requested column
+    entries = [{"name": name, "id": None, "updated_at": None, "created_at": None, "metadata": None} for name in sorted(folders)]
+    file_entries = [
+        {
+            "name": name,
+            "id": obj["id"],
+            "updated_at": obj["updated_at"],
+            "created_at": obj["updated_at"],
+            "metadata": {"size": len(obj["data"]), "mimetype": obj["mimetype"], "eTag": f'"{obj["id"]}"'},
+        }
+        for name, obj in files.items()
+    ]
+    column = sort_by.get("column", "name")
+    file_entries.sort(key=lambda e: (e.get(column) or "", e["name"]), reverse=sort_by.get("order") == "desc")
+    entries += file_entries
+    return JSONResponse(entries[offset:offset + limit])
+
+async def remove_objects(request: Request):
+    await _latency()
+    body = await request.json()
+    removed = []
+    for key in body.get("prefixes", []):
+        if objects.pop(key, None) is not None:
+            removed.append({"name": key})
+    return JSONResponse(removed)
+
+async def move_object(request: Request):
+    await _latency()
+    body = await request.json()
+    source, destination = body["sourceKey"], body["destinationKey"]
+    if source not in objects:
+        return JSONResponse({"error": "not_found", "message": "Object not found"}, 400)
+    if destination in objects:
+        return JSONResponse({"statusCode": "409", "error": "Duplicate", "message": "The resource already exists"}, 400)
+    objects[destination] = objects.pop(source)
+    return JSONResponse({"message": "Successfully moved"})
+
+async def copy_object(request: Request):
+    await _latency()
+    body = await request.json()
+    source, destination = body["sourceKey"], body["destinationKey"]
+    if source not in objects:
+        return JSONResponse({"error": "not_found", "message": "Object not found"}, 400)
+    if destination in objects:
+        return JSONResponse({"statusCode": "409", "error": "Duplicate", "message": "The resource already exists"}, 400)
+    objects[destination] = {**objects[source], "id": str(uuid.uuid4()), "updated_at": _now()}
+    return JSONResponse({"Key": f"{body['bucketId']}/{destination}"})
+
+async def sign_object(request: Request):
+    await _latency()
+    key = request.path_params["key"]
+    bucket, path = _split_key(key)
+    body = await request.json()
+    if not path:
+        # POST /object/sign/{bucket} signs many paths at once
+        return JSONResponse([
+            {"path": p, "signedURL": f"/object/sign/{bucket}/{p}?token={uuid.uuid4().hex}", "error": None}
+            if p in objects else
+            {"path": p, "signedURL": None, "error": "Either the object does not exist or you do not have access to it"}
+            for p in body.get("paths", [])
+        ])
+    if path not in objects:
+        return JSONResponse({"error": "not_found", "message": "Object not found"}, 400)
+    return JSONResponse({"signedURL": f"/object/sign/{key}?token={uuid.uuid4().hex}"})
+
+
+def _user(email: str) -> dict:
+    return {
+        "id": str(uuid.uuid5(uuid.NAMESPACE_URL, email)),
+        "aud": "authenticated",
+        "role": "authenticated",
+        "email": email,
+        "app_metadata": {"provider": "email"},
+        "user_metadata": {},
+        "created_at": _now(),
+    }
+
+def _session(email: str) -> dict:
+    access_token = uuid.uuid4().hex
+    sessions[access_token] = email
+    return {
+        "access_token": access_token,
+        "token_type": "bearer",
+        "expires_in": 3600,
+        "expires_at": int(datetime.now(timezone.utc).timestamp()) + 3600,
+        "refresh_token": uuid.uuid4().hex,
+        "user": _user(email),
+    }
+
+async def token(request: Request):
+    await _latency()
+    body = await request.json()
+    if request.query_params.get("grant_type") != "password" or not body.get("email"):
+        return JSONResponse({"error": "invalid_grant", "error_description": "Invalid login credentials"}, 400)
+    return JSONResponse(_session(body["email"]))
+
+async def signup(request: Request):
+    await _latency()
+    body = await request.json()
+    if not body.get("email") or not body.get("password"):
+        return JSONResponse({"code": 400, "msg": "Signup requires a valid password"}, 400)
+    return JSONResponse(_session(body["email"]))
+
+async def recover(request: Request):
+    await _latency()
+    return JSONResponse({})
+
+async def get_user(request: Request):
+    await _latency()
+    email = sessions.get(request.headers.get("authorization", "").removeprefix("Bearer "))
+    if email is None:
+        return JSONResponse({"code": 401, "msg": "Invalid token"}, 401)
+    if request.method == "PUT":
+        await request.json()
+    return JSONResponse(_user(email))
+
+async def logout(request: Request):
+    await _latency()
+    sessions.pop(request.headers.get("authorization", "").removeprefix("Bearer "), None)
+    return Response(status_code=204)
+
+
+async def profiles_table(request: Request):
+    # Only the user_id=eq.<id> filter PostgREST would get from auth_service
+    await _latency()
+    user_id = request.query_params.get("user_id", "").removeprefix("eq.")
+    if request.method == "GET":
+        return JSONResponse([profiles[user_id]] if user_id in profiles else [])
+    body = await request.json()
+    if request.method == "POST":
+        if body.get("user_id") in profiles:
+            return JSONResponse({"code": "23505", "message": "duplicate key value violates unique constraint"}, 409)
+        profiles[body["user_id"]] = body
+    elif user_id in profiles:
+        profiles[user_id].update(body)
+    return Response(status_code=201 if request.method == "POST" else 204)
+
+
+app = Starlette(routes=[
+    Route("/auth/v1/token", token, methods=["POST"]),
+    Route("/auth/v1/signup", signup, methods=["POST"]),
+    Route("/auth/v1/recover", recover, methods=["POST"]),
+    Route("/auth/v1/user", get_user, methods=["GET", "PUT"]),
+    Route("/auth/v1/logout", logout, methods=["POST"]),
+    Route("/rest/v1/profiles", profiles_table, methods=["GET", "POST", "PATCH"]),
+    Route("/storage/v1/object/list/{bucket}", list_objects, methods=["POST"]),
+    Route("/storage/v1/object/move", move_object, methods=["POST"]),
+    Route("/storage/v1/object/copy", copy_object, methods=["POST"]),
+    Route("/storage/v1/object/sign/{key:path}", sign_object, methods=["POST"]),
+    Route("/storage/v1/object/info/{key:path}", object_info, methods=["GET"]),
+    Route("/storage/v1/object/{key:path}", put_object, methods=["PUT", "POST"]),
+    Route("/storage/v1/object/{key:path}", get_object, methods=["GET"]),
+    Route("/storage/v1/object/{key:path}", remove_objects, methods=["DELETE"]),
+])